@@ -7,11 +7,16 @@
 # See the LICENSE file in the GitHub repository for further details.
 
 import argparse
+import asyncio
+import atexit
+import base64
 from collections import OrderedDict
+import concurrent.futures
 import copy
 import datetime
 import gc
 import getpass
+import hashlib
 import html
 import json
 import queue
@@ -28,8 +33,22 @@ from urllib import parse
 #from OpenSSL.SSL import SysCallError
 from distutils.dir_util import copy_tree
 
+from . import backoff
+from . import blobstore
+from . import crawltree
+from . import discover
+from . import frontier
 from . import hg2git
+from . import cassette
+from . import planner
+from . import profiles
+from . import ratelimit
+from . import rules
+from . import sessions
+from . import telemetry
+from . import visited
 from . import __version__ as software_version 
+from .github_client import GitHubClient
 from .issue_migrate import import_issues_to_github
 
 bitbucket_api_url = 'https://api.bitbucket.org/2.0/'
@@ -87,39 +106,50 @@ def full_url_to_query(url):
     endpoint = parse.urlunsplit(list(split_data[0:3])+['',''])
     return endpoint, params
 
-def bb_query_api(endpoint, auth, params=None):
+def bb_query_api(endpoint, auth, params=None, headers=None):
     if not endpoint.startswith('https://'):
         endpoint = bb_endpoint_to_full_url(endpoint)
     endpoint, orig_params = full_url_to_query(endpoint)
     if params is not None:
         orig_params.update(params)
-    # Catch the API limit
+    # Wait for a permit from the rate limiter shared by all threads using these credentials
+    # (this keeps us just under the API limit rather than discovering it via 429 responses)
+    bucket = ratelimit.get_bucket('bitbucket', auth)
     retry = True
     retry_count = 0
     response = None
+    # time spent waiting for the rate limiter, and taken by the last attempt (see telemetry.py)
+    rate_limit_wait = 0
+    latency = 0
+    # (waits are interrupted by ABORT_EVENT and survive a PC hibernate)
+    connection_backoff = backoff.Backoff(base=5, cap=300, abort_event=ABORT_EVENT)
+    rate_limit_backoff = backoff.Backoff(base=5, cap=300, abort_event=ABORT_EVENT)
     while retry:
+        start = time.perf_counter()
+        if not bucket.acquire(ABORT_EVENT):
+            raise RuntimeError('Raising exception so that the thread ends sooner')
+        rate_limit_wait += time.perf_counter() - start
         try:
-            response = requests.get(endpoint, params=orig_params, auth=auth)
+            start = time.perf_counter()
+            response = sessions.request('bitbucket', auth, 'GET', endpoint, params=orig_params, headers=headers)
+            latency = time.perf_counter() - start
+            bucket.update(response.headers)
             if response.status_code == 429:
+                # Catch the API limit (the bucket then holds back every thread using these credentials)
                 retry_count += 1
+                retry_after = ratelimit.get_retry_after(response.headers)
+                # (with jitter, and growing exponentially if BitBucket doesn't say when to retry)
+                wait = bucket.penalise(rate_limit_backoff.delay(retry_after), slow_down=retry_after is None)
                 if retry_count%5 == 4:
-                    mins_wait = retry_count//5 + 1
-                    print(pad_message('({}) BitBucket API limit likely exceeded. Will retry in {} mins...'.format(auth[0], mins_wait)))
-                    # TODO: make this a sleep(1) in a loop that checks elapsed time, so that PC hibernate negates the sleep
-                    time.sleep(60*mins_wait)
-                else:
-                    time.sleep(5)
+                    print(pad_message('({}) BitBucket API limit likely exceeded. Will retry in {:.0f} seconds...'.format(auth[0], wait)))
                 continue
             retry = False
         except (requests.exceptions.SSLError, requests.exceptions.ConnectionError):
             retry_count += 1
+            wait = connection_backoff.delay()
             if retry_count%5 == 4:
-                mins_wait = retry_count//5 + 1
-                print(pad_message('({}) BitBucket API limit likely exceeded. Will retry in {} mins...'.format(auth[0], mins_wait)))
-                # TODO: make this a sleep(1) in a loop that checks elapsed time, so that PC hibernate negates the sleep
-                time.sleep(60*mins_wait)
-            else:
-                time.sleep(5)
+                print(pad_message('({}) Could not connect to the BitBucket API. Will retry in {:.0f} seconds...'.format(auth[0], wait)))
+            connection_backoff.wait(wait)
             continue
         except BaseException:
             # retry = False
@@ -128,8 +158,22 @@ def bb_query_api(endpoint, auth, params=None):
     if ABORT_EVENT.is_set():
         raise RuntimeError('Raising exception so that the thread ends sooner')
 
+    telemetry.record('bitbucket', endpoint, latency, response.status_code, len(response.content), retry_count, rate_limit_wait)
     return response
 
+_non_ascii_regex = re.compile(r'[^\x00-\x7f]')
+def _escape_non_ascii(matchobj):
+    char = matchobj.group(0)
+    if ord(char) > 0xffff:
+        # characters outside the basic multilingual plane are written as a surrogate pair
+        code = ord(char) - 0x10000
+        return '\\u{:04x}\\u{:04x}'.format(0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+    return '\\u{:04x}'.format(ord(char))
+
+def ascii_escape_json(data):
+    """Escapes all non-ASCII characters in a JSON document (they can only appear inside strings)"""
+    return _non_ascii_regex.sub(_escape_non_ascii, data)
+
 def bbapi_json(endpoint, auth, params=None):
     response = bb_query_api(endpoint, auth, params)
     try:
@@ -145,20 +189,9 @@ def gh_query_api(endpoint, auth, params=None, data=None, headers=None):
     endpoint, orig_params = full_url_to_query(endpoint)
     if params is not None:
         orig_params.update(params)
-    # Catch the API limit
-    retry = True
-    response = None
-    while retry:
-        try:
-            response = requests.get(endpoint, params=orig_params, auth=auth, data=data, headers=headers)
-            retry = False
-        except requests.exceptions.SSLError:
-            print('API limit likely exceeded. Will retry in 5 mins...')
-            time.sleep(60*5)
-        except BaseException:
-            # retry = False
-            raise
-    return response
+    # The client waits (and retries) if GitHub's rate limits are hit
+    github = GitHubClient(auth, abort_event=ABORT_EVENT)
+    return github.get(endpoint, params=orig_params, data=data, headers=headers)
 
 def ghapi_json(endpoint, auth, params=None, data=None, headers=None):
     response = gh_query_api(endpoint, auth, params=params, data=data, headers=headers)
@@ -228,6 +261,7 @@ class MigrationProject(object):
             'bitbucket_api_download_complete': False,
             # 'bitbucket_api_URL_replace_complete': False,
             'bitbucket_api_download_complete_list': [],
+            'bitbucket_api_refresh': False,
             'bitbucket_hg_download_complete': False,
 
             'import_to_github': True,
@@ -254,14 +288,65 @@ class MigrationProject(object):
 
             'reorder_comments_complete': False,
             'hash_link_complete': False,
+
+            # number of hosts (pool_connections) and connections per host (pool_maxsize) 
+            # kept alive for each set of credentials
+            'http_pool_connections': sessions.DEFAULT_POOL_CONNECTIONS,
+            'http_pool_maxsize': sessions.DEFAULT_POOL_MAXSIZE,
+            # seconds between writes of the API request statistics to telemetry.json (see telemetry.py)
+            'telemetry_interval': telemetry.DEFAULT_INTERVAL,
+
+            # API quota for each set of credentials (updated automatically from the 
+            # rate limit headers in API responses)
+            'bitbucket_requests_per_hour': ratelimit.DEFAULT_REQUESTS_PER_HOUR['bitbucket'],
+            'github_requests_per_hour': ratelimit.DEFAULT_REQUESTS_PER_HOUR['github'],
+
+            # 'threaded' makes one BitBucket API request at a time per set of credentials,
+            # 'asyncio' keeps bitbucket_crawl_concurrency requests in flight per set of credentials
+            'bitbucket_crawl_backend': 'threaded',
+            'bitbucket_crawl_concurrency': 4,
+            # number of threads (per set of credentials) downloading files referenced in the
+            # API data (images, avatars, attachments) alongside the API requests
+            'bitbucket_asset_download_threads': 4,
+            # which parts of the BitBucket API data to download (see profiles.py)
+            'bitbucket_crawl_profile': profiles.DEFAULT_PROFILE,
+            # save the JSON of each issue, pull request and commit from the pages of the list
+            # it is in (see discover.ItemLists), rather than requesting each one separately
+            'bitbucket_synthesise_items': False,
         }
 
+        self.__replaying = False
+
         p = argparse.ArgumentParser()
         p.add_argument('--load', action='store_true')
         p.add_argument('--storage-dir')
         p.add_argument('--project-name')
+        p.add_argument('--record-cassette', metavar='PATH', help='Record all HTTP requests and responses to the specified file')
+        p.add_argument('--replay-cassette', metavar='PATH', help='Serve all HTTP requests from a file created with --record-cassette (no network access is made)')
+        p.add_argument('--rebuild-pages-data', action='store_true', help='Regenerate gh-pages/data of a project from the downloaded BitBucket API data (no network access is made)')
+        p.add_argument('--repositories', nargs='+', metavar='OWNER/REPO', help='Only rebuild the data of these repositories (with --rebuild-pages-data)')
         arguments = p.parse_args()
 
+        if arguments.record_cassette is not None and arguments.replay_cassette is not None:
+            p.error('--record-cassette and --replay-cassette cannot be used together')
+        if arguments.record_cassette is not None:
+            self.__use_cassette(arguments.record_cassette, 'record')
+        elif arguments.replay_cassette is not None:
+            self.__use_cassette(arguments.replay_cassette, 'replay')
+
+        if arguments.repositories is not None and not arguments.rebuild_pages_data:
+            p.error('--repositories can only be used with --rebuild-pages-data')
+
+        kwargs = {}
+        if arguments.storage_dir is not None:
+            kwargs['location'] = arguments.storage_dir
+        if arguments.project_name is not None:
+            kwargs['project'] = arguments.project_name
+
+        if arguments.rebuild_pages_data:
+            self.__rebuild_pages_data(arguments.repositories, **kwargs)
+            return
+
         choices = {"Start new project":0, "Load project":1}
         if arguments.load:
             response=list(choices.keys())[1]
@@ -272,16 +357,37 @@ class MigrationProject(object):
         if choices[response] == 0:
             self.__start_project()
         elif choices[response] == 1:
-            kwargs = {}
-            if arguments.storage_dir is not None:
-                kwargs['location'] = arguments.storage_dir
-            if arguments.project_name is not None:
-                kwargs['project'] = arguments.project_name
             self.__load_project(**kwargs)
         else:
             raise RuntimeError('Unknown option selected')
 
+    def __use_cassette(self, path, mode):
+        try:
+            recording = cassette.Cassette(path, mode)
+        except (OSError, ValueError) as e:
+            print('Could not open the cassette {}: {}'.format(path, e))
+            sys.exit(1)
+        if mode == 'replay':
+            print('Replaying {} recorded HTTP responses from {}'.format(len(recording), path))
+        else:
+            print('Recording all HTTP traffic to {}'.format(path))
+        sessions.use_cassette(recording)
+        # the recorded responses are replayed as fast as they are requested (and the rate limit
+        # headers recorded with them are ignored), see __configure_http
+        self.__replaying = mode == 'replay'
+        # make sure the end of the (gzipped) file is written
+        atexit.register(recording.close)
+
     def __load_project(self, location=os.getcwd(), project=None):
+        self.__find_project(location, project)
+
+        # make sure we have a password/token or ask for it
+        self.__get_password('bitbucket', self.__settings['master_bitbucket_username'], silent=False)
+
+        self.__confirm_project_settings(load=True)
+
+    def __find_project(self, location=os.getcwd(), project=None):
+        # Loads the settings of an existing project
         project_found = False
         first_run = True
         while not project_found:
@@ -305,10 +411,35 @@ class MigrationProject(object):
 
             first_run = False
 
-        # make sure we have a password/token or ask for it
-        self.__get_password('bitbucket', self.__settings['master_bitbucket_username'], silent=False)
+    def __rebuild_pages_data(self, repositories=None, location=os.getcwd(), project=None):
+        # Rewrites the URLs in the downloaded API data again (for example, after changing the 
+        # URL rewrite file) using the tree of URLs saved by the crawl. Makes no API requests.
+        self.__find_project(location, project)
 
-        self.__confirm_project_settings(load=True)
+        all_repo_names = [repository['full_name'] for repository in self.__settings['bb_repositories_to_export']]
+        if repositories is not None:
+            unknown = [name for name in repositories if name not in all_repo_names]
+            if unknown:
+                print('The following repositories are not part of this project: {}'.format(', '.join(unknown)))
+                sys.exit(1)
+
+        def post_message(cmd, message):
+            if cmd == 'update':
+                print(pad_message(message[0]), end=message[1])
+
+        exporter = BitBucketExport(self.__settings['bitbucket_repo_owner'], None, copy.deepcopy(self.__settings), post_message, subset=repositories)
+        try:
+            exporter.rebuild_pages_data()
+        finally:
+            # the rebuilt files (even if only some were rebuilt) no longer contain the changes
+            # made by the later steps of the export, so make sure they are run again
+            self.__settings['reorder_comments_complete'] = False
+            self.__settings['hash_link_complete'] = False
+            self.__save_project_settings()
+        if ABORT_EVENT.is_set():
+            return
+
+        print('Rebuilt the data in {}. Load the project to process and publish it again.'.format(os.path.join(self.__settings['project_path'], 'gh-pages', 'data')))
 
     def __start_project(self):
         # Get the project name and save loction
@@ -366,9 +497,13 @@ class MigrationProject(object):
         #TODO: make resume have nicer text prompts
         choices = {
             "Start export":0, 
+            "Estimate the API requests, time and disk space needed for the export (downloads only the first page of each list)":2,
             "Exit":1,
         }
         response = q.select("What would you like to do?", choices=choices.keys()).ask()
+        while choices[response] == 2:
+            self.__estimate_export()
+            response = q.select("What would you like to do?", choices=choices.keys()).ask()
         if choices[response] == 0:
             
             faq_read = q.confirm("I have read the entire readme at https://github.com/philipstarkey/bitbucket-hg-exporter (including the FAQ) and understood the caveats listed. I understand that I use this tool at my own risk. Answer 'Y' for agree or 'N' to terminate the program:", default=False).ask()
@@ -390,6 +525,12 @@ class MigrationProject(object):
                         if not try_again:
                             break
 
+            self.__configure_http()
+            # write the statistics of the API requests made by the export as it runs (and when it ends)
+            telemetry_path = os.path.join(self.__settings['project_path'], 'telemetry.json')
+            telemetry.start(telemetry_path, self.__settings['telemetry_interval'])
+            atexit.register(telemetry.stop)
+
             owner = self.__settings['bitbucket_repo_owner']
             auth = (self.__settings['master_bitbucket_username'], self.__get_password('bitbucket', self.__settings['master_bitbucket_username']))
 
@@ -400,34 +541,6 @@ class MigrationProject(object):
 
             all_repo_names = [repository['full_name'] for repository in self.__settings['bb_repositories_to_export']]
             initial_num_repos = len(all_repo_names)
-            def recursively_process_repositories(repository):
-                if 'links' not in repository or 'forks' not in repository['links'] or 'href' not in repository['links']['forks']:
-                    return
-                status, json_response = bbapi_json(repository['links']['forks']['href'], auth, {'pagelen':100})
-                more = True
-                while more:
-                    if status == 200 and json_response is not None:
-                        # process repositories (don't add duplicates)
-                        for r in json_response['values']:
-                            if r['full_name'] not in all_repo_names:
-                                r['is_fork'] = True
-                                self.__settings['bb_repositories_to_export'].append(r)
-                                all_repo_names.append(r['full_name'])
-                                print('Finding all forks of {}'.format(r['full_name']))
-                                recursively_process_repositories(r)
-                        if 'next' in json_response:
-                            status, json_response = bbapi_json(json_response['next'], auth, {'pagelen':100})
-                        else:
-                            more = False
-                    elif status == 404:
-                        # some forks might have been deleted, but they are still reported by Bitbucket API
-                        # report the error and keep enumerating forks (of the remaining repos)
-                        print('Warning: repository {} might have been deleted (404).'.format(repository['full_name']))
-                        more = False
-                    else:
-                        print('Failed to query BitBucket API when determining forks for {}.'.format(repository['full_name']))
-                        sys.exit(1)
-            
             if self.__settings['backup_forks']:
                 if self.__settings['fork_search_complete']:
                     search = q.confirm('A previous run of this script determined the list of all repository forks. Would you like to search for any new forks since the last run?', default=False).ask()
@@ -438,7 +551,7 @@ class MigrationProject(object):
                     for repository in self.__settings['bb_repositories_to_export']:
                         # recursively get list of all forks
                         print('Finding all forks of {}'.format(repository['full_name']))
-                        recursively_process_repositories(repository)
+                        self.__find_forks(repository, auth, self.__settings['bb_repositories_to_export'], all_repo_names)
                     self.__settings['fork_search_complete'] = True
             else:
                 # remove forks
@@ -452,32 +565,49 @@ class MigrationProject(object):
                 self.__settings['bitbucket_api_download_complete'] = False
                 # self.__settings['bitbucket_api_URL_replace_complete'] = False
 
+            if self.__settings['bitbucket_api_download_complete'] and not self.__settings['bitbucket_api_refresh']:
+                refresh = q.confirm('The BitBucket API data was downloaded during a previous run of this script. Would you like to refresh it? (only data that has changed since it was downloaded will be downloaded again)', default=False).ask()
+                if refresh:
+                    self.__settings['bitbucket_api_refresh'] = True
+                    self.__settings['bitbucket_api_download_complete'] = False
+                    self.__settings['bitbucket_api_download_complete_list'] = []
+                    # updated comments need to be put back in order
+                    self.__settings['reorder_comments_complete'] = False
+                    self.__save_project_settings()
+
             if not self.__settings['bitbucket_api_download_complete']:
                 import colorama
                 colorama.init()
                 auth_list = [auth] + [(user, self.__get_password('bitbucket', user)) for user in self.__settings['bitbucket_additional_users']]
                 message_queue = queue.Queue()
-                subset = [[] for _ in auth_list]
+                # A single exporter shares the requests for every repository between all of the accounts
+                # (so that no account sits idle while there are still URLs to download)
+                subset = [[repo['full_name'] for repo in self.__settings['bb_repositories_to_export'] if repo['full_name'] not in self.__settings['bitbucket_api_download_complete_list']]]
+                labels = [', '.join([credentials[0] for credentials in auth_list])]
                 threads = {}
-                latest_messages = ['' for _ in auth_list]
-                needs_processing = [repo for repo in self.__settings['bb_repositories_to_export'] if repo['full_name'] not in self.__settings['bitbucket_api_download_complete_list']]
-                for i, repository in enumerate(needs_processing):
-                    subset[i%len(auth_list)].append(repository['full_name'])
+                latest_messages = ['' for _ in subset]
 
                 def thread_fn(i, message_queue, credentials):
-                    exporter = BitBucketExport(owner, credentials, copy.deepcopy(self.__settings), lambda cmd, message, i=i, q=message_queue:message_queue.put((i,cmd,message)), subset=subset[i])
-                    exporter.backup_api()
-                    message_queue.put((i, 'finished', ''))
+                    # (always reports that it has finished, otherwise the loop below waits forever)
+                    try:
+                        exporter = BitBucketExport(owner, credentials[0], copy.deepcopy(self.__settings), lambda cmd, message, i=i, q=message_queue:message_queue.put((i,cmd,message)), subset=subset[i], additional_credentials=credentials[1:])
+                        exporter.backup_api()
+                    except BaseException as e:
+                        message_queue.put((i, 'error', '{}: {}'.format(type(e).__name__, e)))
+                        raise
+                    finally:
+                        message_queue.put((i, 'finished', ''))
 
-                for i, credentials in enumerate(auth_list):
-                    t = threading.Thread(target=thread_fn, args=(i, message_queue, credentials))
+                for i in range(len(subset)):
+                    t = threading.Thread(target=thread_fn, args=(i, message_queue, auth_list))
                     t.daemon = True
-                    _REGISTERED_THREADS["Thread {} ({})".format(i, credentials[0])] = t
+                    _REGISTERED_THREADS["Thread {} ({})".format(i, labels[i])] = t
                     t.start()
                     threads[i] = t
 
                 last_update_time = time.time()-1
                 overwrite_last_lines = True
+                errors = []
                 while threads:
                     force = False
                     try:
@@ -490,7 +620,7 @@ class MigrationProject(object):
                                 force = message[2]
 
                             if message[1] == '\n':
-                                print(pad_message("Thread {} ({}): {}".format(i, auth_list[i][0], message[0])))
+                                print(pad_message("Thread {} ({}): {}".format(i, labels[i], message[0])))
                                 # overwrite_last_lines = False
                                 force = True
                             else:
@@ -498,13 +628,17 @@ class MigrationProject(object):
                         elif cmd == 'complete':
                             self.__settings['bitbucket_api_download_complete_list'].append(message)
                             self.__save_project_settings()
+                        elif cmd == 'error':
+                            errors.append(message)
+                            print(pad_message("Thread {} ({}): ERROR: {}".format(i, labels[i], message)))
+                            force = True
                         elif cmd == 'finished':
                             del threads[i]
                             force = True
 
                     if time.time() - last_update_time > 0.25 or force:
                         last_update_time = time.time()
-                        pm = '\n'.join([pad_message("Thread {} ({}): {}".format(i, auth_list[i][0], m)) for i,m in enumerate(latest_messages)])
+                        pm = '\n'.join([pad_message("Thread {} ({}): {}".format(i, labels[i], m)) for i,m in enumerate(latest_messages)])
                         end = '\n'
                         if overwrite_last_lines and threads:
                             # calculate number of links to move up
@@ -515,9 +649,19 @@ class MigrationProject(object):
                         print(pm, end=end)
                         overwrite_last_lines = True
 
-                self.__settings['bitbucket_api_download_complete'] = True
-                self.__save_project_settings()
                 colorama.deinit()
+                if errors:
+                    print('The download of the BitBucket API data failed. Run the export again to resume it.')
+                    sys.exit(1)
+                incomplete = [name for name in subset[0] if name not in self.__settings['bitbucket_api_download_complete_list']]
+                if incomplete:
+                    # (the files that failed to download are downloaded again when the crawl is resumed)
+                    print('WARNING: Some files referenced in the BitBucket API data of {} could not be downloaded. Run the export again to retry them.'.format(', '.join(incomplete)))
+                else:
+                    self.__settings['bitbucket_api_download_complete'] = True
+                    self.__settings['bitbucket_api_refresh'] = False
+                self.__save_project_settings()
+                print(sessions.format_statistics(sessions.statistics()))
 
             # clone the Hg repos (including forks if specified)            
             do_hg_pull = True
@@ -567,10 +711,13 @@ class MigrationProject(object):
             github_auth = ('', '') # empty values. Will be filled in if we are actually using GitHub (see a few lines below)
             github_headers = {"Accept": "application/vnd.github.barred-rock-preview"}
 
-            # If needed, import all repositories to GitHub
             if self.__settings['import_to_github']:
                 github_auth = (self.__settings['master_github_username'], self.__get_password('github', self.__settings['master_github_username']))
-            
+            # All GitHub API requests are made through this client so that they stay within GitHub's rate limits
+            github = GitHubClient(github_auth, headers=github_headers, abort_event=ABORT_EVENT)
+
+            # If needed, import all repositories to GitHub
+            if self.__settings['import_to_github']:
                 if self.__settings['hg_to_git_tool'] == 'github':
                     for repository in self.__settings['bb_repositories_to_export']:
                         # skip forks if we are not importing them to github
@@ -580,7 +727,7 @@ class MigrationProject(object):
 
                         # update status if we are in an error condition as this determines whether we should try again and we need to make sure we are not working from stale data
                         if repository['full_name'] in self.__settings['github_existing_repositories'] and self.__settings['github_existing_repositories'][repository['full_name']]['import_started'] and 'import_status' in self.__settings['github_existing_repositories'][repository['full_name']] and self.__settings['github_existing_repositories'][repository['full_name']]['import_status']['status'] == 'error':
-                            import_status_check = requests.get(self.__settings['github_existing_repositories'][repository['full_name']]['import_url'], auth=github_auth, headers=github_headers)
+                            import_status_check = github.get(self.__settings['github_existing_repositories'][repository['full_name']]['import_url'])
                             if import_status_check.status_code == 200:
                                 self.__settings['github_existing_repositories'][repository['full_name']]['import_status'] = import_status_check.json()
                             else:
@@ -619,7 +766,7 @@ class MigrationProject(object):
                             # cancel any error requests
                             if error_condition:
                                 print('Cancelling import for repository {owner}/{repo_name}) as it was in an error state. We will re-request the import shortly.'.format(owner=owner, repo_name=github_slug))
-                                response = requests.delete('https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers)
+                                response = github.delete('https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug))
                                 if response.status_code != 204:
                                     print('WARNING: Failed to cancel import with error state (repository: {owner}/{repo_name}). We suggest visiting github.com/{owner}/{repo_name} and attempting to restart the import from there.'.format(owner=owner, repo_name=github_slug))
                                     continue
@@ -634,7 +781,7 @@ class MigrationProject(object):
                                 # "vcs_password": auth[1]
                             }
                             print('Requesting source import for repository {}/{}'.format(owner, github_slug))
-                            response = requests.put('https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers, json=params)
+                            response = github.put('https://api.github.com/repos/{owner}/{repo_name}/import'.format(owner=owner, repo_name=github_slug), json=params)
                             if response.status_code != 201:
                                 print('Failed to import BitBucket repository {} to GitHub. Response code was: {}'.format(repository['full_name'], response.status_code))
                                 sys.exit(1)
@@ -645,7 +792,7 @@ class MigrationProject(object):
                             })
                             self.__save_project_settings()
                             # enable LFS
-                            response = requests.patch('https://api.github.com/repos/{owner}/{repo_name}/import/lfs'.format(owner=owner, repo_name=github_slug), auth=github_auth, headers=github_headers, json={"use_lfs": "opt_in"})
+                            response = github.patch('https://api.github.com/repos/{owner}/{repo_name}/import/lfs'.format(owner=owner, repo_name=github_slug), json={"use_lfs": "opt_in"})
 
                     # wait for all imports to complete
                     all_finished = False
@@ -661,7 +808,7 @@ class MigrationProject(object):
                                 continue
                             if 'import_status' not in github_data or github_data['import_status']['status'] != 'complete':
                                 # get the current status
-                                response = requests.get(github_data['import_url'], auth=github_auth, headers=github_headers)
+                                response = github.get(github_data['import_url'])
                                 if response.status_code != 200:
                                     all_finished = False
                                     print('Failed to check status of import to {}. Will try again next loop.'.format(github_data['name']))
@@ -676,7 +823,8 @@ class MigrationProject(object):
                                 self.__save_project_settings()
                         if not all_finished:
                             print('sleeping for 30 seconds...')
-                            time.sleep(30)
+                            if not backoff.wait(30, ABORT_EVENT):
+                                raise RuntimeError('Aborted while waiting for the GitHub import to complete')
                 elif self.__settings['hg_to_git_tool'] == 'local':
                     # TODO: Write this
                     repo_mapping = {}
@@ -764,7 +912,7 @@ class MigrationProject(object):
 
                     # get the github repository information
                     github_data = self.__settings['github_existing_repositories'][repository['full_name']]
-                    response = requests.get(github_data['import_status']['repository_url'], auth=github_auth, headers=github_headers)
+                    response = github.get(github_data['import_status']['repository_url'])
                     if response.status_code != 200:
                         print('Failed to get GitHub repository information for {}'.format(github_data['name']))
                         sys.exit(1)
@@ -913,6 +1061,9 @@ class MigrationProject(object):
                     repo_data = top_level_repo_data[repository['full_name']]
                     if "links" in repo_data and "pullrequests" in repo_data['links'] and 'href' in repo_data['links']['pullrequests']:
                         pull_request_path = os.path.join(self.__settings['project_path'], 'gh-pages', *repo_data['links']['pullrequests']['href'].split('/'))
+                        # (not downloaded if skipped by the crawl profile)
+                        if not os.path.exists(pull_request_path):
+                            pull_request_path = None
 
                     # open that file, iterate over each pull requests, and find links to comments
                     comment_paths = []
@@ -930,6 +1081,8 @@ class MigrationProject(object):
                     # find location of commit list
                     if "links" in repo_data and "commits" in repo_data['links'] and 'href' in repo_data['links']['commits']:
                         pull_request_path = os.path.join(self.__settings['project_path'], 'gh-pages', *repo_data['links']['commits']['href'].split('/'))
+                        if not os.path.exists(pull_request_path):
+                            pull_request_path = None
 
                     # open that file, iterate over each commit, and find links to comments
                     # TODO: rename variables
@@ -1109,6 +1262,9 @@ class MigrationProject(object):
                                 node_tags.append(" ".join(parts[1:]))
                             
                     repo_api_path = os.path.join(self.__settings['project_path'], 'gh-pages', 'data', 'repositories', *repository['full_name'].split('/'))
+                    if not os.path.isdir(os.path.join(repo_api_path, 'commit')):
+                        # the commits were skipped by the crawl profile
+                        continue
                     for filename in os.listdir(os.path.join(repo_api_path, 'commit')):
                         if filename.endswith('.json'):
                             try:
@@ -1209,17 +1365,16 @@ class MigrationProject(object):
 
                 
                 # Configure for github pages
-                github_headers = {"Accept": 'application/vnd.github.switcheroo-preview+json'}
+                pages_headers = {"Accept": 'application/vnd.github.switcheroo-preview+json'}
                 pages_data = {
                     "source": {
                         "branch": "master",
                         "path": ""
                     }
                 }
-                response = requests.post(
+                response = github.post(
                     'https://api.github.com/repos/{owner}/{repo}/pages'.format(owner=self.__settings['github_owner'], repo=self.__settings['github_pages_repo_name']),  
-                    auth=github_auth, 
-                    headers=github_headers,
+                    headers=pages_headers,
                     json=pages_data
                 )
                 # Only error on response codes that are not success or "already enabled"
@@ -1239,9 +1394,8 @@ class MigrationProject(object):
                         "cname": None,
                         "source": "master"
                     }
-                response = requests.put(
+                response = github.put(
                     'https://api.github.com/repos/{owner}/{repo}/pages'.format(owner=self.__settings['github_owner'], repo=self.__settings['github_pages_repo_name']),  
-                    auth=github_auth, 
                     json=pages_data
                 )
                 if response.status_code != 204:
@@ -1257,7 +1411,7 @@ class MigrationProject(object):
                 for repository in self.__settings['bb_repositories_to_export']: 
                     bb_repo = repository['full_name']
                     gh_repo = self.__settings['github_existing_repositories'][bb_repo]['repository']['full_name']
-                    import_issues_to_github(bb_repo, gh_repo, github_auth, copy.deepcopy(self.__settings), mapping, dry_run=True)
+                    import_issues_to_github(bb_repo, gh_repo, github_auth, copy.deepcopy(self.__settings), mapping, dry_run=True, abort_event=ABORT_EVENT)
                 print('done! (you can see the results in the "temp/<owner>/<repo>" folder in the project directory)')
 
                 do_import = q.confirm('Do you want to proceed with the import of issues to GitHub (this can only be attempted once)?', default=False).ask()
@@ -1267,12 +1421,16 @@ class MigrationProject(object):
                         bb_repo = repository['full_name']
                         gh_repo = self.__settings['github_existing_repositories'][bb_repo]['repository']['full_name']
                         print('Importing issues from BitBucket/{} to GitHub/{}'.format(bb_repo, gh_repo))
-                        import_issues_to_github(bb_repo, gh_repo, github_auth, copy.deepcopy(self.__settings), mapping, dry_run=False)
+                        import_issues_to_github(bb_repo, gh_repo, github_auth, copy.deepcopy(self.__settings), mapping, dry_run=False, abort_event=ABORT_EVENT)
                     print('done!')
 
                     self.__settings['github_issue_import_complete'] = True
                     self.__save_project_settings()
 
+            print(sessions.format_statistics(sessions.statistics()))
+            telemetry.stop()
+            print('Statistics of the API requests made have been saved to {}'.format(telemetry_path))
+
 
             
 
@@ -1283,8 +1441,113 @@ class MigrationProject(object):
         else:
             raise RuntimeError('Unknown option selected')
 
+    def __find_forks(self, repository, auth, repositories, all_repo_names):
+        # Recursively adds the forks of repository (that are not already in all_repo_names) to repositories
+        if 'links' not in repository or 'forks' not in repository['links'] or 'href' not in repository['links']['forks']:
+            return
+        status, json_response = bbapi_json(repository['links']['forks']['href'], auth, {'pagelen':100})
+        more = True
+        while more:
+            if status == 200 and json_response is not None:
+                # process repositories (don't add duplicates)
+                for r in json_response['values']:
+                    if r['full_name'] not in all_repo_names:
+                        r['is_fork'] = True
+                        repositories.append(r)
+                        all_repo_names.append(r['full_name'])
+                        print('Finding all forks of {}'.format(r['full_name']))
+                        self.__find_forks(r, auth, repositories, all_repo_names)
+                if 'next' in json_response:
+                    status, json_response = bbapi_json(json_response['next'], auth, {'pagelen':100})
+                else:
+                    more = False
+            elif status == 404:
+                # some forks might have been deleted, but they are still reported by Bitbucket API
+                # report the error and keep enumerating forks (of the remaining repos)
+                print('Warning: repository {} might have been deleted (404).'.format(repository['full_name']))
+                more = False
+            else:
+                print('Failed to query BitBucket API when determining forks for {}.'.format(repository['full_name']))
+                sys.exit(1)
+
+    def __configure_http(self):
+        # make sure there are enough connections in the pool for all concurrent requests
+        pool_maxsize = self.__settings['http_pool_maxsize']
+        if self.__settings['bitbucket_crawl_backend'] == 'asyncio':
+            pool_maxsize = max(pool_maxsize, self.__settings['bitbucket_crawl_concurrency'])
+        pool_maxsize = max(pool_maxsize, self.__settings['bitbucket_asset_download_threads'])
+        sessions.configure(pool_connections=self.__settings['http_pool_connections'], pool_maxsize=pool_maxsize)
+        if self.__replaying:
+            # no requests reach the APIs, so there is no quota to stay under
+            ratelimit.configure('bitbucket', None)
+            ratelimit.configure('github', None)
+            ratelimit.configure('downloads', None)
+        else:
+            ratelimit.configure('bitbucket', self.__settings['bitbucket_requests_per_hour'])
+            ratelimit.configure('github', self.__settings['github_requests_per_hour'])
+
+    def __estimate_export(self):
+        # Estimates the API requests, time and disk space needed to export the repositories (see
+        # planner.py) so that the number of BitBucket accounts to use can be decided up front
+        self.__configure_http()
+        users = [self.__settings['master_bitbucket_username']] + self.__settings['bitbucket_additional_users']
+        auth_list = [(user, self.__get_password('bitbucket', user)) for user in users]
+        # check each account works (this also picks up the rate limit of each account, if BitBucket reports it)
+        for credentials in auth_list:
+            status, _ = bbapi_json('user', credentials)
+            if status != 200:
+                print('WARNING: Could not access the BitBucket API as {} (response code {}). Please check the credentials.'.format(credentials[0], status))
+
+        repositories = list(self.__settings['bb_repositories_to_export'])
+        if not self.__settings['backup_forks']:
+            repositories = [repository for repository in repositories if 'is_fork' not in repository or not repository['is_fork']]
+        elif not self.__settings['fork_search_complete']:
+            all_repo_names = [repository['full_name'] for repository in repositories]
+            for repository in repositories:
+                print('Finding all forks of {}'.format(repository['full_name']))
+                self.__find_forks(repository, auth_list[0], repositories, all_repo_names)
+
+        def post_message(cmd, message):
+            if cmd == 'update':
+                print(pad_message(message[0]), end=message[1])
+
+        settings = copy.deepcopy(self.__settings)
+        settings['bb_repositories_to_export'] = repositories
+        exporter = BitBucketExport(self.__settings['bitbucket_repo_owner'], auth_list[0], settings, post_message, additional_credentials=auth_list[1:])
+        estimates, latency, requests_made = exporter.estimate_api()
+        if ABORT_EVENT.is_set():
+            return
+
+        requests_needed = sum(estimate.cost.requests for estimate in estimates)
+        print('')
+        print('Estimated cost of the export (the estimate itself made {} API requests):'.format(requests_made))
+        for estimate in estimates:
+            lists = ', '.join('{}{} {}'.format('about ' if name in estimate.extrapolated else '', size, name) for name, size in sorted(estimate.list_sizes.items()))
+            print('    {}: {}{:.0f} API requests, {} of API data ({})'.format(estimate.full_name, 'at least ' if estimate.lower_bound else '', estimate.cost.requests, planner.format_bytes(estimate.cost.bytes), lists))
+        print('    Total: {}{:.0f} API requests'.format('at least ' if any(estimate.lower_bound for estimate in estimates) else '', requests_needed))
+        if any(estimate.extrapolated or estimate.lower_bound for estimate in estimates):
+            print('    (lists without a size, such as commits, are only counted for their first {} pages, then estimated from the dates of the items counted where possible)'.format(planner.COUNT_PAGES + 1))
+        print('Disk space: {} (the API data is saved twice, as downloaded and with the URLs rewritten in gh-pages/data) plus {} of Mercurial repositories (and again for their conversion to git)'.format(
+            planner.format_bytes(2*sum(estimate.cost.bytes for estimate in estimates)), planner.format_bytes(sum(estimate.repository_size for estimate in estimates))))
+        print('    (files attached to issues, images and avatars are not included)')
+
+        # time taken by each number of accounts (any accounts beyond those added are assumed to have
+        # the lowest limit of those added)
+        rates = [ratelimit.get_bucket('bitbucket', credentials).rate for credentials in auth_list]
+        concurrency = self.__settings['bitbucket_crawl_concurrency'] if self.__settings['bitbucket_crawl_backend'] == 'asyncio' else 1
+        print('Time ({:.2f} seconds per request, {} request(s) at a time per account):'.format(latency, concurrency))
+        for credentials, rate in zip(auth_list, rates):
+            print('    {}: limited to {:.0f} requests per hour'.format(credentials[0], rate))
+        for accounts in range(1, len(auth_list) + 4):
+            account_rates = rates[:accounts] + [min(rates)]*(accounts - len(rates))
+            hours = planner.hours_needed(requests_needed, account_rates, latency, concurrency)
+            print('    {} account(s): {}{}'.format(accounts, planner.format_hours(hours), ' (the accounts added to this project)' if accounts == len(auth_list) else ''))
+        print('Data already downloaded by a previous run is not taken into account.')
+        print('')
+
     def create_or_get_github_repository(self, owner, github_slug, bb_repository_details, github_auth=None):
         repository = bb_repository_details
+        github = GitHubClient(github_auth, abort_event=ABORT_EVENT)
 
         # query if the repository already exists
         status, response = ghapi_json('repos/{owner}/{repo}'.format(owner=owner, repo=github_slug), github_auth)
@@ -1309,15 +1572,13 @@ class MigrationProject(object):
                 repo_data['homepage'] = repository['website']
             print('Creating repository {}/{}'.format(owner, github_slug))
             if is_org:
-                response = requests.post(
+                response = github.post(
                     'https://api.github.com/orgs/{owner}/repos'.format(owner=owner),  
-                    auth=github_auth, 
                     json=repo_data
                 )
             else:
-                response = requests.post(
+                response = github.post(
                     'https://api.github.com/user/repos',  
-                    auth=github_auth, 
                     json=repo_data
                 )
             if response.status_code != 201:
@@ -1524,6 +1785,27 @@ class MigrationProject(object):
 
         self.__settings['backup_forks'] = q.confirm('Do you wish to recursively backup all repository forks?', default=self.__settings['backup_forks']).ask()
 
+        choices = {profiles.DESCRIPTIONS[profile]:profile for profile in profiles.PROFILES}
+        self.__settings['bitbucket_crawl_profile'] = choices[q.select("Which BitBucket API data should be downloaded? (skipping data you don't need greatly reduces the number of API requests for repositories with many commits)", choices=list(choices), default=profiles.DESCRIPTIONS[self.__settings['bitbucket_crawl_profile']]).ask()]
+
+        self.__settings['bitbucket_synthesise_items'] = q.confirm('Save issues, pull requests and commits from the lists of them, rather than requesting each one separately? (greatly reduces the number of API requests for large repositories)', default=self.__settings['bitbucket_synthesise_items']).ask()
+
+        choices = {
+            "One request at a time for each BitBucket account":'threaded', 
+            "Several concurrent requests for each BitBucket account (faster for large repositories)":'asyncio',
+        }
+        self.__settings['bitbucket_crawl_backend'] = choices[q.select("How should the BitBucket API data be downloaded?", choices=list(choices), default={v: k for k, v in choices.items()}[self.__settings['bitbucket_crawl_backend']]).ask()]
+        if self.__settings['bitbucket_crawl_backend'] == 'asyncio':
+            while True:
+                response = q.text('How many concurrent requests should be made for each BitBucket account?', default=str(self.__settings['bitbucket_crawl_concurrency'])).ask()
+                try:
+                    self.__settings['bitbucket_crawl_concurrency'] = int(response)
+                    if self.__settings['bitbucket_crawl_concurrency'] < 1:
+                        raise ValueError('')
+                    break
+                except ValueError:
+                    print('ERROR: Please enter a positive integer')
+
     def __get_github_import_options(self):
         choices = {
             "I need to create new repositories on GitHub for all previously selected BitBucket repositories":0, 
@@ -1699,6 +1981,13 @@ class MigrationProject(object):
         # print('    Backup BitBucket commit comments: {}'.format(str(self.__settings['backup_commit_comments'])))
         # print('        Generate HTML pages: {}'.format(str(self.__settings['generate_static_commit_comments_pages'])))
         print('    Backup forks: {}'.format(str(self.__settings['backup_forks'])))
+        print('    BitBucket API data to download: {}'.format(profiles.DESCRIPTIONS[self.__settings['bitbucket_crawl_profile']]))
+        print('    Save issues, pull requests and commits from the lists of them: {}'.format(str(self.__settings['bitbucket_synthesise_items'])))
+        print('    BitBucket API download method: {}'.format('{} concurrent requests per account'.format(self.__settings['bitbucket_crawl_concurrency']) if self.__settings['bitbucket_crawl_backend'] == 'asyncio' else 'one request at a time per account'))
+        print('    Files referenced in BitBucket API data are downloaded by {} threads'.format(self.__settings['bitbucket_asset_download_threads']))
+        print('    HTTP connection pool: {} hosts, {} connections per host'.format(self.__settings['http_pool_connections'], self.__settings['http_pool_maxsize']))
+        print('    API request statistics are saved to telemetry.json every {} seconds'.format(self.__settings['telemetry_interval']))
+        print('    API requests per hour (per account): BitBucket {}, GitHub {}'.format(self.__settings['bitbucket_requests_per_hour'], self.__settings['github_requests_per_hour']))
         
         print('    Import to GitHub: {}'.format(str(self.__settings['import_to_github'])))
         if self.__settings['import_to_github']:
@@ -1801,25 +2090,50 @@ class MigrationProject(object):
         return password
         
 
-prog = re.compile(r'\"{}(.*?)\"'.format(bitbucket_api_url), re.MULTILINE)
+# number of times a file download is attempted (resuming from where it stopped each time)
+ASSET_DOWNLOAD_ATTEMPTS = 5
 
 
 
 class BitBucketExport(object):
     #
-    # This code is terrible and is not going to do what I want.
-    # We can't parallelise the download of JSON data if we want to be able to 
-    # resume it without processing every saved JSON file
+    # The state of the crawl of each repository (the tree of URLs and the queue of URLs 
+    # still to be processed) is saved as it progresses (see frontier.py) so that it can 
+    # be resumed without processing every saved JSON file
     #
-    def __init__(self, owner, credentials, options, post_message, subset=None):
+    def __init__(self, owner, credentials, options, post_message, subset=None, additional_credentials=None):
         self.__owner = owner
-        self.__credentials = credentials
+        # API requests for every repository are shared between all of the accounts (rather 
+        # than each account exporting different repositories)
+        self.__credential_pool = ratelimit.CredentialPool('bitbucket', [credentials] + list(additional_credentials or []))
+        # The next page of a paginated list is requested by the same account as the previous 
+        # page (the URL may contain a context that is only valid for that account). Maps 
+        # frontier id to credentials (the username is also saved in the frontier, so that the
+        # pin survives the crawl being resumed).
+        self.__pinned_credentials = {}
         self.__options = options
-        self.__dummy_response_cache = {}
+        # (owner, repository) of every repository in the export, whose links are rewritten to
+        # the archive (see fix_stupid_bitbucket_urls)
+        self.__repository_list = [tuple(repository['full_name'].split('/')) for repository in options['bb_repositories_to_export']]
+        self.__in_progress = set()
+        self.__assets_in_progress = set()
+        self.__asset_executor = None
+        self.__asset_downloads = []
+        self.__frontier = None
         self.__post_message = post_message
+        # Revalidate previously downloaded JSON files using conditional requests
+        self.__refresh = options['bitbucket_api_refresh']
+        # The files in gh-pages/data written so far by rebuild_pages_data (None otherwise)
+        self.__rebuilt_paths = None
 
         self.__save_path = os.path.join(options['project_path'], 'bitbucket_data_raw')
         self.__save_path_relative = os.path.join(options['project_path'], 'gh-pages', 'data')
+        # the files that have been saved, and which of them have been processed on this run
+        # (so that the crawl does not need to ask the filesystem about every URL it finds)
+        self.__visited = visited.VisitedSet(self.__save_path)
+        # downloaded files (images, avatars, attachments) are stored once per distinct content
+        # and linked from the paths above
+        self.__blob_store = blobstore.BlobStore(os.path.join(options['project_path'], 'bitbucket_data_blobs'))
 
         self.__external_URL_rewrites = {}
         if options['github_rewrite_additional_URLs']:
@@ -1831,7 +2145,7 @@ class BitBucketExport(object):
         else:
             self.__repos_to_export = self.__options['bb_repositories_to_export']
 
-        self.__tree = []
+        self.__tree = crawltree.CrawlTree()
         self.__current_tree_location = ()
 
         self.tree_new_level()
@@ -1846,8 +2160,9 @@ class BitBucketExport(object):
 
 
     def backup_api(self):
-        self.__repository_list = [tuple(repository['full_name'].split('/')) for repository in self.__options['bb_repositories_to_export']]
         mapping = [repo['full_name'] for repo in self.__options['bb_repositories_to_export']]
+        # find the files downloaded by previous runs (once, rather than for each URL)
+        self.__visited.scan()
         # print(len(self.__repos_to_export))
         for repository in self.__repos_to_export:
             # this is a bit of a hack but whatever!
@@ -1856,43 +2171,139 @@ class BitBucketExport(object):
             self.__files_downloaded = 0
             self.__duplicates_skipped = 0
             self.__already_downloaded = 0
+            self.__unchanged = 0
+            self.__items_synthesised = 0
             self.__time_of_last_update = time.time()-1
             self.__print_update()
             self.__backup_api()
             if ABORT_EVENT.is_set():
                 return
             self.__print_update(end="\n", force=True)
-            # clear the dummy response cache as we don't need it one we finish with a repository
-            self.__dummy_response_cache = {}
-
-            self.url_queue = queue.Queue()
-            self.url_queue.put({'mapping':mapping})
-            rewrite_count = 0
-            # rewrite URLs in all files
-            while not self.url_queue.empty() and not ABORT_EVENT.is_set():
-                data = self.url_queue.get()
-                self.make_urls_relative(**data)
-                rewrite_count += 1
-                self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\r"))
-            # self.make_urls_relative(mapping=mapping)
+            self.__report_profile_savings()
+            # files saved for this repository may be referenced again by the next, but are
+            # not duplicates of anything in it
+            self.__visited.clear_visited()
+
+            self.__rewrite_urls(mapping)
             if ABORT_EVENT.is_set():
                 return
-            self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\n"))
-            self.__post_message('complete', repository['full_name'])
+            if self.__assets_failed:
+                # (not complete, so the crawl is resumed to retry them when the export is run again)
+                self.__post_message('update', ('{}: WARNING: {} files could not be downloaded'.format(self.__repo_full_name, self.__assets_failed), "\n"))
+            else:
+                self.__post_message('complete', repository['full_name'])
             # reset the tree
-            self.__tree = []
+            self.__tree = crawltree.CrawlTree()
             self.__current_tree_location = ()
             self.tree_new_level()
 
-    def __backup_api(self):    
-        self.file_download_regexes = [
-            re.compile(r'\"(https://bitbucket\.org/repo/(?:[a-zA-Z0-9]+)/images/(?:.+?))\\\"', re.MULTILINE), # images in HTML
-            re.compile(r'\"(https://pf-emoji-service--cdn\.(?:[a-zA-Z0-9\-]+)\.prod\.public\.atl-paas\.net/(?:.+?))\\\"', re.MULTILINE), # emojis
-            re.compile(r'\"(https://secure.gravatar.com/avatar/(?:.+?))\"', re.MULTILINE), # avatars
-            re.compile(r'\"(https://bytebucket\.org/(?:.+?))\"', re.MULTILINE), # other things (like language avatars)
-            # re.compile(r'\"(https://bytebucket\.org/(?:.+?))\"', re.MULTILINE), # TODO: downloads
-            re.compile(r'\"(https://api\.bitbucket\.org/2\.0/repositories/{owner}/{repo}/issues/(?:\d+)/attachments/(?:.+?))\"'.format(owner=self.__owner, repo=self.__repository), re.MULTILINE), # attachments
-        ]
+    def estimate_api(self):
+        # Estimates the cost of the crawl of each repository without downloading it (see planner.py).
+        # Returns the list of planner.RepositoryEstimate objects, the average time taken by a request
+        # and the number of requests made
+        estimates = []
+        request_times = []
+        for repository in self.__repos_to_export:
+            self.__owner, self.__repository = repository['full_name'].split('/')
+            self.__repo_full_name = repository['full_name']
+            self.__post_message('update', ('{}: Estimating the size of the BitBucket API data'.format(self.__repo_full_name), "\n"))
+            ignore_matcher, rewrite_rules = self.__prepare_crawl()
+
+            def fetch(endpoint, params=None):
+                # request the URL the crawl would request for endpoint
+                rewritten_base_url = self.__locate_json(bb_endpoint_to_full_url(endpoint), rewrite_rules)[1]
+                credentials = self.__credential_pool.acquire()
+                try:
+                    start = time.perf_counter()
+                    response = bb_query_api(rewritten_base_url, auth=credentials, params=params)
+                    request_times.append(time.perf_counter() - start)
+                finally:
+                    self.__credential_pool.release(credentials)
+                if response.status_code != 200:
+                    return None, 0
+                try:
+                    return response.json(), len(response.content)
+                except ValueError:
+                    return None, len(response.content)
+
+            def follows(endpoint):
+                # (the same checks as __process_json)
+                if ignore_matcher.matches(endpoint) or self.__profile_matcher.matches(endpoint):
+                    return False
+                return endpoint.startswith(self.__repo_prefixes[1]) or endpoint == self.__repo_prefixes[0]
+
+            synthesised = None
+            if self.__item_lists is not None:
+                synthesised = lambda endpoint, value: bool(self.__item_lists.items(endpoint, {'values': [value]}))
+
+            repository_planner = planner.RepositoryPlanner(bitbucket_api_url, self.__owner, self.__repository, self.__url_scanner, fetch, follows, synthesised)
+            estimates.append(repository_planner.plan())
+            if ABORT_EVENT.is_set():
+                break
+        latency = sum(request_times)/len(request_times) if request_times else 0
+        return estimates, latency, len(request_times)
+
+    def rebuild_pages_data(self):
+        # Regenerates gh-pages/data for each repository from the saved API data and the tree
+        # of URLs saved by the crawl (rather than crawling the data again)
+        mapping = [repo['full_name'] for repo in self.__options['bb_repositories_to_export']]
+        self.__rebuilt_paths = set()
+        try:
+            for repository in self.__repos_to_export:
+                self.__owner, self.__repository = repository['full_name'].split('/')
+                self.__repo_full_name = repository['full_name']
+                path = self.__crawl_state_path()
+                if not os.path.exists(path):
+                    self.__post_message('update', ('{}: No saved crawl of the BitBucket API data was found, skipping'.format(self.__repo_full_name), "\n"))
+                    continue
+                crawl_state = frontier.CrawlFrontier(path)
+                try:
+                    if not crawl_state.complete:
+                        self.__post_message('update', ('{}: WARNING: The download of the BitBucket API data did not finish. Only the data downloaded so far will be rebuilt'.format(self.__repo_full_name), "\n"))
+                    self.__tree = crawltree.CrawlTree()
+                    crawl_state.load(self.__tree)
+                finally:
+                    crawl_state.close()
+                self.__rewrite_urls(mapping)
+                if ABORT_EVENT.is_set():
+                    return
+                self.__tree = crawltree.CrawlTree()
+        finally:
+            self.__rebuilt_paths = None
+
+    def __rewrite_urls(self, mapping):
+        self.url_queue = queue.Queue()
+        self.url_queue.put({'mapping':mapping})
+        rewrite_count = 0
+        # rewrite URLs in all files
+        while not self.url_queue.empty() and not ABORT_EVENT.is_set():
+            data = self.url_queue.get()
+            self.make_urls_relative(**data)
+            rewrite_count += 1
+            self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\r"))
+        # self.make_urls_relative(mapping=mapping)
+        if ABORT_EVENT.is_set():
+            return
+        self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {count} files rewritten'.format(repo=self.__repo_full_name, count=rewrite_count), "\n"))
+
+    def __report_profile_savings(self):
+        # (the counts are saved in the crawl state, so cover the whole crawl even if it was resumed)
+        skipped, (requests_made, savings) = self.__profile_counts
+        if skipped:
+            self.__post_message('update', ('{}: Skipped {} API endpoints (and the data they link to) excluded by the "{}" crawl profile'.format(self.__repo_full_name, skipped, self.__options['bitbucket_crawl_profile']), "\n"))
+        if requests_made:
+            for name in self.__profile_savings:
+                self.__post_message('update', ('{}: The "{}" crawl profile would skip {} of the {} API endpoints processed'.format(self.__repo_full_name, name, savings.get(name, 0), requests_made), "\n"))
+
+    def __crawl_state_path(self):
+        return os.path.join(self.__options['project_path'], 'bitbucket_crawl_state', self.__owner, self.__repository + '.sqlite3')
+
+    def __prepare_crawl(self):
+        # Sets up the rules for the crawl of the current repository. Returns the ignore matcher
+        # and rewrite rules
+
+        # finds the files and API endpoints referenced in each page
+        self.__url_scanner = discover.UrlScanner(bitbucket_api_url, self.__owner, self.__repository)
 
         # TODO: probably want to save some of these...the question is how far do we go down the tree.
         #       for example, users link to other repos which then result in you saving data for every 
@@ -2070,15 +2481,163 @@ class BitBucketExport(object):
             },
         ]
 
+        # compile the rules once, rather than interpreting them for every URL found
+        ignore_matcher = rules.IgnoreMatcher(ignore_rules + pr_ignores)
+        # The endpoints skipped by the crawl profile are checked separately so that we can 
+        # report how many were skipped (and how many requests the narrower profiles would save)
+        profile = self.__options['bitbucket_crawl_profile']
+        self.__profile_matcher = rules.IgnoreMatcher(profiles.ignore_rules(profile, self.__owner, self.__repository))
+        self.__profile_savings = OrderedDict(
+            (name, rules.IgnoreMatcher(profiles.ignore_rules(name, self.__owner, self.__repository)))
+            for name in profiles.PROFILES if set(profiles.PROFILES[name]) > set(profiles.PROFILES[profile])
+        )
+        # Ask for any fields missing from the lists of issues, pull requests and commits so that
+        # each item can be saved from the list (see __synthesise_items)
+        self.__item_lists = None
+        self.__synthesised = set()
+        if self.__options['bitbucket_synthesise_items']:
+            self.__item_lists = discover.ItemLists(bitbucket_api_url, self.__owner, self.__repository)
+            rewrite_rules += self.__item_lists.rewrite_rules()
+        rewrite_rules = rules.RewriteRules(rewrite_rules)
+        repo_str = 'repositories/{}/{}'.format(self.__owner, self.__repository)
+        self.__repo_prefixes = (repo_str, repo_str + '/')
+        self.__issue_regex = re.compile(r'repositories/{}/{}/issues/(\d+)$'.format(re.escape(self.__owner), re.escape(self.__repository)))
+        return ignore_matcher, rewrite_rules
+
+    def __backup_api(self):
+        ignore_matcher, rewrite_rules = self.__prepare_crawl()
+
         self.url_queue = queue.Queue()
-        self.url_queue.put(('https://api.bitbucket.org/2.0/repositories/{owner}/{repo}'.format(owner=self.__owner, repo=self.__repository), self.__tree))
 
-        # Backup everything
-        while not self.url_queue.empty() and not ABORT_EVENT.is_set():
-            url, tree = self.url_queue.get()
-            self.get_and_save_json(url, ignore_rules + pr_ignores, rewrite_rules, tree)
+        # Files referenced in the API data are downloaded by a separate pool of threads
+        # (they don't count towards the API limit, so there is no need for the API requests to wait for them)
+        self.__asset_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(int(self.__options['bitbucket_asset_download_threads']), 1))
+        self.__asset_downloads = []
+        # files that could not be downloaded on this run (so are not tried again for each reference)
+        self.__assets_failed_paths = set()
+        self.__frontier = frontier.CrawlFrontier(self.__crawl_state_path())
+        try:
+            # (a refresh always crawls again, unless we are resuming an unfinished refresh)
+            if self.__frontier.started and not (self.__refresh and (not self.__frontier.refresh or self.__frontier.complete)):
+                # pick up where the previous run stopped
+                self.__resume_crawl()
+            else:
+                root_url = 'https://api.bitbucket.org/2.0/repositories/{owner}/{repo}'.format(owner=self.__owner, repo=self.__repository)
+                frontier_id = self.__frontier.start(root_url, refresh=self.__refresh)
+                self.url_queue.put((root_url, None, frontier_id))
+
+            # Backup everything
+            if self.__options['bitbucket_crawl_backend'] == 'asyncio':
+                asyncio.run(self.__backup_api_asyncio(ignore_matcher, rewrite_rules, max(int(self.__options['bitbucket_crawl_concurrency']), 1)))
+            elif len(self.__credential_pool) > 1:
+                # one request at a time per account
+                asyncio.run(self.__backup_api_asyncio(ignore_matcher, rewrite_rules, 1))
+            else:
+                while not self.url_queue.empty() and not ABORT_EVENT.is_set():
+                    url, parent, frontier_id = self.url_queue.get()
+                    self.get_and_save_json(url, ignore_matcher, rewrite_rules, parent, frontier_id)
+            # The files must all be downloaded before make_urls_relative is run
+            self.__assets_failed = self.__wait_for_asset_downloads()
+            if self.url_queue.empty() and not ABORT_EVENT.is_set() and not self.__assets_failed:
+                self.__frontier.mark_complete()
+        finally:
+            for _, future in self.__asset_downloads:
+                future.cancel()
+            self.__asset_executor.shutdown(wait=True)
+            self.__asset_executor = None
+            # (duplicate URLs are removed from the frontier without a commit of their own)
+            self.__frontier.commit()
+            self.__profile_counts = (self.__frontier.profile_skipped(), self.__frontier.processed())
+            self.__frontier.close()
+            self.__frontier = None
         self.tree_increment_level()
 
+    def __resume_crawl(self):
+        # Rebuild the tree and queue from the saved crawl state rather than starting again
+        # from the top of the tree
+        self.__tree = crawltree.CrawlTree()
+        nodes, pending = self.__frontier.load(self.__tree)
+        for node in nodes.values():
+            if node.already_processed:
+                continue
+            if node.endpoint_path.endswith('.json') or self.__visited.exists(node.endpoint_path):
+                # record that this file has been processed on this run, so later references to 
+                # it are counted as duplicates
+                self.__visited.visit(node.endpoint_path)
+            else:
+                # the download of this file had not finished
+                self.__download_in_background(node.url, node.endpoint_path)
+        for url, parent, frontier_id, account in pending:
+            if account is not None:
+                credentials = self.__credential_pool.find(account)
+                # (the account may no longer be one of those used for the export)
+                if credentials is not None:
+                    self.__pinned_credentials[frontier_id] = credentials
+            self.url_queue.put((url, parent, frontier_id))
+        if not self.__frontier.complete:
+            self.__post_message('update', ('{}: Resuming download of API data ({} URLs remaining)'.format(self.__repo_full_name, len(pending)), "\n"))
+
+    def __wait_for_asset_downloads(self):
+        # Returns the number of files that could not be downloaded (they are left in the crawl
+        # state, so are downloaded again when the crawl is resumed)
+        failed = 0
+        for url, future in self.__asset_downloads:
+            try:
+                future.result()
+            except BaseException as e:
+                if ABORT_EVENT.is_set():
+                    break
+                failed += 1
+                self.__post_message('update', ('{}: Failed to download file {} ({})'.format(self.__repo_full_name, url, e), "\n"))
+        return failed
+
+    async def __backup_api_asyncio(self, ignore_matcher, rewrite_rules, concurrency):
+        # Keeps up to concurrency requests in flight for each set of credentials.
+        # Only the HTTP requests run in the thread pool. Everything that touches the tree, the 
+        # queue or the counters runs in the event loop (so there is only ever one thread 
+        # modifying them)
+        concurrency *= len(self.__credential_pool)
+        loop = asyncio.get_running_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+        def fetch(url, request_headers, credentials):
+            credentials = self.__credential_pool.acquire(credentials)
+            try:
+                return bb_query_api(url, credentials, headers=request_headers), credentials
+            finally:
+                self.__credential_pool.release(credentials)
+
+        async def fetch_and_process(job):
+            job['response'], job['credentials'] = await loop.run_in_executor(executor, fetch, job['rewritten_base_url'], job['request_headers'], job['credentials'])
+            self.__files_downloaded += 1
+            self.__print_update()
+            self.__process_json(job, ignore_matcher, rewrite_rules)
+
+        pending = set()
+        try:
+            while (pending or not self.url_queue.empty()) and not ABORT_EVENT.is_set():
+                # start new requests until we reach the concurrency limit
+                while len(pending) < concurrency and not self.url_queue.empty():
+                    url, parent, frontier_id = self.url_queue.get()
+                    job = self.__claim_json(url, rewrite_rules, parent, frontier_id)
+                    if job is None:
+                        continue
+                    if job['response'] is not None:
+                        # already on disk, so no need to query the API
+                        self.__process_json(job, ignore_matcher, rewrite_rules)
+                    else:
+                        pending.add(asyncio.ensure_future(fetch_and_process(job)))
+                if not pending:
+                    continue
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    # raise any exceptions
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            executor.shutdown(wait=False)
+
     @property
     def current_tree_location(self):
         return self.__current_tree_location
@@ -2096,48 +2655,24 @@ class BitBucketExport(object):
     def tree_increment_level(self):
         self.current_tree_location = (*self.current_tree_location[:-1], self.current_tree_location[-1]+1)
 
-    def rewrite_url(self, endpoint, params, rules):
-        params = copy.deepcopy(params)
-        for rule in rules:
-            endpoint_matches = False
-            for endpoint_match in rule['endpoint_match']:
-                if (isinstance(endpoint_match, str) and endpoint == endpoint_match) or (isinstance(endpoint_match, re.Pattern) and endpoint_match.findall(endpoint)):
-                    endpoint_matches = True
-                    break
-            if endpoint_matches:
-                for rewrite in rule['rewrites']:
-                    do_rewrite = True
-                    for match_param_name, match_param_value in rewrite['params_match'].items():
-                        if match_param_value == '*':
-                            continue
-                        elif match_param_value is None:
-                            if match_param_name in params and params[match_param_name] != match_param_value:
-                                do_rewrite = False
-                                break
-                        else:
-                            if match_param_name not in params or params[match_param_name] != match_param_value:
-                                do_rewrite = False
-                                break
-
-                    if do_rewrite:
-                        for rewrite_param_name, rewrite_param_value in rewrite['params_to_update'].items():
-                            if rewrite_param_value is None and rewrite_param_name in params:
-                                del params[rewrite_param_name]
-                            else:
-                                if isinstance(rewrite_param_value, (list, dict)):
-                                    rewrite_param_value = copy.deepcopy(rewrite_param_value)
-                                params[rewrite_param_name] = rewrite_param_value
-
-        return endpoint, params
+    def rewrite_url(self, endpoint, params, rewrite_rules):
+        # rewrite_rules is a rules.RewriteRules object (or a list of rules to compile)
+        if not isinstance(rewrite_rules, rules.RewriteRules):
+            rewrite_rules = rules.RewriteRules(rewrite_rules)
+        return rewrite_rules.rewrite(endpoint, params)
 
     def __print_update(self, end="\r", force=False):
         if time.time()-self.__time_of_last_update > 0.25 or force:
-            message = '{}/{}: Downloaded {} files ({} already downloaded, skipped {} duplicate URLs)'.format(self.__owner, self.__repository, self.__files_downloaded, self.__already_downloaded, self.__duplicates_skipped)
+            synthesised = ', {} saved from list pages'.format(self.__items_synthesised) if self.__items_synthesised else ''
+            if self.__refresh:
+                message = '{}/{}: Downloaded {} files ({} unchanged since last download{}, skipped {} duplicate URLs)'.format(self.__owner, self.__repository, self.__files_downloaded, self.__unchanged, synthesised, self.__duplicates_skipped)
+            else:
+                message = '{}/{}: Downloaded {} files ({} already downloaded{}, skipped {} duplicate URLs)'.format(self.__owner, self.__repository, self.__files_downloaded, self.__already_downloaded, synthesised, self.__duplicates_skipped)
             self.__post_message('update', (message, end, force))
             # print(message, end=end)
             self.__time_of_last_update = time.time()
 
-    def download_file(self, base_url, tree):
+    def download_file(self, base_url, parent):
         # convert url to save path
         # remove '/' before the decode as the ones that exist prior to the decode as real characters
         #  (aka the '/' in the address, not query params) shouldn't be removed
@@ -2153,40 +2688,236 @@ class BitBucketExport(object):
         # tree = self.__tree
         # for i in self.current_tree_location[:-1]:
         #     tree = tree[i]['children']
-        tree.append({'url': base_url, 'rewritten_url': base_url, 'endpoint_path':save_path, 'already_processed': False, 'children': []})
+        node = self.__tree.add(parent, base_url, base_url, save_path)
 
+        # The file is currently being downloaded (or failed to download earlier in this run)
+        if save_path in self.__assets_in_progress or save_path in self.__assets_failed_paths:
+            self.__duplicates_skipped += 1
+            node.already_processed = True
+            self.__frontier.add_node(parent.id, node)
+            self.__print_update()
+            return
 
         # don't download if it is already downloaded
-        if os.path.exists(save_path):
-            response = DummyResponse(save_path, self.__dummy_response_cache)
-            if response.already_processed:
+        if self.__visited.exists(save_path):
+            if self.__visited.visit(save_path):
                 self.__duplicates_skipped += 1
             else:
                 self.__already_downloaded += 1
             # mark as already processed
-            tree[-1]['already_processed'] = True
+            node.already_processed = True
+            self.__frontier.add_node(parent.id, node)
             # self.__already_downloaded += 1
             self.__print_update()
             return
 
-        # create the dir structure
-        head, _ = os.path.split(save_path)
-        try:
-            os.makedirs(head)
-        except FileExistsError:
-            pass
-
-        r = requests.get(base_url, stream=True)
-        with open(save_path, 'wb') as fd:
-            for chunk in r.iter_content(1024**2): # 1Mb chunk size
-                fd.write(chunk)
+        # (if the crawl is stopped before this download finishes, it is restarted when the crawl is resumed)
+        self.__frontier.add_node(parent.id, node)
+        self.__download_in_background(base_url, save_path)
 
-        DummyResponse(save_path, self.__dummy_response_cache)
+    def __download_in_background(self, base_url, save_path):
+        # create the dir structure
+        self.__visited.makedirs(os.path.dirname(save_path))
 
+        self.__assets_in_progress.add(save_path)
+        future = self.__asset_executor.submit(self.__download_asset, base_url, save_path)
+        self.__asset_downloads.append((base_url, future))
         self.__files_downloaded += 1
         self.__print_update()
 
-    def get_and_save_json(self, base_url, ignore_rules, rewrite_rules, tree):
+    def __download_asset(self, base_url, save_path):
+        # Runs in the asset download thread pool
+        try:
+            if self.__download_file_resumable(base_url, save_path):
+                self.__visited.add(save_path)
+            self.__visited.visit(save_path)
+        except BaseException:
+            self.__assets_failed_paths.add(save_path)
+            raise
+        finally:
+            # (must happen after the file is marked as visited so that later references 
+            # to this file are counted as duplicates)
+            self.__assets_in_progress.discard(save_path)
+
+    def __download_file_resumable(self, base_url, save_path):
+        # Downloads to a ".part" file which is only moved to save_path once complete and
+        # verified, so a partially downloaded file is never mistaken for a complete one.
+        # If the download fails part way through (in this run or a previous one), it is 
+        # resumed from where it stopped using a HTTP Range request. Returns False (having
+        # posted a warning) if the server refused to send the file, e.g. it has been deleted.
+        part_path = save_path + '.part'
+        part_meta_path = part_path + '.meta'
+        # each host gets its own session (and hence connection pool)
+        service = 'downloads/{}'.format(parse.urlsplit(base_url).netloc)
+
+        # validators for the partially downloaded file, so we can check it hasn't changed since
+        validators = {}
+        if os.path.exists(part_path):
+            try:
+                with open(part_meta_path, 'r') as f:
+                    validators = json.load(f)
+            except (FileNotFoundError, ValueError):
+                # we can't tell if the remote file has changed, so start again
+                os.remove(part_path)
+
+        attempt = 0
+        retry_backoff = backoff.Backoff(base=5, cap=60, abort_event=ABORT_EVENT)
+        # (held back by every thread downloading from this host after a 429 response)
+        bucket = ratelimit.get_bucket(service)
+        # The outcome of the download is recorded in telemetry.py whether or not it succeeds: the
+        # number of requests made, and the status code (or the reason for the failure), time taken
+        # and bytes received of the last one
+        requests_made = 0
+        status = None
+        latency = 0
+        size = 0
+        try:
+            while True:
+                if ABORT_EVENT.is_set():
+                    raise RuntimeError('Raising exception so that the thread ends sooner')
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                # Don't let the server compress the file, otherwise the Range and Content-Length
+                # headers refer to the compressed data rather than the file
+                headers = {'Accept-Encoding': 'identity'}
+                if offset:
+                    headers['Range'] = 'bytes={}-'.format(offset)
+                    if validators.get('etag') or validators.get('last_modified'):
+                        # only resume if the file is unchanged, otherwise send the whole file
+                        headers['If-Range'] = validators.get('etag') or validators.get('last_modified')
+                if not bucket.acquire(ABORT_EVENT):
+                    raise RuntimeError('Raising exception so that the thread ends sooner')
+                try:
+                    requests_made += 1
+                    start = time.perf_counter()
+                    with sessions.request(service, None, 'GET', base_url, stream=True, headers=headers) as r:
+                        status = r.status_code
+                        if r.status_code == 416 and offset:
+                            # we already have the whole file (or the part file is bad), so start again
+                            os.remove(part_path)
+                            continue
+                        if r.status_code >= 500:
+                            # a server error, so wait and try again (keeping what we've got)
+                            attempt += 1
+                            if attempt >= ASSET_DOWNLOAD_ATTEMPTS:
+                                self.__remove_part_files(part_path)
+                                raise RuntimeError('Download of {} failed with status code {}'.format(base_url, r.status_code))
+                            r.close()
+                            retry_backoff.sleep()
+                            continue
+                        if r.status_code == 429:
+                            # rate limited (attachments are served by the API), so wait as told
+                            attempt += 1
+                            if attempt >= ASSET_DOWNLOAD_ATTEMPTS:
+                                self.__remove_part_files(part_path)
+                                raise RuntimeError('Download of {} failed with status code {}'.format(base_url, r.status_code))
+                            bucket.penalise(retry_backoff.delay(ratelimit.get_retry_after(r.headers)))
+                            continue
+                        if not 200 <= r.status_code < 300:
+                            # The file no longer exists (or we are not allowed to see it). The body
+                            # is an error page rather than the file, so nothing is saved
+                            self.__remove_part_files(part_path)
+                            self.__post_message('update', ('{}: WARNING: Skipped downloading {} (response code {})'.format(self.__repo_full_name, base_url, r.status_code), "\n"))
+                            return False
+                        expected_length = None
+                        if r.status_code == 206:
+                            content_range = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', r.headers.get('Content-Range', ''))
+                            if content_range is None or int(content_range.group(1)) != offset:
+                                # not the part we asked for, so start again
+                                os.remove(part_path)
+                                continue
+                            if content_range.group(3) != '*':
+                                expected_length = int(content_range.group(3))
+                            mode = 'ab'
+                        else:
+                            # the whole file was sent (the server does not support ranges, the file 
+                            # has changed or this is a new download)
+                            if 'Content-Length' in r.headers and 'Content-Encoding' not in r.headers:
+                                expected_length = int(r.headers['Content-Length'])
+                            mode = 'wb'
+                            validators = {}
+                            if r.headers.get('ETag', None):
+                                validators['etag'] = r.headers['ETag']
+                            if r.headers.get('Last-Modified', None):
+                                validators['last_modified'] = r.headers['Last-Modified']
+                            with open(part_meta_path, 'w') as f:
+                                json.dump(validators, f)
+
+                        with open(part_path, mode) as fd:
+                            for chunk in r.iter_content(1024**2): # 1Mb chunk size
+                                fd.write(chunk)
+                        # (only meaningful if we have the whole file in a single response)
+                        content_md5 = r.headers.get('Content-MD5', None) if mode == 'wb' else None
+                except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.Timeout) as e:
+                    status = type(e).__name__
+                    attempt += 1
+                    if attempt >= ASSET_DOWNLOAD_ATTEMPTS:
+                        raise
+                    # keep what we've got, wait and then resume
+                    retry_backoff.sleep()
+                    continue
+                finally:
+                    latency = time.perf_counter() - start
+
+                # check the file is complete and not corrupted
+                length = os.path.getsize(part_path)
+                if expected_length is not None and length < expected_length:
+                    # the connection was closed early, so resume
+                    attempt += 1
+                    status = 'incomplete'
+                    if attempt >= ASSET_DOWNLOAD_ATTEMPTS:
+                        raise RuntimeError('Download of {} is incomplete ({} of {} bytes)'.format(base_url, length, expected_length))
+                    continue
+                sha256 = hashlib.sha256()
+                md5 = hashlib.md5()
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024**2), b''):
+                        sha256.update(chunk)
+                        md5.update(chunk)
+                if (expected_length is not None and length != expected_length) or (content_md5 is not None and base64.b64encode(md5.digest()).decode('ascii') != content_md5):
+                    os.remove(part_path)
+                    attempt += 1
+                    status = 'failed verification'
+                    if attempt >= ASSET_DOWNLOAD_ATTEMPTS:
+                        raise RuntimeError('Download of {} failed verification'.format(base_url))
+                    continue
+                break
+
+            # record the hash of the file (alongside the validators) and move it into the blob 
+            # store, linking it into place
+            validators.update({'length': length, 'sha256': sha256.hexdigest()})
+            with open(save_path + '.meta', 'w') as f:
+                json.dump(validators, f)
+            self.__blob_store.add(part_path, sha256.hexdigest(), save_path)
+            os.remove(part_meta_path)
+            size = length - offset if mode == 'ab' else length
+        finally:
+            if requests_made:
+                telemetry.record('downloads', base_url, latency, status, size, requests_made - 1)
+        return True
+
+    def __remove_part_files(self, part_path):
+        for path in (part_path, part_path + '.meta'):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get_and_save_json(self, base_url, ignore_matcher, rewrite_rules, parent, frontier_id):
+        job = self.__claim_json(base_url, rewrite_rules, parent, frontier_id)
+        if job is None:
+            return
+        if job['response'] is None:
+            job['credentials'] = self.__credential_pool.acquire(job['credentials'])
+            try:
+                job['response'] = bb_query_api(job['rewritten_base_url'], auth=job['credentials'], headers=job['request_headers'])
+            finally:
+                self.__credential_pool.release(job['credentials'])
+            self.__files_downloaded += 1
+            self.__print_update()
+        self.__process_json(job, ignore_matcher, rewrite_rules)
+
+    def __locate_json(self, base_url, rewrite_rules):
+        # Returns the rewritten endpoint and URL to query for base_url, and the path to save the data to
         endpoint, params = full_url_to_query(base_url)
         endpoint = endpoint.replace(bitbucket_api_url, '')
         endpoint = endpoint.split('?')[0]
@@ -2195,7 +2926,8 @@ class BitBucketExport(object):
         encoded_rewritten_params = parse.urlencode(rewritten_params, doseq=True)
 
         # modify rewritten URL for save path (does not modify the URL being queried)
-        endpoint_simplified_params = copy.deepcopy(rewritten_params)
+        # (a shallow copy is enough as parameters are only removed)
+        endpoint_simplified_params = dict(rewritten_params)
         # we don't need the sort order in the save path
         if "sort" in endpoint_simplified_params:
             del endpoint_simplified_params['sort']
@@ -2207,6 +2939,10 @@ class BitBucketExport(object):
         # largest number of items per page anyway (to reduce the number of API calls we need to make)
         if "pagelen" in endpoint_simplified_params:
             del endpoint_simplified_params['pagelen']
+        # The partial response fields only change which parts of the data are included (and the
+        # save path must not depend on whether they were requested, see __synthesise_items)
+        if "fields" in endpoint_simplified_params:
+            del endpoint_simplified_params['fields']
         endpoint_simplified_params_str = parse.urlencode(endpoint_simplified_params, doseq=True)
         endpoint_path = os.path.join(self.__save_path, rewritten_endpoint)
         if endpoint_simplified_params_str:
@@ -2219,122 +2955,192 @@ class BitBucketExport(object):
         if encoded_rewritten_params:
             rewritten_base_url += '?' + encoded_rewritten_params
 
+        return rewritten_endpoint, rewritten_base_url, endpoint_path
+
+    def __claim_json(self, base_url, rewrite_rules, parent, frontier_id):
+        # Works out where the URL (found in the data of the node parent, or None for the top
+        # of the tree) should be saved and records it in the tree.
+        # Returns None if the URL does not need processing (because it's a duplicate), otherwise
+        # returns a dictionary describing the job. If the data has previously been downloaded, 
+        # the 'response' entry will contain it, otherwise it is None (and the URL needs to be queried)
+        rewritten_endpoint, rewritten_base_url, endpoint_path = self.__locate_json(base_url, rewrite_rules)
+
         # save this URL in the tree
         # tree = self.__tree
         # for i in self.current_tree_location[:-1]:
         #     tree = tree[i]['children']
-        tree.append({'url': base_url, 'rewritten_url': rewritten_base_url, 'endpoint_path':endpoint_path, 'already_processed': False, 'children': []})
+        node = self.__tree.add(parent, base_url, rewritten_base_url, endpoint_path)
+
+        # Another request for the same file is in progress (only happens with the asyncio backend)
+        if endpoint_path in self.__in_progress:
+            node.already_processed = True
+            self.__frontier.add_node(parent.id if parent is not None else None, node)
+            self.__frontier.done(frontier_id)
+            self.__duplicates_skipped += 1
+            self.__print_update()
+            return None
 
         # create the dir structure
-        head, _ = os.path.split(endpoint_path)
-        try:
-            os.makedirs(head)
-        except FileExistsError:
-            pass
-
-        if os.path.exists(endpoint_path):
-            # load the file
-            response = DummyResponse(endpoint_path, self.__dummy_response_cache)
-            if response.already_processed:
+        self.__visited.makedirs(os.path.dirname(endpoint_path))
+
+        response = None
+        request_headers = None
+        if endpoint_path in self.__synthesised:
+            # saved from a page of a list on this run, so there is no need to request it
+            self.__synthesised.discard(endpoint_path)
+            self.__visited.visit(endpoint_path)
+            response = DummyResponse(endpoint_path)
+            self.__items_synthesised += 1
+        elif self.__refresh and self.__visited.exists(endpoint_path) and not self.__visited.visited(endpoint_path):
+            # Ask the API whether the data has changed since we downloaded it (if we know the
+            # ETag/Last-Modified, otherwise download it again in full)
+            request_headers = self.__load_validators(endpoint_path)
+            self.__in_progress.add(endpoint_path)
+        elif self.__visited.exists(endpoint_path):
+            if self.__visited.visit(endpoint_path):
                 # mark as already processed
-                tree[-1]['already_processed'] = True
+                node.already_processed = True
+                self.__frontier.add_node(parent.id if parent is not None else None, node)
+                self.__frontier.done(frontier_id)
                 self.__duplicates_skipped += 1
                 self.__print_update()
-                return
-            else:
-                self.__already_downloaded += 1
+                return None
+            # load the file
+            response = DummyResponse(endpoint_path)
+            self.__already_downloaded += 1
         else:
-            response = bb_query_api(rewritten_base_url, auth=self.__credentials)
-            self.__files_downloaded += 1
-            self.__print_update()
+            self.__in_progress.add(endpoint_path)
+
+        self.__frontier.add_processed(endpoint_path, [name for name, matcher in self.__profile_savings.items() if matcher.matches(rewritten_endpoint)])
+
+        # (committed along with the next page to be processed)
+        self.__frontier.claim(frontier_id, self.__frontier.add_node(parent.id if parent is not None else None, node))
+
+        return {
+            'base_url': base_url,
+            'rewritten_endpoint': rewritten_endpoint,
+            'rewritten_base_url': rewritten_base_url,
+            'endpoint_path': endpoint_path,
+            'node': node,
+            'response': response,
+            'request_headers': request_headers,
+            'frontier_id': frontier_id,
+            'credentials': self.__pinned_credentials.pop(frontier_id, None),
+        }
+
+    def __process_json(self, job, ignore_matcher, rewrite_rules):
+        # Saves the JSON data for a job and queues any URLs found within it
+        rewritten_endpoint = job['rewritten_endpoint']
+        endpoint_path = job['endpoint_path']
+        node = job['node']
+        response = job['response']
+        self.__in_progress.discard(endpoint_path)
+
+        if job['request_headers'] is not None:
+            if response.status_code == 304:
+                # unchanged since the last run, so use the data on disk
+                response = DummyResponse(endpoint_path)
+                self.__files_downloaded -= 1
+                self.__unchanged += 1
+            elif response.status_code == 200:
+                # The data has changed, so delete the copy with rewritten URLs in order
+                # for make_urls_relative to regenerate it
+                try:
+                    os.remove(endpoint_path.replace(self.__save_path, self.__save_path_relative))
+                except FileNotFoundError:
+                    pass
 
         if response.status_code == 200:
-            # save the data
+            # Read and decode the data once. It is used as is both for saving to disk and
+            # for finding the URLs referenced within it
+            content = response.content
             try:
-                json_data = response.json()
-            except BaseException:
+                text = content.decode(json.detect_encoding(content))
+                json_data = json.loads(text)
+            except ValueError:
                 # print('Not a JSON response, ignoring')
                 # print('     original endpoint:', base_url)
                 # print('    rewritten endpoint:', rewritten_base_url)
                 # print('    data:', response.text)
                 self.__files_downloaded -= 1
                 self.__print_update(force=True)
+                self.__frontier.done(job['frontier_id'])
+                self.__frontier.commit()
                 return
         
-            with open(endpoint_path, 'w') as f:
-                json.dump(json_data, f)
-
-            # Create dummy response now so that we don't think this file was downloaded on a previous run of the script
+            # save the data (unless it came from the file in the first place)
+            if not isinstance(response, DummyResponse):
+                with open(endpoint_path, 'wb') as f:
+                    f.write(content)
+                self.__save_validators(endpoint_path, response)
+                self.__visited.add(endpoint_path)
+                if self.__item_lists is not None:
+                    self.__synthesise_items(rewritten_endpoint, json_data, ignore_matcher, rewrite_rules)
+
+            # Mark as visited now so that we don't think this file was downloaded on a previous run of the script
             # next time it is encountered on this run of the script
-            DummyResponse(endpoint_path, self.__dummy_response_cache)
+            self.__visited.visit(endpoint_path)
 
             self.tree_new_level()
 
             # get the other pages
             if "next" in json_data:
-                self.url_queue.put((json_data['next'], tree[-1]['children']))
-                # self.get_and_save_json(json_data['next'], ignore_rules, rewrite_rules, tree[-1]['children'])
+                # If this is the first page, all of the other pages are queued now (so they can be
+                # downloaded concurrently). Each page is still linked to from the previous page 
+                # (where it is found again, as a duplicate) so the "next" links are rewritten as usual
+                # Only the "next" link is requested by the same account (it may contain a context
+                # for that account). The predicted pages are plain page numbers, so are shared
+                # between the accounts
+                pinned = job['credentials'] if len(self.__credential_pool) > 1 else None
+                self.__queue_url(json_data['next'], node, pinned)
                 self.tree_increment_level()
+                for url in discover.predict_pages(json_data):
+                    self.__queue_url(url, node)
+                    # self.get_and_save_json(json_data['next'], ignore_rules, rewrite_rules, node['children'])
+                    self.tree_increment_level()
+
+            # find the files and other API endpoints referenced in this data (in a single pass 
+            # over the data; the next page was queued above)
+            downloads, results = self.__url_scanner.scan(json_data)
 
             # download any files references
-            for compiled_regex in self.file_download_regexes:
-                results = compiled_regex.findall(response.text)
-                for result in results:
-                    try:
-                        # print('downloading file: {}'.format(result))
-                        self.download_file(result, tree[-1]['children'])
-                        self.tree_increment_level()
-                    except BaseException:
-                        self.__post_message('update', ('{}: Failed to download file {}'.format(self.__repo_full_name, result), "\n"))
-                        # print('Failed to download file {}'.format(result))
-                        raise
+            for result in downloads:
+                try:
+                    # print('downloading file: {}'.format(result))
+                    self.download_file(result, node)
+                    self.tree_increment_level()
+                except BaseException:
+                    self.__post_message('update', ('{}: Failed to download file {}'.format(self.__repo_full_name, result), "\n"))
+                    # print('Failed to download file {}'.format(result))
+                    raise
 
-            # find all the other referenced API endpoints in this data and collect them too
-            results = prog.findall(response.text)
+            # collect all the other referenced API endpoints too
             for result in results:
                 # hack because nothing references issue/<num>/changes for some reason
-                issue_pattern = r'repositories/{}/{}/issues/(\d+)$'.format(self.__owner, self.__repository)
-                matches = re.match(issue_pattern, result)
+                matches = self.__issue_regex.match(result)
                 if matches:
-                    self.url_queue.put((bb_endpoint_to_full_url(result+'/changes'), tree[-1]['children']))
-                    # self.get_and_save_json(bb_endpoint_to_full_url(result+'/changes'), ignore_rules, rewrite_rules, tree[-1]['children'])
+                    self.__queue_url(bb_endpoint_to_full_url(result+'/changes'), node)
+                    # self.get_and_save_json(bb_endpoint_to_full_url(result+'/changes'), ignore_rules, rewrite_rules, node['children'])
                     self.tree_increment_level()
 
-                skip = False
-                for rule in ignore_rules:
-                    if rule['type'] == 'in':
-                        if rule['not']:
-                            skip = rule['string'] not in result
-                        else:
-                            skip = rule['string'] in result
-                    elif rule['type'] == 'startswith':
-                        if rule['not']:
-                            skip = not result.startswith(rule['string'])
-                        else:
-                            skip = result.startswith(rule['string'])
-                    elif rule['type'] == 'endswith':
-                        if rule['not']:
-                            skip = not result.endswith(rule['string'])
-                        else:
-                            skip = result.endswith(rule['string'])
-
-                    if skip:
-                        break
+                skip = ignore_matcher.matches(result)
+                if not skip and self.__profile_matcher.matches(result):
+                    self.__frontier.add_profile_skipped(result)
+                    skip = True
 
                 # TODO: Work out why this is needed now and wasn't needed for other repositories I tested with
                 #       Was it because I had two repositories 'user/repo" and "user/repo-dev"?
                 #       In that case it started download repo-dev as part of repo and the ignore rules didn't
                 #       match so it started downloading source files too.
-                repo_str = 'repositories/{}/{}'.format(self.__owner, self.__repository)
-                if not skip and not result.startswith(repo_str+'/') and result != repo_str:
+                if not skip and not result.startswith(self.__repo_prefixes[1]) and result != self.__repo_prefixes[0]:
                     skip=True
                     print('Skipping file {} (found in {})'.format(result, endpoint_path))
 
                 if skip:
                     continue
 
-                self.url_queue.put((bb_endpoint_to_full_url(result), tree[-1]['children']))
-                # self.get_and_save_json(bb_endpoint_to_full_url(result), ignore_rules, rewrite_rules, tree[-1]['children'])
+                self.__queue_url(bb_endpoint_to_full_url(result), node)
+                # self.get_and_save_json(bb_endpoint_to_full_url(result), ignore_rules, rewrite_rules, node['children'])
                 self.tree_increment_level()
             
             self.tree_finished_level()
@@ -2355,12 +3161,122 @@ class BitBucketExport(object):
             self.__files_downloaded -= 1
             self.__print_update(force=True)
 
+        # The page (and the URLs found in it) is saved in the crawl state as a single transaction
+        self.__frontier.done(job['frontier_id'])
+        self.__frontier.commit()
+
+    def __synthesise_items(self, endpoint, json_data, ignore_matcher, rewrite_rules):
+        # Saves the JSON of each item in a freshly downloaded page of a list (of issues, pull 
+        # requests or commits) to the path that the item's own endpoint would be saved to, so
+        # that it is not requested when its URL is found (in this page)
+        items = []
+        for url, item in self.__item_lists.items(endpoint, json_data):
+            item_endpoint = url[len(bitbucket_api_url):]
+            if ignore_matcher.matches(item_endpoint) or self.__profile_matcher.matches(item_endpoint):
+                continue
+            item_path = self.__locate_json(url, rewrite_rules)[2]
+            if item_path in self.__in_progress or self.__visited.visited(item_path):
+                continue
+            items.append((url, item, item_path))
+        if items and self.__item_lists.complete(endpoint) is None:
+            # check the values of this kind of list have every field of the items first
+            if not self.__check_item_list(endpoint, items.pop(0), rewrite_rules):
+                return
+        for url, item, item_path in items:
+            self.__visited.makedirs(os.path.dirname(item_path))
+            # (written to a temporary file first so that an interrupted run never leaves a
+            # truncated file that looks like it was downloaded)
+            with open(item_path + '.tmp', 'wb') as f:
+                f.write(json.dumps(item).encode('utf-8'))
+            os.replace(item_path + '.tmp', item_path)
+            # The ETag/Last-Modified of a previous download of the item no longer apply, and the
+            # copy with rewritten URLs needs regenerating (see make_urls_relative)
+            for path in [item_path + '.meta', item_path.replace(self.__save_path, self.__save_path_relative)]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.__visited.add(item_path)
+            self.__synthesised.add(item_path)
+
+    def __check_item_list(self, endpoint, list_item, rewrite_rules):
+        # Requests one of the items in a page of a list (saving it as if it had been found by
+        # the crawl) and compares it with its value in the list. Returns True if the values of
+        # the list are complete items
+        url, value, item_path = list_item
+        rewritten_base_url = self.__locate_json(url, rewrite_rules)[1]
+        credentials = self.__credential_pool.acquire()
+        try:
+            response = bb_query_api(rewritten_base_url, auth=credentials)
+        finally:
+            self.__credential_pool.release(credentials)
+        self.__files_downloaded += 1
+        if response.status_code != 200:
+            # (try again with the next page of the list)
+            return False
+        try:
+            item = json.loads(response.content.decode(json.detect_encoding(response.content)))
+        except ValueError:
+            return False
+        self.__visited.makedirs(os.path.dirname(item_path))
+        with open(item_path + '.tmp', 'wb') as f:
+            f.write(response.content)
+        os.replace(item_path + '.tmp', item_path)
+        self.__save_validators(item_path, response)
+        try:
+            os.remove(item_path.replace(self.__save_path, self.__save_path_relative))
+        except FileNotFoundError:
+            pass
+        self.__visited.add(item_path)
+        self.__synthesised.add(item_path)
+        missing = self.__item_lists.check(endpoint, value, item)
+        if missing:
+            self.__post_message('update', ('{}: The list {} is missing fields of its items ({}), so each item will be requested separately'.format(self.__repo_full_name, endpoint, ', '.join(missing[:5])), "\n"))
+        return not missing
+
+    def __queue_url(self, url, parent, credentials=None):
+        # queue a URL found in the data of the node parent (to be requested with credentials, if given)
+        frontier_id = self.__frontier.push(url, parent.id, credentials[0] if credentials is not None else None)
+        if credentials is not None:
+            self.__pinned_credentials[frontier_id] = credentials
+        self.url_queue.put((url, parent, frontier_id))
+        return frontier_id
+
+    def __load_validators(self, endpoint_path):
+        # Returns the headers for a conditional request based on the ETag/Last-Modified
+        # headers saved when the file was downloaded
+        request_headers = {}
+        try:
+            with open(endpoint_path + '.meta', 'r') as f:
+                validators = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return request_headers
+        if validators.get('etag'):
+            request_headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            request_headers['If-Modified-Since'] = validators['last_modified']
+        return request_headers
+
+    def __save_validators(self, endpoint_path, response):
+        # save the ETag/Last-Modified headers next to the JSON file so that a later refresh
+        # can ask the API whether the data has changed
+        validators = {}
+        if response.headers.get('ETag', None):
+            validators['etag'] = response.headers['ETag']
+        if response.headers.get('Last-Modified', None):
+            validators['last_modified'] = response.headers['Last-Modified']
+        if validators:
+            with open(endpoint_path + '.meta', 'w') as f:
+                json.dump(validators, f)
+        elif os.path.exists(endpoint_path + '.meta'):
+            os.remove(endpoint_path + '.meta')
+
     def make_urls_relative(self, tree=None, parent_percent=0, parent_percent_subset=100.0, mapping=None):
-        # tree.append({'url': base_url, 'rewritten_url': rewritten_base_url, 'endpoint_path':endpoint_path, 'already_processed': False, 'children': []})
+        # tree is a list of crawltree.Node objects
         
         top_level = False
         if tree is None:
-            tree = self.__tree
+            tree = self.__tree.roots
             top_level = True
             # self.__post_message('update', ('{repo}: Rewriting URLs in downloaded API data: {pcnt:.1f}% complete'.format(repo=self.__repo_full_name, pcnt=parent_percent), "\r"))
             # print('Rewriting URLs in downloaded API data: {:.1f}% complete'.format(parent_percent), end="\r")
@@ -2369,7 +3285,7 @@ class BitBucketExport(object):
 
         for item in tree:
             # get new path
-            new_path = item['endpoint_path'].replace(self.__save_path, self.__save_path_relative)
+            new_path = item.endpoint_path.replace(self.__save_path, self.__save_path_relative)
             head, _ = os.path.split(new_path)
             try:
                 os.makedirs(head)
@@ -2377,33 +3293,41 @@ class BitBucketExport(object):
                 pass
 
             skip_file = False
+            if self.__rebuilt_paths is not None:
+                # rebuilding, so replace the file written previously (but only once)
+                if new_path in self.__rebuilt_paths:
+                    skip_file = True
             # ignore if new path already converted
-            if os.path.exists(new_path):
+            elif os.path.exists(new_path):
                 skip_file = True
             # ignore if file doesn't exist
-            if not os.path.exists(item['endpoint_path']):
+            if not os.path.exists(item.endpoint_path):
                 skip_file = True
             # only process the items that have children (we may encounter reference to a file that was marked as already processed)
             # before we hit the reference that was not marked as already processed.
-            if item['already_processed'] and new_path.endswith('.json'):
+            if item.already_processed and new_path.endswith('.json'):
                 skip_file = True
+            if not skip_file and self.__rebuilt_paths is not None:
+                self.__rebuilt_paths.add(new_path)
 
             if not skip_file:
                 # if it is a JSON file
                 if new_path.endswith('.json'):
                     # open file
-                    # print('processing', item['endpoint_path'])
-                    with open(item['endpoint_path'], 'r') as f:
-                        data = f.read()
+                    # print('processing', item.endpoint_path)
+                    # (files are saved exactly as they were received, so are UTF-8 encoded)
+                    with open(item.endpoint_path, 'rb') as f:
+                        content = f.read()
+                    data = content.decode(json.detect_encoding(content))
 
                     # iterate over children and replace URLs
-                    for child in item['children']:
+                    for child in item.children:
                         # print('replacing', child['url'], 'with', child['endpoint_path'].replace(r'\\', '/').replace(r'\','/'))
-                        new_url = child['endpoint_path'].replace(self.__save_path, 'data').replace('\\\\', '/').replace('\\','/')
-                        data = data.replace('"{}"'.format(child['url']), '"{}"'.format(new_url)) # JSON value
-                        data = data.replace(r'\"{}\"'.format(child['url']), r'\"{}\"'.format(new_url)) # escaped HTML image src in JSON
-                        # data = data.replace('![]({})'.format(child['url']), '![]({})'.format(new_url)) # markdown image format
-                        data = re.sub(r"\!\[(.*?)\]\("+re.escape(child['url'])+r"\)", r"![\1]("+new_url+r")", data, flags=re.MULTILINE) # markdown image format
+                        new_url = child.endpoint_path.replace(self.__save_path, 'data').replace('\\\\', '/').replace('\\','/')
+                        data = data.replace('"{}"'.format(child.url), '"{}"'.format(new_url)) # JSON value
+                        data = data.replace(r'\"{}\"'.format(child.url), r'\"{}\"'.format(new_url)) # escaped HTML image src in JSON
+                        # data = data.replace('![]({})'.format(child.url), '![]({})'.format(new_url)) # markdown image format
+                        data = re.sub(r"\!\[(.*?)\]\("+re.escape(child.url)+r"\)", r"![\1]("+new_url+r")", data, flags=re.MULTILINE) # markdown image format
 
                     # fix weird URLS that exist which aren't valid api endpoints, but BitBucket puts them in the content...WTF?
                     # data = re.sub(r'\\\"(https\:\/\/api\.bitbucket\.org\/(.*?)\/(.*?)\/(.*?))\\\"', self.fix_stupid_bitbucket_urls, data, flags=re.MULTILINE)
@@ -2419,16 +3343,17 @@ class BitBucketExport(object):
                     for old_url, (new_url, _) in self.__external_URL_rewrites.items():
                         data = data.replace(old_url, new_url)
 
-                    # save file
+                    # save file (escaping any non-ASCII characters, as json.dump does by default,
+                    # so that the file can be read regardless of the platform's default encoding)
                     with open(new_path, 'w') as f:
-                        f.write(data)
-                # if it is a binary file
+                        f.write(ascii_escape_json(data))
+                # if it is a binary file (link to the same copy in the blob store)
                 else:
-                    shutil.copyfile(item['endpoint_path'], new_path)
+                    blobstore.link_or_copy(item.endpoint_path, new_path)
 
             # recurse over children
             self.url_queue.put({
-                'tree': item['children'],
+                'tree': item.children,
                 'mapping': mapping,
                 'parent_percent': parent_percent, 
                 'parent_percent_subset': parent_percent_subset,
@@ -2461,31 +3386,23 @@ class BitBucketExport(object):
 
 
 class DummyResponse(object):
-    def __init__(self, path, cache):
-        if getattr(self, 'already_processed', None) is not None:
-            return
+    # A response whose content is a file saved by a previous run
+    def __init__(self, path):
         self.__path = path
         self.status_code = 200
-        self.already_processed = False
+
+    @property
+    def content(self):
+        with open(self.__path, 'rb') as f:
+            return f.read()
 
     def json(self):
-        with open(self.__path, 'r') as f:
-            return json.load(f)
+        return json.loads(self.content)
 
     @property
     def text(self):
-        with open(self.__path, 'r') as f:
-            return f.read()
-
-    def __new__(cls, path, cache, *args, **kwargs):
-        existing = cache.get(path, None)
-        if existing is not None:
-            # print('ignoring',path)
-            existing.already_processed = True
-            return existing
-        obj = super(DummyResponse, cls).__new__(cls)
-        cache[path] = obj
-        return obj
+        content = self.content
+        return content.decode(json.detect_encoding(content))
 
 def main():
     project = MigrationProject()
@@ -0,0 +1,87 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Waiting between retries of failed requests.
+#
+# All waits:
+#   * are measured on a clock that keeps counting while the computer is
+#     suspended/hibernated (where the OS provides one), so a long wait that
+#     spans a hibernate ends when it should rather than starting again
+#   * wait on the abort event, so that Ctrl-C (or SIGTERM) stops a thread
+#     within a fraction of a second rather than after the wait
+#   * are randomised ("jitter") so that threads (using the same or different
+#     credentials) that failed at the same time don't all retry at once
+
+import random
+import time
+
+if hasattr(time, 'CLOCK_BOOTTIME'):
+    # Linux: like CLOCK_MONOTONIC but includes time spent suspended
+    def clock():
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+else:
+    clock = time.monotonic
+
+# Longest single wait on the abort event, so that the clock is checked regularly
+# (threading.Event.wait does not count time spent suspended on all platforms)
+MAX_WAIT_SLICE = 1.0
+
+
+def wait(seconds, abort_event=None):
+    """Wait for the given number of seconds.
+
+    Returns False if the abort_event was set while waiting, True otherwise.
+    """
+    deadline = clock() + seconds
+    while True:
+        if abort_event is not None and abort_event.is_set():
+            return False
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return True
+        if abort_event is not None:
+            if abort_event.wait(min(remaining, MAX_WAIT_SLICE)):
+                return False
+        else:
+            time.sleep(min(remaining, MAX_WAIT_SLICE))
+
+
+class Backoff(object):
+    """Exponential backoff (with jitter) for the retries of a single request"""
+
+    def __init__(self, base=5, cap=300, abort_event=None):
+        self.base = base
+        self.cap = cap
+        self.abort_event = abort_event
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def delay(self, retry_after=None):
+        """Returns the time to wait before the next attempt. If the server told
+        us when to retry (e.g. via a Retry-After header) that is used instead of
+        the exponential delay, with jitter of up to 20% of it (or 0.2 seconds, if longer) added"""
+        self.attempts += 1
+        if retry_after is not None:
+            return retry_after + random.uniform(0, min(self.base, max(retry_after, 1)*0.2))
+        ceiling = min(self.cap, self.base*2**(self.attempts-1))
+        # "equal jitter": wait at least half of the exponential delay
+        return ceiling/2 + random.uniform(0, ceiling/2)
+
+    def wait(self, delay):
+        """Wait for delay seconds (as returned by self.delay()), raising an
+        exception if the abort event is set"""
+        if not wait(delay, self.abort_event):
+            raise RuntimeError('Raising exception so that the thread ends sooner')
+
+    def sleep(self, retry_after=None):
+        """Wait before the next attempt. Returns the time waited"""
+        delay = self.delay(retry_after)
+        self.wait(delay)
+        return delay
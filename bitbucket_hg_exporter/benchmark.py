@@ -0,0 +1,242 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# End-to-end benchmark of the BitBucket API export.
+#
+# Starts the mock server (see mockserver.py), redirects all HTTP traffic to it
+# and runs a complete export (crawl + URL rewriting) of the synthetic
+# repository. Optionally, the issues are then imported into the mock GitHub API.
+# Reports requests/s, bytes/s and peak memory so that changes in crawl
+# throughput can be spotted before they are used for a real migration.
+
+import argparse
+import copy
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+from . import mockserver
+from . import profiles
+from . import ratelimit
+from . import sessions
+from . import telemetry
+from .__main__ import BitBucketExport
+from .issue_migrate import import_issues_to_github
+
+# Don't let the rate limiter slow down the benchmark (unless it is asked to)
+UNLIMITED_REQUESTS_PER_HOUR = 10**9
+
+
+class _NoConversion(object):
+    # Stands in for the hg2git.Bb2Gh object (which needs the hg and git repositories)
+    def convert_all(self, content):
+        return content
+
+    def convert_other_repo_content(self, content):
+        return content
+
+
+def _format_bytes(num_bytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(num_bytes) < 1024 or unit == 'GB':
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024.0
+
+def _peak_rss():
+    # Peak resident set size of this process in bytes (or None if unknown)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak*1024
+
+
+class Benchmark(object):
+    def __init__(self, dataset, latency=0, rate_limit_every=0, retry_after=1, backend='threaded', concurrency=4, asset_threads=4, accounts=1, profile=profiles.DEFAULT_PROFILE, synthesise_items=False, requests_per_hour=None, output_dir=None, trace_memory=False, verbose=False):
+        self.dataset = dataset
+        self.server = mockserver.MockServer(dataset, latency=latency, rate_limit_every=rate_limit_every, retry_after=retry_after)
+        self.backend = backend
+        self.concurrency = concurrency
+        self.asset_threads = asset_threads
+        self.accounts = accounts
+        self.profile = profile
+        self.synthesise_items = synthesise_items
+        self.requests_per_hour = requests_per_hour or UNLIMITED_REQUESTS_PER_HOUR
+        self.output_dir = output_dir
+        # tracemalloc gives the peak memory allocated by Python code in each phase,
+        # but slows everything down
+        self.trace_memory = trace_memory
+        self.verbose = verbose
+        self.results = []
+
+    def __post_message(self, message_type, data):
+        if self.verbose and message_type == 'update':
+            print(data[0], end=data[1])
+
+    def __settings(self, project_path):
+        return {
+            'project_path': project_path,
+            'bb_repositories_to_export': [{'full_name': '{}/{}'.format(self.dataset.owner, self.dataset.repository)}],
+            'github_rewrite_additional_URLs': False,
+            'bitbucket_crawl_backend': self.backend,
+            'bitbucket_crawl_concurrency': self.concurrency,
+            'bitbucket_asset_download_threads': self.asset_threads,
+            'bitbucket_crawl_profile': self.profile,
+            'bitbucket_synthesise_items': self.synthesise_items,
+            'bitbucket_api_refresh': False,
+            'bb_gh_user_mapping': {},
+            'github_publish_pages': False,
+            'github_owner': 'mock-github-user',
+            'github_pages_repo_name': '',
+        }
+
+    def __measure(self, name, function):
+        before = self.server.statistics()
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        after = self.server.statistics()
+        peak_traced = None
+        if self.trace_memory:
+            _, peak_traced = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # (Python < 3.9) restarting also resets the peak, but the memory still held
+                # from earlier phases is then not counted in the next phase
+                tracemalloc.stop()
+                tracemalloc.start()
+        result = {
+            'name': name,
+            'time': elapsed,
+            'requests': after['requests'] - before['requests'],
+            'bytes': after['bytes'] - before['bytes'],
+            'rate_limited': after['rate_limited'] - before['rate_limited'],
+            'peak_traced_memory': peak_traced,
+        }
+        self.results.append(result)
+        return result
+
+    def run(self, github=False):
+        project_path = self.output_dir
+        if project_path is None:
+            project_path = tempfile.mkdtemp(prefix='bitbucket-hg-exporter-benchmark-')
+        elif os.path.exists(project_path):
+            raise RuntimeError('The output directory {} already exists. Please specify a new directory.'.format(project_path))
+        settings = self.__settings(project_path)
+        credentials = ('mock-user', 'mock-password')
+        additional_credentials = [('mock-user-{}'.format(i), 'mock-password') for i in range(1, self.accounts)]
+
+        self.server.start()
+        sessions.redirect_hosts(self.server.redirects())
+        sessions.configure(pool_maxsize=max(sessions.DEFAULT_POOL_MAXSIZE, self.concurrency, self.asset_threads))
+        ratelimit.configure('bitbucket', self.requests_per_hour)
+        ratelimit.configure('github', self.requests_per_hour)
+        if self.trace_memory:
+            tracemalloc.start()
+        telemetry.start(os.path.join(project_path, 'telemetry.json'))
+        try:
+            export = BitBucketExport(self.dataset.owner, credentials, copy.deepcopy(settings), self.__post_message, additional_credentials=additional_credentials)
+            self.__measure('BitBucket API export', export.backup_api)
+            if github:
+                bb_repo = settings['bb_repositories_to_export'][0]['full_name']
+                mapping = {bb_repo: _NoConversion()}
+                self.__measure(
+                    'GitHub issue import',
+                    lambda: import_issues_to_github(bb_repo, 'mock-github-user/' + self.dataset.repository, credentials, copy.deepcopy(settings), mapping, dry_run=False)
+                )
+        finally:
+            if self.trace_memory:
+                tracemalloc.stop()
+            telemetry.stop()
+            sessions.close()
+            self.server.stop()
+            if self.output_dir is None:
+                shutil.rmtree(project_path, ignore_errors=True)
+        return self.results
+
+    def report(self):
+        lines = []
+        for result in self.results:
+            lines.append('{name}: {requests} requests ({size}) in {time:.2f} s'.format(size=_format_bytes(result['bytes']), **result))
+            lines.append('    {:.1f} requests/s, {}/s'.format(result['requests']/result['time'], _format_bytes(result['bytes']/result['time'])))
+            if result['rate_limited']:
+                lines.append('    {} requests were rate limited (429)'.format(result['rate_limited']))
+            if result['peak_traced_memory'] is not None:
+                lines.append('    peak Python memory allocated: {}'.format(_format_bytes(result['peak_traced_memory'])))
+        # the endpoint families that took the most requests
+        for service, families in telemetry.snapshot()['endpoints'].items():
+            lines.append('{} requests by endpoint:'.format(service))
+            for family, statistics in sorted(families.items(), key=lambda item: -item[1]['requests'])[:10]:
+                lines.append('    {}: {} requests ({}), mean latency {:.3f} s'.format(family or '(other)', statistics['requests'], _format_bytes(statistics['bytes']), statistics['mean_latency']))
+        peak_rss = _peak_rss()
+        if peak_rss is not None:
+            lines.append('Peak resident memory of process: {}'.format(_format_bytes(peak_rss)))
+        lines.append(sessions.format_statistics(sessions.statistics()))
+        return '\n'.join(lines)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the BitBucket API export against a local mock server')
+    p.add_argument('--issues', type=int, default=100)
+    p.add_argument('--pull-requests', type=int, default=20)
+    p.add_argument('--commits', type=int, default=200)
+    p.add_argument('--comments', type=int, default=3, help='Average number of comments on each issue/pull request')
+    p.add_argument('--latency', type=float, default=0, help='Seconds the mock server waits before responding to each request')
+    p.add_argument('--rate-limit-every', type=int, default=0, help='Respond to every Nth API request with a 429 (0 to disable)')
+    p.add_argument('--retry-after', type=int, default=1, help='Value of the Retry-After header sent with 429 responses')
+    p.add_argument('--requests-per-hour', type=int, default=None, help='Limit the request rate of the exporter (default: unlimited)')
+    p.add_argument('--backend', choices=['threaded', 'asyncio'], default='threaded', help='BitBucket crawl backend to use')
+    p.add_argument('--concurrency', type=int, default=4, help='Number of requests in flight when using the asyncio backend')
+    p.add_argument('--asset-threads', type=int, default=4, help='Number of threads downloading files (images, avatars, attachments)')
+    p.add_argument('--accounts', type=int, default=1, help='Number of BitBucket accounts to share the API requests between')
+    p.add_argument('--profile', choices=list(profiles.PROFILES), default=profiles.DEFAULT_PROFILE, help='Crawl profile (which parts of the BitBucket API data to download)')
+    p.add_argument('--synthesise-items', action='store_true', help='Save issues, pull requests and commits from the lists of them rather than requesting each one')
+    p.add_argument('--github', action='store_true', help='Also import the issues into the mock GitHub API')
+    p.add_argument('--output-dir', default=None, help='Keep the exported data in this (new) directory rather than deleting it')
+    p.add_argument('--trace-memory', action='store_true', help='Report the peak memory allocated by Python during each phase (slower)')
+    p.add_argument('--verbose', action='store_true', help='Show the progress messages of the exporter')
+    arguments = p.parse_args()
+
+    dataset = mockserver.MockDataset(
+        issues=arguments.issues,
+        pull_requests=arguments.pull_requests,
+        commits=arguments.commits,
+        comments=arguments.comments,
+    )
+    benchmark = Benchmark(
+        dataset,
+        latency=arguments.latency,
+        rate_limit_every=arguments.rate_limit_every,
+        retry_after=arguments.retry_after,
+        backend=arguments.backend,
+        concurrency=arguments.concurrency,
+        asset_threads=arguments.asset_threads,
+        accounts=arguments.accounts,
+        profile=arguments.profile,
+        synthesise_items=arguments.synthesise_items,
+        requests_per_hour=arguments.requests_per_hour,
+        output_dir=arguments.output_dir,
+        trace_memory=arguments.trace_memory,
+        verbose=arguments.verbose,
+    )
+    print('Benchmarking export of {} issues, {} pull requests and {} commits ({} backend, {} account(s), "{}" profile)'.format(arguments.issues, arguments.pull_requests, arguments.commits, arguments.backend, arguments.accounts, arguments.profile))
+    benchmark.run(github=arguments.github)
+    print(benchmark.report())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# A content addressed store for downloaded files.
+#
+# The same avatars, emoji and images are referenced from many different URLs
+# (and by every repository in an export of a whole team). Each distinct file
+# is stored once, named by the sha256 hash of its content, and the paths
+# derived from the URLs (in bitbucket_data_raw and gh-pages/data) are hard
+# links to it. Where hard links are not supported (e.g. FAT formatted drives,
+# or the store being on a different drive), the file is copied instead.
+
+import os
+import shutil
+
+
+def link_or_copy(src, dst):
+    """Makes dst a hard link to src (or a copy of it if hard links are not
+    supported). dst is replaced atomically if it already exists."""
+    try:
+        if os.path.samefile(src, dst):
+            # already linked (and os.replace does nothing when both paths are
+            # links to the same file, so would leave tmp behind)
+            return
+    except FileNotFoundError:
+        pass
+    tmp = dst + '.linking'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except (OSError, NotImplementedError):
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+class BlobStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def blob_path(self, sha256):
+        # split into subfolders so that no one folder gets too large
+        return os.path.join(self.path, sha256[:2], sha256)
+
+    def __contains__(self, sha256):
+        return os.path.exists(self.blob_path(sha256))
+
+    def add(self, path, sha256, dst):
+        """Moves the file at path (whose content has the given sha256 hash) into
+        the store and links dst to the stored copy. If the store already has a
+        file with the same content, the file at path is deleted instead."""
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(blob_path):
+            os.remove(path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # (if another thread stores the same content at the same time, one simply
+            # replaces the other)
+            os.replace(path, blob_path)
+        link_or_copy(blob_path, dst)
+        return blob_path
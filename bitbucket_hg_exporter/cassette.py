@@ -0,0 +1,179 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Record and replay of HTTP traffic.
+#
+# When recording, every request sent through the session pool (BitBucket and
+# GitHub API queries as well as file downloads) is written, along with its
+# response, to a gzipped file containing one JSON object per line (a
+# "cassette"). When replaying, the responses are served from the cassette and
+# nothing is sent over the network. This allows a crawl to be repeated exactly,
+# offline and without using any API quota, which is useful for profiling.
+#
+# Credentials are never written to the cassette.
+
+import base64
+import datetime
+import gzip
+import io
+import json
+import threading
+import time
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+# Response headers that describe the encoding of the body on the wire. The
+# cassette stores the decoded body, so these no longer apply on replay.
+_WIRE_HEADERS = ('Content-Encoding', 'Transfer-Encoding', 'Content-Length')
+
+
+def _encode_body(body):
+    if body is None:
+        return {}
+    try:
+        return {'text': body.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'base64': base64.b64encode(body).decode('ascii')}
+
+def _decode_body(entry):
+    if 'text' in entry:
+        return entry['text'].encode('utf-8')
+    elif 'base64' in entry:
+        return base64.b64decode(entry['base64'])
+    return b''
+
+
+class CassetteRecorder(BaseAdapter):
+    """Transport adapter that sends requests using another adapter and
+    records each exchange to a cassette file"""
+
+    def __init__(self, cassette, adapter):
+        super(CassetteRecorder, self).__init__()
+        self.__cassette = cassette
+        self.__adapter = adapter
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        response = self.__adapter.send(request, **kwargs)
+        # Read the whole body now (even for streamed downloads) so that it can be
+        # recorded. The body remains available through response.content and
+        # response.iter_content()
+        content = response.content
+        self.__cassette.record(request, response, content, time.monotonic() - start)
+        return response
+
+    def close(self):
+        self.__adapter.close()
+
+    def statistics(self):
+        return self.__adapter.statistics()
+
+
+class CassettePlayer(BaseAdapter):
+    """Transport adapter that serves responses from a cassette"""
+
+    def __init__(self, cassette):
+        super(CassettePlayer, self).__init__()
+        self.__cassette = cassette
+
+    def send(self, request, **kwargs):
+        entry = self.__cassette.play(request)
+        content = _decode_body(entry)
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry.get('reason', '')
+        response.headers = CaseInsensitiveDict(entry.get('headers', {}))
+        for name in _WIRE_HEADERS:
+            response.headers.pop(name, None)
+        response.headers['Content-Length'] = str(len(content))
+        response.raw = io.BytesIO(content)
+        response._content = content
+        response._content_consumed = True
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=entry.get('elapsed', 0))
+        return response
+
+    def close(self):
+        pass
+
+
+class Cassette(object):
+    def __init__(self, path, mode):
+        if mode not in ('record', 'replay'):
+            raise RuntimeError('Unknown cassette mode "{}"'.format(mode))
+        self.path = path
+        self.mode = mode
+        self.__lock = threading.Lock()
+        self.__num_exchanges = 0
+        if mode == 'record':
+            self.__file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.__file = None
+            self.__exchanges = {}
+            self.__load()
+
+    def __key(self, request):
+        return '{} {}'.format(request.method, request.url)
+
+    def __load(self):
+        # Responses for the same request are kept in the order they were recorded
+        # so that (for example) a 429 followed by a successful retry replays the same way
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.__exchanges.setdefault(entry['key'], []).append(entry)
+                    self.__num_exchanges += 1
+        except EOFError:
+            # The recording was interrupted, so use the exchanges that were written
+            pass
+
+    def __len__(self):
+        return self.__num_exchanges
+
+    def record(self, request, response, content, elapsed):
+        entry = {
+            'key': self.__key(request),
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': dict(response.headers),
+            'elapsed': round(elapsed, 4),
+        }
+        entry.update(_encode_body(content))
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.__lock:
+            self.__file.write(line + '\n')
+            self.__num_exchanges += 1
+
+    def play(self, request):
+        key = self.__key(request)
+        with self.__lock:
+            entries = self.__exchanges.get(key, None)
+            if not entries:
+                raise RuntimeError('No response for {} was recorded in the cassette {}'.format(key, self.path))
+            # If the request is made more times than it was recorded, keep serving the last response
+            if len(entries) > 1:
+                return entries.pop(0)
+            return entries[0]
+
+    def wrap(self, adapter):
+        """Returns the transport adapter to use in place of adapter"""
+        if self.mode == 'record':
+            return CassetteRecorder(self, adapter)
+        return CassettePlayer(self)
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
@@ -0,0 +1,69 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# The tree of URLs found by the crawl of a repository's BitBucket API data.
+#
+# Each node is a URL found in the data of its parent, along with the path the
+# data was (or would have been) saved to. The tree is kept until the URLs in
+# the saved data have been rewritten (see make_urls_relative), so for large
+# repositories it has millions of nodes. To keep the memory use down:
+#
+#   * nodes are records with __slots__ (rather than dictionaries), and leaves
+#     (most nodes, as most URLs are duplicates) have no list of children.
+#   * the URL and save path strings are interned per tree, so each distinct
+#     string is stored once no matter how many times the URL is found.
+#   * the rewritten URL is only stored if it differs from the URL.
+
+
+class Node(object):
+    __slots__ = ('url', '_rewritten_url', 'endpoint_path', 'already_processed', 'id', '_children')
+
+    def __init__(self, url, rewritten_url, endpoint_path, already_processed=False, node_id=None):
+        self.url = url
+        self._rewritten_url = None if rewritten_url == url else rewritten_url
+        self.endpoint_path = endpoint_path
+        self.already_processed = already_processed
+        # id of the node in the saved crawl state (see frontier.py)
+        self.id = node_id
+        self._children = None
+
+    @property
+    def rewritten_url(self):
+        return self.url if self._rewritten_url is None else self._rewritten_url
+
+    @property
+    def children(self):
+        return self._children if self._children is not None else ()
+
+
+class CrawlTree(object):
+    def __init__(self):
+        # the top level nodes
+        self.roots = []
+        self.__strings = {}
+
+    def __intern(self, string):
+        return self.__strings.setdefault(string, string)
+
+    def add(self, parent, url, rewritten_url, endpoint_path, already_processed=False, node_id=None):
+        """Adds a node as the last child of parent (or as a top level node if parent is None)
+        and returns it"""
+        node = Node(self.__intern(url), self.__intern(rewritten_url), self.__intern(endpoint_path), already_processed, node_id)
+        if parent is None:
+            self.roots.append(node)
+        elif parent._children is None:
+            parent._children = [node]
+        else:
+            parent._children.append(node)
+        return node
+
+    def __len__(self):
+        return len(self.roots)
+
+    def __iter__(self):
+        return iter(self.roots)
@@ -0,0 +1,206 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Finds the URLs to crawl in a page of BitBucket API data.
+#
+# Rather than searching the text of the page with a regular expression for
+# each kind of URL, the parsed JSON is walked once. Every string that is a URL
+# (for example the "href" of each entry in "links") is classified as either
+# a file to download (avatars, images, attachments, ...) or another API
+# endpoint. Strings containing rendered HTML are searched for the files they
+# reference (e.g. images in issue descriptions).
+#
+# The URLs of all of the pages of a paginated list can also be predicted from
+# its first page, so that they can be downloaded concurrently rather than one
+# at a time by following each page's "next" link.
+#
+# Finally, the values in a page of some lists (issues, pull requests and
+# commits) are the same JSON as each item's own endpoint, provided that any
+# fields missing from the list are requested with BitBucket's partial response
+# syntax (the "fields" query parameter). The item files can then be saved from
+# the list pages, rather than requested one at a time.
+
+import re
+
+# Files that are downloaded (in addition to the repository's issue attachments)
+_DOWNLOAD_PATTERNS = [
+    r'https://bitbucket\.org/repo/(?:[a-zA-Z0-9]+)/images/.+', # images in HTML
+    r'https://pf-emoji-service--cdn\.(?:[a-zA-Z0-9\-]+)\.prod\.public\.atl-paas\.net/.+', # emojis
+    r'https://secure\.gravatar\.com/avatar/.+', # avatars
+    r'https://bytebucket\.org/.+', # other things (like language avatars)
+]
+
+# quoted URLs (e.g. attributes) in HTML
+_html_url_regex = re.compile(r'"(https://[^"\s]+)"')
+
+
+class UrlScanner(object):
+    def __init__(self, api_url, owner, repository):
+        self.__api_url = api_url
+        self.__download_regex = re.compile('|'.join(_DOWNLOAD_PATTERNS + [
+            re.escape('{}repositories/{}/{}/issues/'.format(api_url, owner, repository)) + r'(?:\d+)/attachments/.+', # attachments
+        ]), re.DOTALL)
+
+    def scan(self, data, ignore_keys=('next',)):
+        """Returns the list of files to download and the list of API endpoints (relative
+        to the API URL) referenced in data (the parsed JSON of a page), in the order they
+        appear. Values of keys in ignore_keys at the top level of data are not included."""
+        downloads = []
+        endpoints = []
+        api_url = self.__api_url
+        download_match = self.__download_regex.fullmatch
+        if isinstance(data, dict):
+            stack = [value for key, value in data.items() if key not in ignore_keys]
+        else:
+            stack = [data]
+        stack.reverse()
+        while stack:
+            value = stack.pop()
+            if isinstance(value, str):
+                if value.startswith('https://'):
+                    if download_match(value):
+                        downloads.append(value)
+                    elif value.startswith(api_url):
+                        endpoints.append(value[len(api_url):])
+                elif '<' in value:
+                    # rendered HTML (only files are taken from here, as API URLs in the
+                    # content are not valid endpoints)
+                    for url in _html_url_regex.findall(value):
+                        if download_match(url):
+                            downloads.append(url)
+            elif isinstance(value, dict):
+                stack.extend(reversed(list(value.values())))
+            elif isinstance(value, list):
+                stack.extend(reversed(value))
+        return downloads, endpoints
+
+
+# the page number in the query string of a "next" link
+_next_page_regex = re.compile(r'(?<=[?&])page=2(?=&|#|$)')
+
+def predict_pages(data):
+    """Returns the URLs of the pages of a paginated list that follow data['next'], if data
+    is the first page of a list that tells us how many items it has (otherwise returns an 
+    empty list). The URLs are the "next" link with only the page number changed, so are
+    identical to those that would be found by following the "next" links one at a time."""
+    page = data.get('page', None)
+    size = data.get('size', None)
+    pagelen = data.get('pagelen', None)
+    if page != 1 or not isinstance(size, int) or not isinstance(pagelen, int) or pagelen < 1:
+        return []
+    next_url = data.get('next', None)
+    # (lists that don't use page numbers, such as commits, can't be predicted)
+    if not isinstance(next_url, str) or len(_next_page_regex.findall(next_url)) != 1:
+        return []
+    last_page = -(-size // pagelen)
+    return [_next_page_regex.sub('page={}'.format(n), next_url) for n in range(3, last_page + 1)]
+
+
+# The lists whose values can be saved as the JSON of each item:
+#   (list endpoint, item endpoint, fields to request in addition to those in the list by default)
+# The endpoints are regular expressions, in which '{repo}' is replaced with
+# 'repositories/<owner>/<repository>'
+#
+# The API does not promise that the values of a list have every field of the item, so
+# before the values of a list are trusted, one item is requested separately and compared
+# with its value in the list (see ItemLists.check).
+_ITEM_LISTS = [
+    (r'{repo}/issues', r'{repo}/issues/\d+', None),
+    (r'{repo}/pullrequests', r'{repo}/pullrequests/\d+', '+values.description,+values.summary,+values.rendered,+values.participants,+values.reviewers'),
+    (r'{repo}/commits(?:/[^/]+)?', r'{repo}/commit/[0-9a-fA-F]+', None),
+]
+
+
+def missing_fields(value, item, prefix=''):
+    """Returns the fields (e.g. 'links.html') of item that are not in value"""
+    missing = []
+    if isinstance(item, dict):
+        if not isinstance(value, dict):
+            return [prefix.rstrip('.') or '.']
+        for key, child in item.items():
+            if key not in value:
+                missing.append(prefix + key)
+            else:
+                missing += missing_fields(value[key], child, prefix + key + '.')
+    elif isinstance(item, list) and isinstance(value, list):
+        for value_child, child in zip(value, item):
+            missing += missing_fields(value_child, child, prefix)
+    return missing
+
+
+class ItemLists(object):
+    def __init__(self, api_url, owner, repository):
+        self.__api_url = api_url
+        repo = re.escape('repositories/{}/{}'.format(owner, repository))
+        self.__lists = [
+            (re.compile(list_endpoint.format(repo=repo)), re.compile(item_endpoint.format(repo=repo)), fields)
+            for list_endpoint, item_endpoint, fields in _ITEM_LISTS
+        ]
+        # whether the values of each kind of list (by index in self.__lists) are complete items
+        # (None until checked)
+        self.__complete = [None]*len(self.__lists)
+
+    def __find(self, endpoint):
+        for i, (list_regex, _, _) in enumerate(self.__lists):
+            if list_regex.fullmatch(endpoint):
+                return i
+        return None
+
+    def complete(self, endpoint):
+        """Returns True if the values of the list at endpoint have been found to be complete
+        items, False if they have not, or None if this is not yet known"""
+        i = self.__find(endpoint)
+        return None if i is None else self.__complete[i]
+
+    def check(self, endpoint, value, item):
+        """Compares value (from the list at endpoint) with item (the JSON of the same item,
+        requested separately), and records whether the values of the list are complete items.
+        Returns the fields that are missing from value"""
+        missing = missing_fields(value, item)
+        i = self.__find(endpoint)
+        if i is not None:
+            self.__complete[i] = not missing
+        return missing
+
+    def rewrite_rules(self):
+        """Returns the URL rewrite rules (see rules.RewriteRules) that request the
+        extra fields needed for the values of each list to be complete items"""
+        return [
+            {
+                'endpoint_match': [re.compile('^(?:{})$'.format(list_regex.pattern))],
+                'rewrites': [
+                    {
+                        'params_match': {'fields': None},
+                        'params_to_update': {'fields': fields},
+                    },
+                ],
+            }
+            for list_regex, _, fields in self.__lists if fields is not None
+        ]
+
+    def items(self, endpoint, data):
+        """Returns a list of (URL, value) for each value in data (the parsed JSON of a
+        page of the list at endpoint) that is the JSON of the item at URL. The list is
+        empty if endpoint is not one of the lists with complete items (or its values
+        have been found to be incomplete, see check)."""
+        i = self.__find(endpoint)
+        if i is None or self.__complete[i] is False:
+            return []
+        item_regex = self.__lists[i][1]
+        values = data.get('values', None) if isinstance(data, dict) else None
+        if not isinstance(values, list):
+            return []
+        items = []
+        for value in values:
+            try:
+                url = value['links']['self']['href']
+            except (TypeError, KeyError):
+                continue
+            if isinstance(url, str) and url.startswith(self.__api_url) and item_regex.fullmatch(url[len(self.__api_url):]):
+                items.append((url, value))
+        return items
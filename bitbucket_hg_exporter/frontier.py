@@ -0,0 +1,177 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Persistent state of the crawl of a repository's BitBucket API data.
+#
+# The crawl builds a tree of every URL found (which is later used to rewrite
+# the URLs in the saved data) and a queue of URLs still to be processed (the
+# "frontier"). Both are kept in an SQLite database (in WAL mode, so that each
+# commit is cheap) as the crawl progresses, so that a crawl that is stopped
+# part way through can be resumed exactly where it stopped rather than by
+# reprocessing every JSON file saved so far.
+#
+# Each page is committed (in a single transaction) once all of the URLs found
+# in it have been added to the tree/frontier, and it has been removed from the
+# frontier. A URL that was taken from the frontier but not finished when the
+# crawl stopped is put back in the frontier when the crawl is resumed.
+
+import os
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER,
+    url TEXT NOT NULL,
+    rewritten_url TEXT NOT NULL,
+    endpoint_path TEXT NOT NULL,
+    already_processed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS frontier (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    parent INTEGER,
+    node INTEGER,
+    account TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS processed (
+    endpoint TEXT PRIMARY KEY,
+    profiles TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS profile_skipped (
+    endpoint TEXT PRIMARY KEY
+);
+"""
+
+
+class CrawlFrontier(object):
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__db = sqlite3.connect(path)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        # (a commit is not flushed to disk immediately, but the database can't be corrupted
+        # by a crash. At worst the last few pages are processed again on resume)
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.executescript(_SCHEMA)
+        # (the frontier of a crawl started by an older version has no account column)
+        if 'account' not in [row[1] for row in self.__db.execute('PRAGMA table_info(frontier)')]:
+            self.__db.execute('ALTER TABLE frontier ADD COLUMN account TEXT')
+        self.__db.commit()
+
+    def __get_state(self, key):
+        row = self.__db.execute('SELECT value FROM state WHERE key=?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def __set_state(self, key, value):
+        self.__db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    @property
+    def started(self):
+        return self.__get_state('started') is not None
+
+    @property
+    def complete(self):
+        return self.__get_state('complete') is not None
+
+    @property
+    def refresh(self):
+        """True if the crawl was started in order to refresh previously downloaded data"""
+        return self.__get_state('refresh') is not None
+
+    def start(self, root_url, refresh=False):
+        """Clears any previous crawl and starts a new one from root_url. Returns the
+        frontier id of root_url"""
+        self.__db.execute('DELETE FROM nodes')
+        self.__db.execute('DELETE FROM frontier')
+        self.__db.execute('DELETE FROM state')
+        self.__db.execute('DELETE FROM processed')
+        self.__db.execute('DELETE FROM profile_skipped')
+        self.__set_state('started', '1')
+        if refresh:
+            self.__set_state('refresh', '1')
+        frontier_id = self.push(root_url, None)
+        self.commit()
+        return frontier_id
+
+    def mark_complete(self):
+        self.__set_state('complete', '1')
+        self.commit()
+
+    def push(self, url, parent_id, account=None):
+        """Adds a URL (found in the node with id parent_id) to the frontier. account is the
+        username that must request the URL (if any)"""
+        return self.__db.execute('INSERT INTO frontier (url, parent, account) VALUES (?, ?, ?)', (url, parent_id, account)).lastrowid
+
+    def add_node(self, parent_id, node):
+        """Adds a node (a crawltree.Node) to the tree as a child of the node with id
+        parent_id, and sets node.id"""
+        node.id = self.__db.execute(
+            'INSERT INTO nodes (parent, url, rewritten_url, endpoint_path, already_processed) VALUES (?, ?, ?, ?, ?)',
+            (parent_id, node.url, node.rewritten_url, node.endpoint_path, int(node.already_processed))
+        ).lastrowid
+        return node.id
+
+    def claim(self, frontier_id, node_id):
+        """Records that the URL in the frontier is being processed as node_id"""
+        self.__db.execute('UPDATE frontier SET node=? WHERE id=?', (node_id, frontier_id))
+
+    def done(self, frontier_id):
+        """Removes a URL that has been processed from the frontier"""
+        self.__db.execute('DELETE FROM frontier WHERE id=?', (frontier_id,))
+
+    def add_processed(self, endpoint, profiles):
+        """Records an endpoint that was processed, and the crawl profiles that would have skipped it
+        (an endpoint claimed again after a resume is only recorded once)"""
+        self.__db.execute('INSERT OR IGNORE INTO processed (endpoint, profiles) VALUES (?, ?)', (endpoint, ' '.join(profiles)))
+
+    def processed(self):
+        """Returns the number of endpoints processed by the crawl (including any previous runs
+        that it resumes), and a dictionary of the number each crawl profile would have skipped"""
+        total = 0
+        skipped = {}
+        for (profiles,) in self.__db.execute('SELECT profiles FROM processed'):
+            total += 1
+            for name in profiles.split():
+                skipped[name] = skipped.get(name, 0) + 1
+        return total, skipped
+
+    def add_profile_skipped(self, endpoint):
+        """Records an endpoint that was skipped because of the crawl profile"""
+        self.__db.execute('INSERT OR IGNORE INTO profile_skipped (endpoint) VALUES (?)', (endpoint,))
+
+    def profile_skipped(self):
+        """Returns the number of endpoints skipped because of the crawl profile"""
+        return self.__db.execute('SELECT COUNT(*) FROM profile_skipped').fetchone()[0]
+
+    def commit(self):
+        self.__db.commit()
+
+    def load(self, tree):
+        """Adds the saved nodes to tree (an empty crawltree.CrawlTree). Returns a dictionary 
+        of the nodes (by id) and the frontier (a list of (url, parent node, frontier id, account)
+        in the order they were added) as they were when last committed. URLs that were being 
+        processed are put back in the frontier."""
+        self.__db.execute('DELETE FROM nodes WHERE id IN (SELECT node FROM frontier WHERE node IS NOT NULL)')
+        self.__db.execute('UPDATE frontier SET node=NULL WHERE node IS NOT NULL')
+        self.commit()
+
+        nodes = {}
+        for node_id, parent_id, url, rewritten_url, endpoint_path, already_processed in self.__db.execute('SELECT id, parent, url, rewritten_url, endpoint_path, already_processed FROM nodes ORDER BY id'):
+            parent = nodes[parent_id] if parent_id is not None else None
+            nodes[node_id] = tree.add(parent, url, rewritten_url, endpoint_path, bool(already_processed), node_id)
+
+        pending = [(url, nodes[parent_id] if parent_id is not None else None, frontier_id, account) for frontier_id, url, parent_id, account in self.__db.execute('SELECT id, url, parent, account FROM frontier ORDER BY id')]
+        return nodes, pending
+
+    def close(self):
+        self.__db.close()
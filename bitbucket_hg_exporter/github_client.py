@@ -0,0 +1,187 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# A client for the GitHub API that keeps us within GitHub's rate limits.
+#
+# GitHub has a primary rate limit (a number of requests per hour, reported in
+# the X-RateLimit-* headers) and secondary rate limits (which lock out clients
+# that make too many requests concurrently, or create content too quickly).
+# Hitting a secondary limit during a large migration can stall it for a long
+# time, so this client:
+#
+#   * sends requests through the pooled session for the credentials (see sessions.py)
+#   * waits for a permit from the token bucket for the credentials (see ratelimit.py),
+#     which is kept in step with the X-RateLimit-* headers
+#   * sends requests that create or modify content (POST/PATCH/PUT/DELETE) one at a
+#     time, at least MUTATING_REQUEST_INTERVAL seconds apart, for each set of credentials
+#   * waits (for as long as GitHub asks via Retry-After or X-RateLimit-Reset) and then
+#     retries if a request is refused because of a rate limit
+#   * records the latency, size and number of retries of each request (see telemetry.py)
+
+import random
+import threading
+import time
+
+import requests
+
+from . import backoff
+from . import ratelimit
+from . import sessions
+from . import telemetry
+
+GITHUB_API_URL = 'https://api.github.com/'
+
+# GitHub recommends waiting at least one second between requests that create content
+MUTATING_REQUEST_INTERVAL = 1.0
+MUTATING_METHODS = ('POST', 'PATCH', 'PUT', 'DELETE')
+
+# How long to wait after hitting a secondary rate limit that does not include a
+# Retry-After header (doubled for each consecutive time it happens)
+SECONDARY_LIMIT_WAIT = 60
+SECONDARY_LIMIT_MAX_WAIT = 60*15
+
+
+class _MutationPacer(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last_request = None
+
+_pacers = {}
+_pacers_lock = threading.Lock()
+
+def _get_pacer(auth):
+    key = auth[0] if auth else None
+    with _pacers_lock:
+        if key not in _pacers:
+            _pacers[key] = _MutationPacer()
+        return _pacers[key]
+
+
+def is_rate_limited(response):
+    """Returns 'primary', 'secondary' or None depending on whether GitHub refused
+    the request due to a rate limit"""
+    if response.status_code not in (403, 429):
+        return None
+    if response.headers.get('X-RateLimit-Remaining', None) == '0':
+        return 'primary'
+    if 'Retry-After' in response.headers:
+        return 'secondary'
+    try:
+        message = response.json().get('message', '').lower()
+    except (ValueError, AttributeError):
+        message = ''
+    if 'secondary rate limit' in message or 'abuse' in message:
+        return 'secondary'
+    if response.status_code == 429:
+        return 'primary'
+    return None
+
+
+class GitHubClient(object):
+    def __init__(self, auth, headers=None, abort_event=None):
+        self.auth = auth
+        self.headers = headers or {}
+        self.abort_event = abort_event
+        self.__bucket = ratelimit.get_bucket('github', auth)
+        self.__pacer = _get_pacer(auth)
+
+    def __check_abort(self):
+        if self.abort_event is not None and self.abort_event.is_set():
+            raise RuntimeError('Raising exception so that the thread ends sooner')
+
+    def __wait(self, seconds):
+        if not backoff.wait(seconds, self.abort_event):
+            raise RuntimeError('Raising exception so that the thread ends sooner')
+
+    def __send(self, method, url, kwargs):
+        # Returns the response, the time spent waiting to send the request and the time
+        # taken by the request
+        start = time.perf_counter()
+        if not self.__bucket.acquire(self.abort_event):
+            raise RuntimeError('Raising exception so that the thread ends sooner')
+        # (there is no need to space out requests that are not rate limited, e.g. when replaying them)
+        if method not in MUTATING_METHODS or isinstance(self.__bucket, ratelimit.UnlimitedBucket):
+            rate_limit_wait = time.perf_counter() - start
+            start = time.perf_counter()
+            response = sessions.request('github', self.auth, method, url, **kwargs)
+            return response, rate_limit_wait, time.perf_counter() - start
+        with self.__pacer.lock:
+            if self.__pacer.last_request is not None:
+                wait = self.__pacer.last_request + MUTATING_REQUEST_INTERVAL - backoff.clock()
+                if wait > 0:
+                    self.__wait(wait)
+            rate_limit_wait = time.perf_counter() - start
+            start = time.perf_counter()
+            try:
+                response = sessions.request('github', self.auth, method, url, **kwargs)
+            finally:
+                self.__pacer.last_request = backoff.clock()
+            return response, rate_limit_wait, time.perf_counter() - start
+
+    def request(self, method, url, **kwargs):
+        """Make a request to the GitHub API, retrying if it is refused due to a
+        rate limit. url can be a full URL or an endpoint relative to the API root."""
+        method = method.upper()
+        if not url.startswith('https://') and not url.startswith('http://'):
+            url = GITHUB_API_URL + url
+        headers = dict(self.headers)
+        headers.update(kwargs.pop('headers', None) or {})
+        kwargs['headers'] = headers
+
+        secondary_limit_count = 0
+        retries = 0
+        total_rate_limit_wait = 0
+        connection_backoff = backoff.Backoff(base=5, cap=300, abort_event=self.abort_event)
+        while True:
+            self.__check_abort()
+            try:
+                response, rate_limit_wait, latency = self.__send(method, url, kwargs)
+                total_rate_limit_wait += rate_limit_wait
+            except (requests.exceptions.SSLError, requests.exceptions.ConnectionError):
+                # Only retry requests that do not modify anything, as we can't tell whether
+                # GitHub acted on the original request
+                if method in MUTATING_METHODS:
+                    raise
+                retries += 1
+                wait = connection_backoff.delay()
+                print('Could not connect to the GitHub API. Will retry in {:.0f} seconds...'.format(wait))
+                connection_backoff.wait(wait)
+                continue
+            self.__bucket.update(response.headers)
+
+            limit = is_rate_limited(response)
+            if limit is None:
+                telemetry.record('github', url, latency, response.status_code, len(response.content), retries, total_rate_limit_wait)
+                return response
+            retries += 1
+            retry_after = ratelimit.get_retry_after(response.headers)
+            if limit == 'secondary':
+                secondary_limit_count += 1
+                if retry_after is None:
+                    retry_after = min(SECONDARY_LIMIT_WAIT*2**(secondary_limit_count-1), SECONDARY_LIMIT_MAX_WAIT)
+                # (spread out the retries of threads that hit the limit at the same time)
+                retry_after += random.uniform(0, 1)
+            # Stop every thread using these credentials until we are allowed to continue.
+            # (for the primary limit, the bucket already knows when the limit resets)
+            wait = self.__bucket.penalise(retry_after)
+            print('GitHub API {} rate limit exceeded. Will retry in {:.0f} seconds...'.format(limit, wait))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
@@ -24,9 +24,14 @@ import logging
 import datetime
 import argparse
 
-import requests
 import dateutil.parser
 
+try:
+    from . import sessions
+except ImportError:
+    # this file is being run as a script
+    import sessions
+
 class memoize(object):
     def __init__(self):
         self.cache = {}
@@ -60,7 +65,7 @@ def get_bb_username(user, try_with_braces=False):
     if try_with_braces:
         user = '{'+user+'}'
     base_user_api_url = "https://bitbucket.org/api/2.0/users/"
-    res = requests.get(base_user_api_url + user)
+    res = sessions.request('bitbucket', None, 'GET', base_user_api_url + user)
     if res.status_code == 200 or res.status_code == 304:
         #logging.debug("user @%s is exist in BB.", user)
         return res.json()
@@ -11,13 +11,14 @@ import copy
 import json
 import os
 import re
-import time
 import urllib.parse
 
 import pprint
-import requests
 import questionary as q
 
+from . import backoff
+from .github_client import GitHubClient
+
 SEP = "-" * 40
 
 ISSUE_TEMPLATE = """\
@@ -47,7 +48,7 @@ class Options(object):
 #   * assignee requires the user be a collaborator, so is disabled for now
 #####
 
-def import_issues_to_github(bb_repo, gh_repo, gh_auth, settings, mapping, dry_run=True):
+def import_issues_to_github(bb_repo, gh_repo, gh_auth, settings, mapping, dry_run=True, abort_event=None):
     options = Options()
     options.bitbucket_repo = bb_repo
     options.github_repo = gh_repo
@@ -55,12 +56,14 @@ def import_issues_to_github(bb_repo, gh_repo, gh_auth, settings, mapping, dry_ru
     options.settings = settings
     options.mapping = mapping
     options.dry_run = dry_run
+    # (this client waits if GitHub's rate limits are reached)
+    github = GitHubClient(gh_auth, abort_event=abort_event)
 
     # check that there are no issues/pullrequests on GitHub for this repository. If there are,
     # we should abort as we can't yet handle this case!
     offset = 0
     if not options.dry_run:
-        response = requests.get('https://api.github.com/search/issues?q=repo:{}+sort:author-date-desc&sort=created&order=desc'.format(options.github_repo), auth=options.gh_auth)
+        response = github.get('https://api.github.com/search/issues?q=repo:{}+sort:author-date-desc&sort=created&order=desc'.format(options.github_repo))
         if response.status_code == 200:
             data = response.json()
             if len(data['items']) != 0:
@@ -83,7 +86,7 @@ def import_issues_to_github(bb_repo, gh_repo, gh_auth, settings, mapping, dry_ru
 
     # GitHub's Import API currently requires a special header
     headers = {'Accept': 'application/vnd.github.golden-comet-preview+json'}
-    gh_milestones = GithubMilestones(options.github_repo, options.gh_auth, headers)
+    gh_milestones = GithubMilestones(options.github_repo, github, headers)
     
     issues_iterator = fill_gaps(get_issues(options))
 
@@ -109,7 +112,7 @@ def import_issues_to_github(bb_repo, gh_repo, gh_auth, settings, mapping, dry_ru
         else:
             push_respo = push_github_issue(
                 gh_issue, gh_comments, options.github_repo,
-                options.gh_auth, headers
+                github, headers
             )
             # issue POSTed successfully, now verify the import finished before
             # continuing. Otherwise, we risk issue IDs not being sync'd between
@@ -120,7 +123,7 @@ def import_issues_to_github(bb_repo, gh_repo, gh_auth, settings, mapping, dry_ru
             # https://github.com/jeffwidman/bitbucket-issue-migration/issues/45
             status_url = push_respo.json()['url']
             resp = verify_github_issue_import_finished(
-                status_url, options.gh_auth, headers)
+                status_url, github, headers)
 
             # Verify GH & BB issue IDs match.
             # If this assertion fails, convert_links() will have incorrect
@@ -415,7 +418,7 @@ def format_change_element(change_type, change, options):
     else:
         return None
 
-def push_github_issue(issue, comments, github_repo, auth, headers):
+def push_github_issue(issue, comments, github_repo, github, headers):
     """
     Push a single issue to GitHub.
     Importing via GitHub's normal Issue API quickly triggers anti-abuse rate
@@ -426,7 +429,7 @@ def push_github_issue(issue, comments, github_repo, auth, headers):
     issue_data = {'issue': issue, 'comments': comments}
     url = 'https://api.github.com/repos/{repo}/import/issues'.format(
         repo=github_repo)
-    respo = requests.post(url, json=issue_data, auth=auth, headers=headers)
+    respo = github.post(url, json=issue_data, headers=headers)
     if respo.status_code == 202:
         return respo
     elif respo.status_code == 422:
@@ -440,14 +443,14 @@ def push_github_issue(issue, comments, github_repo, auth, headers):
             .format(issue['title'], respo.status_code)
         )
 
-def verify_github_issue_import_finished(status_url, auth, headers):
+def verify_github_issue_import_finished(status_url, github, headers):
     """
     Check the status of a GitHub issue import.
     If the status is 'pending', it sleeps, then rechecks until the status is
     either 'imported' or 'failed'.
     """
     while True:  # keep checking until status is something other than 'pending'
-        respo = requests.get(status_url, auth=auth, headers=headers)
+        respo = github.get(status_url, headers=headers)
         if respo.status_code in (403, 404):
             print(respo.status_code, "retrieving status URL", status_url)
             respo.status_code == 404 and print(
@@ -466,7 +469,8 @@ def verify_github_issue_import_finished(status_url, auth, headers):
         status = respo.json()['status']
         if status != 'pending':
             break
-        time.sleep(1)
+        if not backoff.wait(1, github.abort_event):
+            raise RuntimeError('Raising exception so that the thread ends sooner')
     if status == 'imported':
         print("Imported Issue:", respo.json()['issue_url'])
     elif status == 'failed':
@@ -492,11 +496,10 @@ class GithubMilestones(object):
     Github number for the milestone is returned.
     """
 
-    def __init__(self, repo, auth, headers):
+    def __init__(self, repo, github, headers):
         self.url = 'https://api.github.com/repos/{repo}/milestones'.format(repo=repo)
-        self.session = requests.Session()
-        self.session.auth = auth
-        self.session.headers.update(headers)
+        self.github = github
+        self.headers = headers
         self.refresh()
 
     def refresh(self):
@@ -506,14 +509,14 @@ class GithubMilestones(object):
         milestones = {}
         url = self.url + "?state=all"
         while url:
-            respo = self.session.get(url)
+            respo = self.github.get(url, headers=self.headers)
             if respo.status_code != 200:
                 raise RuntimeError(
                     "Failed to get milestones due to HTTP status code: {}".format(
                     respo.status_code))
             for m in respo.json():
                 milestones[m['title']] = m['number']
-            url = respo.links.get("next")
+            url = respo.links.get("next", {}).get("url")
         return milestones
 
     def ensure(self, title):
@@ -524,7 +527,7 @@ class GithubMilestones(object):
         return number
 
     def create(self, title):
-        respo = self.session.post(self.url, json={"title": title})
+        respo = self.github.post(self.url, json={"title": title}, headers=self.headers)
         if respo.status_code != 201:
             raise RuntimeError(
                 "Failed to get milestones due to HTTP status code: {}".format(
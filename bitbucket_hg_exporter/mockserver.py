@@ -0,0 +1,728 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# A local stand-in for the BitBucket 2.0 API (and the parts of the GitHub API
+# used to import issues).
+#
+# The server generates a synthetic repository whose size is set by the number
+# of issues, pull requests, commits and comments per item. The data is
+# generated on demand (rather than stored) so very large repositories can be
+# simulated. Latency and rate limiting (429) responses can be injected to see
+# how the exporter copes with them.
+#
+# All links in the generated data point to the real hosts (api.bitbucket.org,
+# api.github.com, etc). Requests are sent to this server by redirecting those
+# hosts with sessions.redirect_hosts(), and the server uses the Host header to
+# work out which service is being asked for. This means the exporter saves the
+# data in exactly the same place it would for a real repository.
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import threading
+import time
+from urllib import parse
+
+BITBUCKET_API_HOST = 'api.bitbucket.org'
+GITHUB_API_HOST = 'api.github.com'
+# hosts that files (images, avatars, etc) are downloaded from
+ASSET_HOSTS = ['bitbucket.org', 'bytebucket.org', 'secure.gravatar.com']
+# all hosts served by the mock server
+MOCKED_HOSTS = [BITBUCKET_API_HOST, GITHUB_API_HOST] + ASSET_HOSTS
+
+_API = 'https://{}/2.0/'.format(BITBUCKET_API_HOST)
+_START_DATE = datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc)
+
+ISSUE_STATES = ['new', 'open', 'resolved', 'on hold', 'invalid', 'duplicate', 'wontfix', 'closed']
+ISSUE_PRIORITIES = ['trivial', 'minor', 'major', 'critical', 'blocker']
+ISSUE_KINDS = ['bug', 'enhancement', 'proposal', 'task']
+PULL_REQUEST_STATES = ['MERGED', 'OPEN', 'DECLINED', 'SUPERSEDED']
+# fields of a pull request that (like the real API) are left out of the list of pull
+# requests unless asked for with a partial response, e.g. fields=+values.description
+PULL_REQUEST_LIST_OMITTED_FIELDS = ['description', 'summary', 'rendered', 'participants', 'reviewers']
+
+
+def _date(hours):
+    return (_START_DATE + datetime.timedelta(hours=hours)).isoformat()
+
+def _href(url):
+    return {'href': url}
+
+
+class MockDataset(object):
+    """Synthetic data for a single BitBucket repository.
+
+    Everything is derived from the index of each item so the same arguments
+    always produce the same data.
+    """
+
+    def __init__(self, owner='mock-owner', repository='mock-repo', issues=100, pull_requests=20, commits=200, comments=3, users=20):
+        self.owner = owner
+        self.repository = repository
+        self.num_issues = issues
+        self.num_pull_requests = pull_requests
+        self.num_commits = commits
+        self.comments = comments
+        self.num_users = max(users, 1)
+        self.repo_url = _API + 'repositories/{}/{}'.format(owner, repository)
+        self.__commit_hashes = [hashlib.sha1('{}/{}:{}'.format(owner, repository, i).encode('utf-8')).hexdigest() for i in range(commits)]
+        self.__commit_indices = {h: i for i, h in enumerate(self.__commit_hashes)}
+
+    def __num_comments(self, index):
+        # vary the number of comments per item, but keep the average at self.comments
+        return (index*7) % (2*self.comments + 1)
+
+    def user(self, index):
+        index = index % self.num_users
+        nickname = 'user{}'.format(index)
+        uuid = '{{{}}}'.format(hashlib.md5(nickname.encode('utf-8')).hexdigest())
+        return {
+            'display_name': 'Mock User {}'.format(index),
+            'nickname': nickname,
+            'account_id': '5555:{}'.format(index),
+            'uuid': uuid,
+            'type': 'user',
+            'links': {
+                'self': _href(_API + 'users/' + parse.quote(uuid)),
+                'html': _href('https://bitbucket.org/' + parse.quote(uuid) + '/'),
+                'avatar': _href('https://secure.gravatar.com/avatar/{}?d=identicon'.format(hashlib.md5(nickname.encode('utf-8')).hexdigest())),
+            },
+        }
+
+    def repository_data(self):
+        links = {name: _href(self.repo_url + '/' + name) for name in ['watchers', 'commits', 'forks', 'hooks', 'pullrequests', 'issues', 'downloads', 'milestones', 'components', 'versions']}
+        links.update({
+            'self': _href(self.repo_url),
+            'html': _href('https://bitbucket.org/{}/{}'.format(self.owner, self.repository)),
+            'branches': _href(self.repo_url + '/refs/branches'),
+            'tags': _href(self.repo_url + '/refs/tags'),
+            'source': _href(self.repo_url + '/src'),
+            'clone': [{'href': 'https://bitbucket.org/{}/{}'.format(self.owner, self.repository), 'name': 'https'}],
+        })
+        return {
+            'type': 'repository',
+            'scm': 'hg',
+            'name': self.repository,
+            'full_name': '{}/{}'.format(self.owner, self.repository),
+            'uuid': '{{{}}}'.format(hashlib.md5(self.repo_url.encode('utf-8')).hexdigest()),
+            'owner': self.user(0),
+            'is_private': False,
+            'has_issues': self.num_issues > 0,
+            'has_wiki': False,
+            'description': 'Synthetic repository used for benchmarking',
+            'created_on': _date(0),
+            'updated_on': _date(24*365),
+            'mainbranch': {'type': 'named_branch', 'name': 'default'},
+            'links': links,
+        }
+
+    # Issues
+    def issue(self, issue_id):
+        url = self.repo_url + '/issues/{}'.format(issue_id)
+        html = '<p>Description of issue {}</p>'.format(issue_id)
+        if issue_id % 4 == 0:
+            html += '<p><img alt="" src="https://bitbucket.org/repo/mock/images/{}-screenshot.png" /></p>'.format(issue_id % 10)
+        return {
+            'type': 'issue',
+            'id': issue_id,
+            'title': 'Issue number {}'.format(issue_id),
+            'state': ISSUE_STATES[issue_id % len(ISSUE_STATES)],
+            'priority': ISSUE_PRIORITIES[issue_id % len(ISSUE_PRIORITIES)],
+            'kind': ISSUE_KINDS[issue_id % len(ISSUE_KINDS)],
+            'component': {'name': 'component {}'.format(issue_id % 3)} if issue_id % 2 else None,
+            'version': None,
+            'milestone': {'name': 'milestone {}'.format(issue_id % 2)} if issue_id % 5 == 0 else None,
+            'reporter': self.user(issue_id),
+            'assignee': self.user(issue_id + 1) if issue_id % 3 == 0 else None,
+            'created_on': _date(issue_id),
+            'updated_on': _date(issue_id + 1),
+            'edited_on': None,
+            'votes': 0,
+            'watches': 1,
+            'content': {'raw': 'Description of issue {}'.format(issue_id), 'markup': 'markdown', 'html': html, 'type': 'rendered'},
+            'repository': {'full_name': '{}/{}'.format(self.owner, self.repository), 'type': 'repository', 'links': {'self': _href(self.repo_url)}},
+            'links': {
+                'self': _href(url),
+                'html': _href('https://bitbucket.org/{}/{}/issues/{}'.format(self.owner, self.repository, issue_id)),
+                'comments': _href(url + '/comments'),
+                'attachments': _href(url + '/attachments'),
+                'watch': _href(url + '/watch'),
+                'vote': _href(url + '/vote'),
+            },
+        }
+
+    def issue_comment(self, issue_id, comment_id):
+        url = self.repo_url + '/issues/{}/comments/{}'.format(issue_id, comment_id)
+        return {
+            'type': 'issue_comment',
+            'id': comment_id,
+            'created_on': _date(issue_id + comment_id % 1000),
+            'updated_on': None,
+            'user': self.user(comment_id),
+            'content': {'raw': 'Comment {} on issue {}'.format(comment_id, issue_id), 'markup': 'markdown', 'html': '<p>Comment</p>', 'type': 'rendered'},
+            'issue': {'id': issue_id, 'type': 'issue', 'links': {'self': _href(self.repo_url + '/issues/{}'.format(issue_id))}},
+            'links': {
+                'self': _href(url),
+                'html': _href('https://bitbucket.org/{}/{}/issues/{}#comment-{}'.format(self.owner, self.repository, issue_id, comment_id)),
+            },
+        }
+
+    def issue_comment_ids(self, issue_id):
+        return [issue_id*1000 + j for j in range(self.__num_comments(issue_id))]
+
+    def issue_change(self, issue_id, change_id):
+        # BitBucket gives a change the same ID as the comment made with it
+        state = self.issue(issue_id)['state']
+        return {
+            'type': 'issue_change',
+            'id': change_id,
+            'name': 'change',
+            'created_on': _date(issue_id + change_id % 1000),
+            'user': self.user(change_id),
+            'issue': {'id': issue_id, 'type': 'issue', 'links': {'self': _href(self.repo_url + '/issues/{}'.format(issue_id))}},
+            'changes': {'state': {'old': 'new', 'new': state}},
+            'message': {'raw': 'Comment {} on issue {}'.format(change_id, issue_id), 'markup': 'markdown', 'html': '<p>Comment</p>', 'type': 'rendered'},
+            'links': {
+                'self': _href(self.repo_url + '/issues/{}/changes/{}'.format(issue_id, change_id)),
+                'issue': _href(self.repo_url + '/issues/{}'.format(issue_id)),
+            },
+        }
+
+    def issue_change_ids(self, issue_id):
+        return self.issue_comment_ids(issue_id)[::2]
+
+    def issue_attachment_names(self, issue_id):
+        if issue_id % 5:
+            return []
+        return ['attachment-{}.txt'.format(issue_id)]
+
+    def issue_attachment(self, issue_id, name):
+        return {
+            'type': 'issue_attachment',
+            'name': name,
+            'links': {'self': _href(self.repo_url + '/issues/{}/attachments/{}'.format(issue_id, name))},
+        }
+
+    # Commits
+    def commit_hash(self, index):
+        return self.__commit_hashes[index]
+
+    def commit_index(self, commit_hash):
+        return self.__commit_indices.get(commit_hash, None)
+
+    def commit(self, index):
+        commit_hash = self.__commit_hashes[index]
+        url = self.repo_url + '/commit/' + commit_hash
+        parents = []
+        if index > 0:
+            parent_hash = self.__commit_hashes[index - 1]
+            parents.append({'hash': parent_hash, 'type': 'commit', 'links': {'self': _href(self.repo_url + '/commit/' + parent_hash)}})
+        return {
+            'type': 'commit',
+            'hash': commit_hash,
+            'date': _date(index),
+            'message': 'Commit message {}\n'.format(index),
+            'author': {'type': 'author', 'raw': 'Mock User <user@example.com>', 'user': self.user(index)},
+            'parents': parents,
+            'repository': {'full_name': '{}/{}'.format(self.owner, self.repository), 'type': 'repository', 'links': {'self': _href(self.repo_url)}},
+            'links': {
+                'self': _href(url),
+                'html': _href('https://bitbucket.org/{}/{}/commits/{}'.format(self.owner, self.repository, commit_hash)),
+                'comments': _href(url + '/comments'),
+                'approve': _href(url + '/approve'),
+                'statuses': _href(url + '/statuses'),
+                'diff': _href(self.repo_url + '/diff/' + commit_hash),
+                'patch': _href(self.repo_url + '/patch/' + commit_hash),
+                'diffstat': _href(self.repo_url + '/diffstat/' + commit_hash),
+            },
+        }
+
+    def commit_comment_ids(self, index):
+        # only some commits have comments
+        if index % 10:
+            return []
+        return [index*1000 + j for j in range(self.__num_comments(index))]
+
+    def commit_comment(self, index, comment_id):
+        commit_hash = self.__commit_hashes[index]
+        return {
+            'type': 'commit_comment',
+            'id': comment_id,
+            'created_on': _date(index + 1),
+            'user': self.user(comment_id),
+            'content': {'raw': 'Comment on commit', 'markup': 'markdown', 'html': '<p>Comment on commit</p>', 'type': 'rendered'},
+            'commit': {'hash': commit_hash, 'type': 'commit', 'links': {'self': _href(self.repo_url + '/commit/' + commit_hash)}},
+            'links': {'self': _href(self.repo_url + '/commit/{}/comments/{}'.format(commit_hash, comment_id))},
+        }
+
+    def diffstat(self, commit_hash):
+        return [{
+            'type': 'diffstat',
+            'status': 'modified',
+            'lines_added': 3,
+            'lines_removed': 1,
+            'old': {'path': 'file{}.py'.format(j), 'type': 'commit_file', 'links': {'self': _href(self.repo_url + '/src/{}/file{}.py'.format(commit_hash, j))}},
+            'new': {'path': 'file{}.py'.format(j), 'type': 'commit_file', 'links': {'self': _href(self.repo_url + '/src/{}/file{}.py'.format(commit_hash, j))}},
+        } for j in range(int(commit_hash[:2], 16) % 4 + 1)]
+
+    # Pull requests
+    def __pull_request_commits(self, pr_id):
+        if not self.num_commits:
+            return []
+        start = (pr_id*3) % self.num_commits
+        return list(range(start, min(start + 3, self.num_commits)))
+
+    def pull_request(self, pr_id):
+        url = self.repo_url + '/pullrequests/{}'.format(pr_id)
+        commits = self.__pull_request_commits(pr_id)
+        source_hash = self.__commit_hashes[commits[-1]] if commits else '0'*40
+        destination_hash = self.__commit_hashes[commits[0]] if commits else '0'*40
+        repo = {'full_name': '{}/{}'.format(self.owner, self.repository), 'type': 'repository', 'links': {'self': _href(self.repo_url)}}
+        return {
+            'type': 'pullrequest',
+            'id': pr_id,
+            'title': 'Pull request {}'.format(pr_id),
+            'description': 'Description of pull request {}'.format(pr_id),
+            'state': PULL_REQUEST_STATES[pr_id % len(PULL_REQUEST_STATES)],
+            'author': self.user(pr_id),
+            'created_on': _date(pr_id),
+            'updated_on': _date(pr_id + 2),
+            'comment_count': self.__num_comments(pr_id),
+            'task_count': 0,
+            'close_source_branch': False,
+            'reason': '',
+            'reviewers': [],
+            'participants': [{'type': 'participant', 'role': 'PARTICIPANT', 'approved': False, 'user': self.user(pr_id + 1)}],
+            'source': {'branch': {'name': 'feature-{}'.format(pr_id)}, 'commit': {'hash': source_hash[:12], 'type': 'commit', 'links': {'self': _href(self.repo_url + '/commit/' + source_hash)}}, 'repository': repo},
+            'destination': {'branch': {'name': 'default'}, 'commit': {'hash': destination_hash[:12], 'type': 'commit', 'links': {'self': _href(self.repo_url + '/commit/' + destination_hash)}}, 'repository': repo},
+            'merge_commit': None,
+            'closed_by': None,
+            'links': {
+                'self': _href(url),
+                'html': _href('https://bitbucket.org/{}/{}/pull-requests/{}'.format(self.owner, self.repository, pr_id)),
+                'comments': _href(url + '/comments'),
+                'activity': _href(url + '/activity'),
+                'commits': _href(url + '/commits'),
+                'statuses': _href(url + '/statuses'),
+                'approve': _href(url + '/approve'),
+                'decline': _href(url + '/decline'),
+                'merge': _href(url + '/merge'),
+                'diff': _href(self.repo_url + '/diff/{}..{}'.format(source_hash[:12], destination_hash[:12])),
+                'diffstat': _href(self.repo_url + '/diffstat/' + source_hash),
+            },
+        }
+
+    def pull_request_comment_ids(self, pr_id):
+        return [pr_id*1000 + j for j in range(self.__num_comments(pr_id))]
+
+    def pull_request_comment(self, pr_id, comment_id):
+        return {
+            'type': 'pullrequest_comment',
+            'id': comment_id,
+            'created_on': _date(pr_id + comment_id % 1000),
+            'updated_on': _date(pr_id + comment_id % 1000),
+            'user': self.user(comment_id),
+            'deleted': False,
+            'content': {'raw': 'Comment {} on pull request {}'.format(comment_id, pr_id), 'markup': 'markdown', 'html': '<p>Comment</p>', 'type': 'rendered'},
+            'pullrequest': {'id': pr_id, 'type': 'pullrequest', 'links': {'self': _href(self.repo_url + '/pullrequests/{}'.format(pr_id))}},
+            'links': {'self': _href(self.repo_url + '/pullrequests/{}/comments/{}'.format(pr_id, comment_id))},
+        }
+
+    def pull_request_activity(self, pr_id):
+        pr = {'id': pr_id, 'title': 'Pull request {}'.format(pr_id), 'type': 'pullrequest', 'links': {'self': _href(self.repo_url + '/pullrequests/{}'.format(pr_id))}}
+        activity = [{'update': {'state': 'OPEN', 'author': self.user(pr_id), 'date': _date(pr_id), 'title': pr['title']}, 'pull_request': pr}]
+        for comment_id in self.pull_request_comment_ids(pr_id):
+            activity.append({'comment': self.pull_request_comment(pr_id, comment_id), 'pull_request': pr})
+        return activity
+
+    def pull_request_commits(self, pr_id):
+        return [self.commit(index) for index in self.__pull_request_commits(pr_id)]
+
+    def pull_request_ids(self, states):
+        return [pr_id for pr_id in range(1, self.num_pull_requests + 1) if PULL_REQUEST_STATES[pr_id % len(PULL_REQUEST_STATES)] in states]
+
+    # Other
+    def milestone(self, index):
+        return {'type': 'milestone', 'id': index, 'name': 'milestone {}'.format(index), 'links': {'self': _href(self.repo_url + '/milestones/{}'.format(index))}}
+
+    def component(self, index):
+        return {'type': 'component', 'id': index, 'name': 'component {}'.format(index), 'links': {'self': _href(self.repo_url + '/components/{}'.format(index))}}
+
+    def asset(self, url):
+        # Some bytes that look like a PNG file
+        digest = hashlib.sha256(url.encode('utf-8')).digest()
+        return b'\x89PNG\r\n\x1a\n' + digest*64
+
+
+class MockGitHub(object):
+    """The parts of the GitHub API used to import repositories and issues"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__imports = {}
+        self.__issue_numbers = {}
+        self.__milestones = {}
+
+    def __next_number(self, repo):
+        self.__issue_numbers[repo] = self.__issue_numbers.get(repo, 0) + 1
+        return self.__issue_numbers[repo]
+
+    def handle(self, method, parts, params, body):
+        # returns (status code, JSON data)
+        with self.__lock:
+            if parts == ['user']:
+                return 200, {'login': 'mock-github-user', 'id': 1, 'type': 'User'}
+            if parts == ['search', 'issues']:
+                return 200, {'total_count': 0, 'incomplete_results': False, 'items': []}
+            if len(parts) < 3 or parts[0] != 'repos':
+                return 404, {'message': 'Not Found'}
+            repo = '{}/{}'.format(parts[1], parts[2])
+            repo_url = 'https://{}/repos/{}'.format(GITHUB_API_HOST, repo)
+            rest = parts[3:]
+            if rest == []:
+                return 200, {'full_name': repo, 'name': parts[2], 'owner': {'login': parts[1]}, 'url': repo_url}
+            if rest == ['import']:
+                # source import
+                if method == 'PUT':
+                    return 201, {'status': 'importing', 'url': repo_url + '/import'}
+                if method in ('GET', 'PATCH'):
+                    return 200, {'status': 'complete', 'url': repo_url + '/import'}
+                if method == 'DELETE':
+                    return 204, None
+            if rest == ['import', 'issues'] and method == 'POST':
+                number = self.__next_number(repo)
+                import_id = len(self.__imports) + 1
+                self.__imports[import_id] = number
+                return 202, {'id': import_id, 'status': 'pending', 'url': repo_url + '/import/issues/{}'.format(import_id)}
+            if len(rest) == 3 and rest[:2] == ['import', 'issues'] and method == 'GET':
+                number = self.__imports.get(int(rest[2]), None)
+                if number is None:
+                    return 404, {'message': 'Not Found'}
+                return 200, {'id': int(rest[2]), 'status': 'imported', 'issue_url': repo_url + '/issues/{}'.format(number)}
+            if rest == ['milestones']:
+                milestones = self.__milestones.setdefault(repo, [])
+                if method == 'POST':
+                    milestone = {'title': body['title'], 'number': len(milestones) + 1}
+                    milestones.append(milestone)
+                    return 201, milestone
+                return 200, milestones
+            return 404, {'message': 'Not Found'}
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    # keep connections alive (as the real APIs do) so that connection reuse can be measured
+    protocol_version = 'HTTP/1.1'
+    # the headers and body are written separately, so don't let Nagle's algorithm delay the body
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.mock.handle(self)
+
+    do_POST = do_GET
+    do_PUT = do_GET
+    do_PATCH = do_GET
+    do_DELETE = do_GET
+
+
+class MockServer(object):
+    def __init__(self, dataset=None, latency=0, rate_limit_every=0, retry_after=1, host='127.0.0.1', port=0):
+        self.dataset = dataset if dataset is not None else MockDataset()
+        self.github = MockGitHub()
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.__lock = threading.Lock()
+        self.__num_requests = 0
+        self.__num_api_requests = 0
+        self.__num_rate_limited = 0
+        self.__bytes_sent = 0
+        self.__httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.__httpd.daemon_threads = True
+        self.__httpd.mock = self
+        self.__thread = None
+
+    @property
+    def url(self):
+        host, port = self.__httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__httpd.serve_forever, name='mock API server', daemon=True)
+        self.__thread.start()
+        return self.url
+
+    def stop(self):
+        self.__httpd.shutdown()
+        self.__httpd.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def redirects(self):
+        """Returns the dictionary to pass to sessions.redirect_hosts()"""
+        return {host: self.url for host in MOCKED_HOSTS}
+
+    def statistics(self):
+        with self.__lock:
+            return {
+                'requests': self.__num_requests,
+                'bytes': self.__bytes_sent,
+                'rate_limited': self.__num_rate_limited,
+            }
+
+    def handle(self, handler):
+        host = handler.headers.get('Host', BITBUCKET_API_HOST).split(':')[0]
+        if host not in MOCKED_HOSTS:
+            # requests made directly to the mock server are for the BitBucket API
+            host = BITBUCKET_API_HOST
+        split_url = parse.urlsplit(handler.path)
+        params = parse.parse_qs(split_url.query)
+        body = None
+        length = int(handler.headers.get('Content-Length', 0) or 0)
+        if length:
+            try:
+                body = json.loads(handler.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                body = None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        headers = {}
+        rate_limited = False
+        with self.__lock:
+            self.__num_requests += 1
+            if host in (BITBUCKET_API_HOST, GITHUB_API_HOST):
+                self.__num_api_requests += 1
+                if self.rate_limit_every and self.__num_api_requests % self.rate_limit_every == 0:
+                    self.__num_rate_limited += 1
+                    rate_limited = True
+
+        if rate_limited:
+            status, content_type = 429, 'application/json'
+            content = json.dumps({'type': 'error', 'error': {'message': 'Rate limit for this resource has been exceeded'}}).encode('utf-8')
+            if self.retry_after is not None:
+                headers['Retry-After'] = str(self.retry_after)
+        elif host == BITBUCKET_API_HOST:
+            status, data = self.__bitbucket(split_url.path, params)
+            content, content_type = self.__encode(data)
+        elif host == GITHUB_API_HOST:
+            status, data = self.github.handle(handler.command, [p for p in split_url.path.split('/') if p], params, body)
+            content, content_type = self.__encode(data)
+            headers.update({'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4999', 'X-RateLimit-Reset': str(int(time.time()) + 3600)})
+        else:
+            status, content_type = 200, 'image/png'
+            content = self.dataset.asset('https://{}{}'.format(host, handler.path))
+
+        if status == 200 and content:
+            etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+            headers['ETag'] = etag
+            if handler.headers.get('If-None-Match', None) == etag:
+                status, content = 304, b''
+        if status == 204:
+            content = b''
+
+        handler.send_response(status)
+        if content or status not in (204, 304):
+            handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.wfile.write(content)
+        with self.__lock:
+            self.__bytes_sent += len(content)
+
+    def __encode(self, data):
+        if data is None:
+            return b'', 'application/json'
+        if isinstance(data, bytes):
+            return data, 'application/octet-stream'
+        return json.dumps(data).encode('utf-8'), 'application/json'
+
+    def __page(self, url, params, items, max_pagelen=100, default_pagelen=10):
+        # items is a list of IDs/indices and the value of each item is built by the caller
+        try:
+            pagelen = min(int(params.get('pagelen', [default_pagelen])[0]), max_pagelen)
+            page = int(params.get('page', [1])[0])
+        except ValueError:
+            return None
+        pagelen = max(pagelen, 1)
+        values = items[(page - 1)*pagelen:page*pagelen]
+        data = {'pagelen': pagelen, 'size': len(items), 'page': page, 'values': values}
+        for name, other_page in (('next', page + 1), ('previous', page - 1)):
+            if other_page < 1 or (other_page - 1)*pagelen >= len(items):
+                continue
+            other_params = dict(params)
+            other_params['page'] = [str(other_page)]
+            data[name] = url + '?' + parse.urlencode(other_params, doseq=True)
+        return data
+
+    def __bitbucket(self, path, params):
+        d = self.dataset
+        parts = [parse.unquote(p) for p in path.split('/') if p]
+        if parts[:1] != ['2.0']:
+            return 404, {'type': 'error', 'error': {'message': 'Resource not found'}}
+        parts = parts[1:]
+        not_found = (404, {'type': 'error', 'error': {'message': 'Resource not found'}})
+        if parts == ['user']:
+            return 200, d.user(0)
+        if parts[:1] == ['users'] and len(parts) == 2:
+            return 200, d.user(0)
+        if parts[:3] != ['repositories', d.owner, d.repository]:
+            return not_found
+        parts = parts[3:]
+        url = d.repo_url + ('/' + '/'.join(parts) if parts else '')
+
+        def page(ids, build, max_pagelen=100, default_pagelen=10):
+            data = self.__page(url, params, ids, max_pagelen, default_pagelen)
+            if data is None:
+                return 400, {'type': 'error', 'error': {'message': 'Invalid page'}}
+            data['values'] = [build(i) for i in data['values']]
+            return 200, data
+
+        def requested_fields():
+            # the fields of each value added to a list with the partial response syntax
+            fields = set()
+            for value in params.get('fields', []):
+                for field in value.split(','):
+                    if field.startswith('+values.'):
+                        fields.add(field[len('+values.'):])
+            return fields
+
+        def as_int(value):
+            try:
+                return int(value)
+            except ValueError:
+                return None
+
+        if not parts:
+            return 200, d.repository_data()
+        section = parts[0]
+        if section == 'issues':
+            if len(parts) == 1:
+                return page(list(range(1, d.num_issues + 1)), d.issue, max_pagelen=100)
+            issue_id = as_int(parts[1])
+            if issue_id is None or not 1 <= issue_id <= d.num_issues:
+                return not_found
+            if len(parts) == 2:
+                return 200, d.issue(issue_id)
+            if parts[2] == 'comments':
+                ids = d.issue_comment_ids(issue_id)
+                if len(parts) == 3:
+                    return page(ids, lambda comment_id: d.issue_comment(issue_id, comment_id))
+                if len(parts) == 4 and as_int(parts[3]) in ids:
+                    return 200, d.issue_comment(issue_id, int(parts[3]))
+            if parts[2] == 'changes':
+                ids = d.issue_change_ids(issue_id)
+                if len(parts) == 3:
+                    return page(ids, lambda change_id: d.issue_change(issue_id, change_id))
+                if len(parts) == 4 and as_int(parts[3]) in ids:
+                    return 200, d.issue_change(issue_id, int(parts[3]))
+            if parts[2] == 'attachments':
+                names = d.issue_attachment_names(issue_id)
+                if len(parts) == 3:
+                    return page(names, lambda name: d.issue_attachment(issue_id, name))
+                if len(parts) == 4 and parts[3] in names:
+                    return 200, 'Contents of {}\n'.format(parts[3]).encode('utf-8')
+            return not_found
+        if section == 'pullrequests':
+            if len(parts) == 1:
+                states = params.get('state', ['OPEN'])
+                omitted = [field for field in PULL_REQUEST_LIST_OMITTED_FIELDS if field not in requested_fields()]
+                def build(pr_id):
+                    data = d.pull_request(pr_id)
+                    for field in omitted:
+                        data.pop(field, None)
+                    return data
+                return page(d.pull_request_ids(states), build, max_pagelen=50)
+            pr_id = as_int(parts[1])
+            if pr_id is None or not 1 <= pr_id <= d.num_pull_requests:
+                return not_found
+            if len(parts) == 2:
+                return 200, d.pull_request(pr_id)
+            if parts[2] == 'comments':
+                ids = d.pull_request_comment_ids(pr_id)
+                if len(parts) == 3:
+                    return page(ids, lambda comment_id: d.pull_request_comment(pr_id, comment_id))
+                if len(parts) == 4 and as_int(parts[3]) in ids:
+                    return 200, d.pull_request_comment(pr_id, int(parts[3]))
+            if parts[2] == 'activity' and len(parts) == 3:
+                activity = d.pull_request_activity(pr_id)
+                return page(list(range(len(activity))), lambda i: activity[i], max_pagelen=50)
+            if parts[2] == 'commits' and len(parts) == 3:
+                commits = d.pull_request_commits(pr_id)
+                return page(list(range(len(commits))), lambda i: commits[i])
+            if parts[2] == 'statuses' and len(parts) == 3:
+                return page([], None)
+            return not_found
+        if section == 'commits':
+            return page(list(range(d.num_commits - 1, -1, -1)), d.commit)
+        if section == 'commit' and len(parts) >= 2:
+            index = d.commit_index(parts[1])
+            if index is None:
+                return not_found
+            if len(parts) == 2:
+                return 200, d.commit(index)
+            if parts[2] == 'comments':
+                ids = d.commit_comment_ids(index)
+                if len(parts) == 3:
+                    return page(ids, lambda comment_id: d.commit_comment(index, comment_id))
+                if len(parts) == 4 and as_int(parts[3]) in ids:
+                    return 200, d.commit_comment(index, int(parts[3]))
+            if parts[2] == 'statuses' and len(parts) == 3:
+                return page([], None)
+            return not_found
+        if section == 'diffstat' and len(parts) == 2:
+            diffstat = d.diffstat(parts[1])
+            return page(list(range(len(diffstat))), lambda i: diffstat[i], max_pagelen=5000, default_pagelen=500)
+        if section in ('milestones', 'components'):
+            ids, build = ([0, 1], d.milestone) if section == 'milestones' else ([0, 1, 2], d.component)
+            if len(parts) == 1:
+                return page(ids, build)
+            if len(parts) == 2 and as_int(parts[1]) in ids:
+                return 200, build(int(parts[1]))
+        if section in ('versions', 'forks', 'watchers') and len(parts) == 1:
+            return page([], None)
+        if section == 'refs' and parts[1:] == ['tags']:
+            return page([], None)
+        return not_found
+
+
+def main():
+    p = argparse.ArgumentParser(description='Serve a synthetic BitBucket repository (and mock GitHub issue import API). Point a client at it by sending the original Host header (see sessions.redirect_hosts).')
+    p.add_argument('--port', type=int, default=8000)
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--owner', default='mock-owner')
+    p.add_argument('--repository', default='mock-repo')
+    p.add_argument('--issues', type=int, default=100)
+    p.add_argument('--pull-requests', type=int, default=20)
+    p.add_argument('--commits', type=int, default=200)
+    p.add_argument('--comments', type=int, default=3, help='Average number of comments on each issue/pull request')
+    p.add_argument('--latency', type=float, default=0, help='Seconds to wait before responding to each request')
+    p.add_argument('--rate-limit-every', type=int, default=0, help='Respond to every Nth API request with a 429 (0 to disable)')
+    p.add_argument('--retry-after', type=int, default=1, help='Value of the Retry-After header sent with 429 responses')
+    arguments = p.parse_args()
+
+    dataset = MockDataset(arguments.owner, arguments.repository, arguments.issues, arguments.pull_requests, arguments.commits, arguments.comments)
+    server = MockServer(dataset, arguments.latency, arguments.rate_limit_every, arguments.retry_after, arguments.host, arguments.port)
+    print('Serving {}/{} on {}'.format(arguments.owner, arguments.repository, server.url))
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
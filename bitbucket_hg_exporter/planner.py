@@ -0,0 +1,278 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Estimates the cost of exporting a repository before it is crawled.
+#
+# Rather than crawling the whole of a repository's API data, the estimate
+# follows the same links as the crawl (using the same ignore rules) but only
+# requests the first page of each list. The number of items in a list is taken
+# from its "size" field, and the cost of each item (its own JSON and the lists
+# it links to, such as comments) is measured for the first few items and scaled
+# up to the whole list.
+#
+# Lists without a size (such as commits) are counted by paging through a
+# minimal partial response, but only for up to COUNT_PAGES pages (so that the
+# estimate does not use API quota in proportion to the length of the history).
+# Beyond that, the number of items is extrapolated from the dates of those
+# counted back to when the repository was created, or if that is not possible,
+# the estimate is reported as a lower bound.
+#
+# The result is an estimate: items vary, and anything the crawl would find
+# beyond MAX_DEPTH links from the repository is not counted.
+
+import datetime
+import json
+import re
+
+# number of items of each list whose linked data is requested to estimate the cost of every item
+SAMPLES = 3
+
+# how many links from the repository JSON the estimate follows
+MAX_DEPTH = 4
+
+# the partial response requested when paging through a list only to count its items
+COUNT_FIELDS = 'next,values.date'
+
+# the number of pages (after the first) of a list without a size that are requested to count its items
+COUNT_PAGES = 3
+
+# IDs and commit hashes in an endpoint, which are replaced to get the kind of endpoint
+_id_regex = re.compile(r'/(?:\d+|[0-9a-fA-F]{12,40})(?=/|$)')
+
+
+def parse_date(value):
+    """Returns the time (in seconds since the epoch) of a date in the API data, or None"""
+    if not isinstance(value, str):
+        return None
+    try:
+        date = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def endpoint_template(endpoint):
+    """Returns endpoint with the IDs/hashes replaced, e.g. 'repositories/o/r/issues/{id}/comments'"""
+    return _id_regex.sub('/{id}', endpoint)
+
+
+class Cost(object):
+    __slots__ = ('requests', 'bytes')
+
+    def __init__(self, requests=0, bytes=0):
+        self.requests = requests
+        self.bytes = bytes
+
+    def __add__(self, other):
+        return Cost(self.requests + other.requests, self.bytes + other.bytes)
+
+    def __mul__(self, factor):
+        return Cost(self.requests*factor, self.bytes*factor)
+
+
+class RepositoryEstimate(object):
+    def __init__(self, full_name):
+        self.full_name = full_name
+        # the cost of the crawl of the API data
+        self.cost = Cost()
+        # size (in bytes) of the Mercurial repository reported by BitBucket
+        self.repository_size = 0
+        # number of items in each of the lists linked to from the repository JSON (by endpoint)
+        self.list_sizes = {}
+        # the lists (as in list_sizes) whose sizes were extrapolated from the dates of their items
+        self.extrapolated = set()
+        # True if some lists were only partly counted, so the cost is more than estimated
+        self.lower_bound = False
+
+
+class RepositoryPlanner(object):
+    """Estimates the number of API requests (and bytes of JSON) needed to crawl a repository.
+
+    fetch(endpoint, params=None) must return the parsed JSON (or None) and the number of bytes
+    of the response for the URL the crawl would request for endpoint (relative to api_url).
+    follows(endpoint) must return True if the crawl would follow the endpoint.
+    synthesised(endpoint, value) must return True if the value (an item in the list at endpoint)
+    is saved from the list rather than requested (see discover.ItemLists).
+    """
+
+    def __init__(self, api_url, owner, repository, url_scanner, fetch, follows, synthesised=None, samples=SAMPLES):
+        self.__api_url = api_url
+        self.__repo = 'repositories/{}/{}'.format(owner, repository)
+        self.__url_scanner = url_scanner
+        self.__fetch = fetch
+        self.__follows = follows
+        self.__synthesised = synthesised or (lambda endpoint, value: False)
+        self.__samples = max(samples, 1)
+        # (the crawl adds the changes of each issue, as nothing links to them)
+        self.__issue_regex = re.compile(r'{}/issues/\d+$'.format(re.escape(self.__repo)))
+        self.__seen = set()
+        # the kinds of endpoint that are items of a list, and the kind of list they belong to
+        # (they are counted with that list, rather than wherever else they are found)
+        self.__item_templates = {}
+
+    def plan(self):
+        """Returns a RepositoryEstimate"""
+        estimate = RepositoryEstimate(self.__repo[len('repositories/'):])
+        self.__estimate = estimate
+        self.__seen.add(self.__repo)
+        data, nbytes = self.__fetch(self.__repo)
+        self.__created_on = None
+        if isinstance(data, dict):
+            if isinstance(data.get('size', None), int):
+                estimate.repository_size = data['size']
+            self.__created_on = parse_date(data.get('created_on', None))
+        estimate.cost = Cost(1, nbytes) + self.__children(self.__repo, data, 1)
+        return estimate
+
+    def __children(self, endpoint, data, depth):
+        # The cost of the (not yet counted) API endpoints referenced in data
+        if data is None or depth > MAX_DEPTH:
+            return Cost()
+        _, endpoints = self.__url_scanner.scan(data)
+        if self.__issue_regex.match(endpoint):
+            endpoints.append(endpoint + '/changes')
+        children = []
+        for child in endpoints:
+            child = child.split('?')[0]
+            if child in self.__seen or endpoint_template(child) in self.__item_templates or not self.__follows(child):
+                continue
+            self.__seen.add(child)
+            children.append(child)
+        # Request all of the children before following them, so that the lists among them are
+        # known (and their items are not counted a second time when linked from each other)
+        fetched = []
+        for child in children:
+            child_data, nbytes = self.__fetch(child)
+            if isinstance(child_data, dict) and isinstance(child_data.get('values', None), list):
+                for value in child_data['values'][:1]:
+                    item = self.__item_endpoint(value)
+                    if item is not None:
+                        self.__item_templates.setdefault(endpoint_template(item), endpoint_template(child))
+            fetched.append((child, child_data, nbytes))
+        cost = Cost()
+        for child, child_data, nbytes in fetched:
+            if isinstance(child_data, dict) and isinstance(child_data.get('values', None), list):
+                cost += self.__list(child, child_data, nbytes, depth)
+            else:
+                cost += Cost(1, nbytes) + self.__children(child, child_data, depth + 1)
+        return cost
+
+    def __item_endpoint(self, value):
+        try:
+            url = value['links']['self']['href']
+        except (TypeError, KeyError):
+            return None
+        if not isinstance(url, str) or not url.startswith(self.__api_url):
+            return None
+        return url[len(self.__api_url):].split('?')[0]
+
+    def __list(self, endpoint, data, nbytes, depth):
+        # The cost of all of the pages of a list (given its first page) and of its items
+        values = data['values']
+        size = data.get('size', None)
+        pagelen = data.get('pagelen', None)
+        if isinstance(size, int) and isinstance(pagelen, int) and pagelen > 0:
+            pages = max(-(-size // pagelen), 1)
+            list_bytes = nbytes*size/len(values) if values else nbytes
+        else:
+            size, pages, counted = self.__count(data)
+            list_bytes = nbytes*pages
+            if counted == 'extrapolated' and depth == 1:
+                self.__estimate.extrapolated.add(endpoint[len(self.__repo) + 1:])
+            elif counted == 'partly':
+                self.__estimate.lower_bound = True
+        if depth == 1:
+            self.__estimate.list_sizes[endpoint[len(self.__repo) + 1:]] = size
+        cost = Cost(pages, list_bytes)
+        sample = values[:self.__samples]
+        if sample and size:
+            per_item = Cost()
+            for value in sample:
+                per_item += self.__item(endpoint, value, depth + 1)
+            cost += per_item*(size/len(sample))
+        return cost
+
+    def __item(self, list_endpoint, value, depth):
+        # The cost of an item in a list (its own JSON, unless it is saved from the list, and
+        # everything it links to)
+        cost = Cost()
+        item = self.__item_endpoint(value)
+        if item is not None and self.__item_templates.get(endpoint_template(item), None) not in (None, endpoint_template(list_endpoint)):
+            # (e.g. the commits of a pull request) counted with the list of every item of its kind
+            return cost
+        if item is not None and item not in self.__seen and self.__follows(item):
+            self.__seen.add(item)
+            # (an item saved from the list takes up the same space, but needs no request)
+            cost += Cost(0 if self.__synthesised(list_endpoint, value) else 1, len(json.dumps(value)))
+        return cost + self.__children(item if item is not None else list_endpoint, value, depth)
+
+    def __count(self, data):
+        # Returns the number of items and pages of a list without a size, and whether they were
+        # counted ('fully'), 'extrapolated' or only 'partly' counted. The "next" links are followed
+        # (asking only for the fields needed) for up to COUNT_PAGES pages
+        pagelen = max(len(data['values']), 1)
+        size = len(data['values'])
+        pages = 1
+        dates = [parse_date(value.get('date', None)) for value in data['values'][:1] if isinstance(value, dict)]
+        next_url = data.get('next', None)
+        while isinstance(next_url, str) and next_url.startswith(self.__api_url):
+            if pages > COUNT_PAGES:
+                break
+            page, _ = self.__fetch(next_url[len(self.__api_url):], {'fields': COUNT_FIELDS})
+            if not isinstance(page, dict):
+                break
+            values = page.get('values', [])
+            pages += 1
+            size += len(values)
+            if values and isinstance(values[-1], dict):
+                dates.append(parse_date(values[-1].get('date', None)))
+            next_url = page.get('next', None)
+        else:
+            return size, pages, 'fully'
+
+        # There are more pages. Assuming items are added at the same rate as those counted
+        # (the list is newest first), extrapolate back to when the repository was created
+        newest, oldest = (dates[0], dates[-1]) if dates else (None, None)
+        if None in (newest, oldest, self.__created_on) or newest <= oldest:
+            return size, pages, 'partly'
+        remaining = size*max(oldest - self.__created_on, 0)/(newest - oldest)
+        size += int(remaining)
+        return size, pages + -(-int(remaining) // pagelen), 'extrapolated'
+
+
+def hours_needed(requests, rates, latency, concurrency=1):
+    """Returns the hours needed to make the requests when shared between accounts with the
+    given rate limits (in requests per hour), each making up to concurrency requests at once
+    (each of which takes latency seconds)"""
+    throughput = 0
+    for rate in rates:
+        if latency > 0:
+            rate = min(rate, concurrency*3600.0/latency)
+        throughput += rate
+    if throughput <= 0:
+        return float('inf')
+    return requests/throughput
+
+
+def format_bytes(size):
+    for unit in ['bytes', 'kB', 'MB', 'GB']:
+        if size < 1024 or unit == 'GB':
+            return '{:.0f} {}'.format(size, unit) if unit == 'bytes' else '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+
+
+def format_hours(hours):
+    if hours == float('inf'):
+        return 'never'
+    if hours < 1:
+        return '{:.0f} minutes'.format(hours*60)
+    if hours < 48:
+        return '{:.1f} hours'.format(hours)
+    return '{:.1f} days'.format(hours/24)
@@ -0,0 +1,73 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Crawl profiles, which select the parts of a repository's BitBucket API data
+# that are downloaded.
+#
+# Some families of API endpoints (in particular the JSON for each commit) can
+# make up most of the requests needed to export a repository. A profile is a
+# list of the endpoint families to skip, each of which expands into ignore
+# rules (see rules.py) that are added to those always used by the crawl.
+
+from collections import OrderedDict
+
+# Ignore rules for each family of endpoints. '{repo}' is replaced with
+# 'repositories/<owner>/<repository>'
+ENDPOINT_FAMILIES = {
+    # the list of commits and the JSON (and comments, statuses, ...) of each commit
+    'commits': [
+        {'type': 'startswith', 'not': False, 'string': '{repo}/commits'},
+        {'type': 'startswith', 'not': False, 'string': '{repo}/commit/'},
+    ],
+    'statuses': [
+        {'type': 'endswith', 'not': False, 'string': '/statuses'},
+    ],
+    'diffstat': [
+        {'type': 'startswith', 'not': False, 'string': '{repo}/diffstat/'},
+        {'type': 'endswith', 'not': False, 'string': '/diffstat'},
+    ],
+    'pull_request_activity': [
+        {'type': 'startswith', 'not': False, 'string': '{repo}/pullrequests/activity'},
+        {'type': 'endswith', 'not': False, 'string': '/activity'},
+    ],
+    'watchers': [
+        {'type': 'startswith', 'not': False, 'string': '{repo}/watchers'},
+    ],
+    'pull_requests': [
+        {'type': 'startswith', 'not': False, 'string': '{repo}/pullrequests'},
+    ],
+}
+
+# The endpoint families skipped by each profile (from the least to the most data downloaded)
+PROFILES = OrderedDict([
+    ('issues-only', ['commits', 'statuses', 'diffstat', 'pull_request_activity', 'watchers', 'pull_requests']),
+    ('issues+PRs', ['commits', 'statuses', 'diffstat', 'pull_request_activity', 'watchers']),
+    ('full', []),
+])
+
+DEFAULT_PROFILE = 'full'
+
+DESCRIPTIONS = {
+    'issues-only': 'Issues only (no pull requests, commits, diffstats or watchers)',
+    'issues+PRs': 'Issues and pull requests (no commits, statuses, diffstats, pull request activity or watchers)',
+    'full': 'Everything',
+}
+
+
+def ignore_rules(profile, owner, repository):
+    """Returns the ignore rules that the profile adds to the crawl of a repository"""
+    if profile not in PROFILES:
+        raise RuntimeError('Unknown crawl profile "{}"'.format(profile))
+    repo = 'repositories/{}/{}'.format(owner, repository)
+    expanded = []
+    for family in PROFILES[profile]:
+        for rule in ENDPOINT_FAMILIES[family]:
+            rule = dict(rule)
+            rule['string'] = rule['string'].format(repo=repo)
+            expanded.append(rule)
+    return expanded
@@ -0,0 +1,268 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# A token bucket rate limiter per (service, username) pair.
+#
+# Rather than each thread discovering the API limit by hitting 429 responses
+# (and then sleeping for a fixed amount of time), every request must first
+# acquire a permit from the limiter belonging to the credentials it uses. The
+# limiter refills at a rate that keeps the account just under its quota, and
+# adjusts that rate using the rate limit headers returned by BitBucket and
+# GitHub.
+
+import email.utils
+import threading
+import time
+
+from . import backoff
+
+# Requests per hour allowed by each service when it does not tell us otherwise
+DEFAULT_REQUESTS_PER_HOUR = {
+    'bitbucket': 1000,
+    'github': 5000,
+    # Files are downloaded (without credentials) as fast as possible, and only held
+    # back when a host responds with a 429. Applies to each 'downloads/<host>' service
+    'downloads': 10**9,
+}
+
+# Fraction of the quota that we leave unused so that we stay just under it
+SAFETY_MARGIN = 0.02
+
+# Slowest rate (in requests per second) we will back off to after repeated 429 responses
+MIN_RATE = 1.0/60
+
+
+def _get_header(headers, name):
+    value = headers.get(name, None)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def get_retry_after(headers):
+    """Returns the number of seconds requested by a Retry-After header (or None)"""
+    value = headers.get('Retry-After', None)
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        pass
+    # Retry-After may also be a HTTP date
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket(object):
+    def __init__(self, requests_per_hour):
+        self.__lock = threading.Lock()
+        self.__max_rate = requests_per_hour*(1-SAFETY_MARGIN)/3600.0
+        self.__capacity = requests_per_hour*(1-SAFETY_MARGIN)
+        self.__rate = self.__max_rate
+        self.__tokens = self.__capacity
+        self.__last_refill = backoff.clock()
+        self.__blocked_until = 0
+        # time (on backoff.clock()) at which the service has told us our quota resets
+        self.__reset_at = None
+
+    @property
+    def rate(self):
+        """Current refill rate in requests per hour"""
+        return self.__rate*3600
+
+    def __refill(self, now):
+        if self.__reset_at is not None and now >= self.__reset_at:
+            # a new quota window has started
+            self.__reset_at = None
+            self.__tokens = self.__capacity
+            self.__rate = self.__max_rate
+        elapsed = now - self.__last_refill
+        if elapsed > 0:
+            self.__tokens = min(self.__capacity, self.__tokens + elapsed*self.__rate)
+            self.__last_refill = now
+
+    def acquire(self, abort_event=None):
+        """Block until a request is permitted.
+
+        Returns False if the abort_event was set while waiting, True otherwise.
+        """
+        while True:
+            with self.__lock:
+                now = backoff.clock()
+                self.__refill(now)
+                if now >= self.__blocked_until and self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return True
+                if now < self.__blocked_until:
+                    wait = self.__blocked_until - now
+                else:
+                    wait = (1 - self.__tokens)/self.__rate
+            # wait in slices of at most 1 second so that changes to the limits made
+            # by other threads (and a system hibernate) are picked up promptly
+            if not backoff.wait(min(max(wait, 0.001), 1), abort_event):
+                return False
+
+    def wait_time(self):
+        """Returns how long (in seconds) a request would have to wait for a permit"""
+        with self.__lock:
+            now = backoff.clock()
+            self.__refill(now)
+            if now < self.__blocked_until:
+                return self.__blocked_until - now
+            if self.__tokens >= 1:
+                return 0
+            return (1 - self.__tokens)/self.__rate
+
+    def update(self, headers):
+        """Adjust the limiter based on the rate limit headers of a response"""
+        limit = _get_header(headers, 'X-RateLimit-Limit')
+        remaining = _get_header(headers, 'X-RateLimit-Remaining')
+        reset = _get_header(headers, 'X-RateLimit-Reset')
+        near_limit = headers.get('X-RateLimit-NearLimit', '').lower() == 'true'
+
+        with self.__lock:
+            now = backoff.clock()
+            self.__refill(now)
+            if limit is not None and limit > 0:
+                self.__capacity = limit*(1-SAFETY_MARGIN)
+                self.__max_rate = self.__capacity/3600.0
+            margin = SAFETY_MARGIN*self.__capacity
+            if remaining is None and near_limit:
+                # BitBucket tells us when less than 20% of the quota remains
+                remaining = 0.2*self.__capacity
+            if remaining is not None:
+                self.__tokens = min(self.__tokens, max(remaining - margin, 0))
+                if reset is not None:
+                    # GitHub tells us when the quota resets, so spread the remaining
+                    # requests evenly until then
+                    time_left = max(reset - time.time(), 1)
+                    self.__reset_at = now + time_left
+                    if remaining <= margin:
+                        self.__blocked_until = max(self.__blocked_until, now + time_left)
+                    self.__rate = max(min((remaining - margin)/time_left, self.__max_rate), MIN_RATE)
+                    return
+            # gently recover from any previous back off
+            self.__rate = min(self.__max_rate, self.__rate + self.__max_rate*0.05)
+
+    def penalise(self, retry_after=None, slow_down=False):
+        """Called when the API refuses a request due to rate limiting. Blocks requests for
+        retry_after seconds (if given), and halves the request rate if we don't know when
+        we can try again (or slow_down is True)"""
+        with self.__lock:
+            now = backoff.clock()
+            self.__tokens = 0
+            self.__last_refill = now
+            if retry_after is not None:
+                self.__blocked_until = max(self.__blocked_until, now + retry_after)
+                # the bucket refills from the end of the block, so the waiting threads resume
+                # one at a time (at the request rate) rather than all at once
+                self.__last_refill = self.__blocked_until
+            if retry_after is None or slow_down:
+                self.__rate = max(self.__rate/2, MIN_RATE)
+            return max(self.__blocked_until - now, 1/self.__rate)
+
+
+class UnlimitedBucket(object):
+    """A limiter that permits every request (e.g. when replaying recorded responses, whose
+    rate limit headers do not apply)"""
+
+    rate = float('inf')
+
+    def acquire(self, abort_event=None):
+        return abort_event is None or not abort_event.is_set()
+
+    def wait_time(self):
+        return 0
+
+    def update(self, headers):
+        pass
+
+    def penalise(self, retry_after=None, slow_down=False):
+        return 0
+
+
+class RateLimiter(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__buckets = {}
+        self.__requests_per_hour = dict(DEFAULT_REQUESTS_PER_HOUR)
+
+    def configure(self, service, requests_per_hour):
+        """Sets the requests per hour allowed for service (None for no limit)"""
+        with self.__lock:
+            self.__requests_per_hour[service] = requests_per_hour
+            # drop existing buckets for this service so they are recreated with the new limit
+            for key in [key for key in self.__buckets if key[0] == service]:
+                del self.__buckets[key]
+
+    def get_bucket(self, service, auth=None):
+        key = (service, auth[0] if auth else None)
+        with self.__lock:
+            bucket = self.__buckets.get(key, None)
+            if bucket is None:
+                requests_per_hour = self.__requests_per_hour.get(service, self.__requests_per_hour.get(service.split('/')[0], 3600))
+                bucket = UnlimitedBucket() if requests_per_hour is None else TokenBucket(requests_per_hour)
+                self.__buckets[key] = bucket
+            return bucket
+
+
+class CredentialPool(object):
+    """Shares requests to a service between several sets of credentials (each of which 
+    has its own quota). Each request is given the credentials that will be permitted 
+    to make a request soonest (and that have the fewest requests in progress)"""
+
+    def __init__(self, service, credentials_list):
+        self.__service = service
+        self.__credentials = list(credentials_list)
+        self.__in_progress = [0 for _ in self.__credentials]
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__credentials)
+
+    def find(self, username):
+        """Returns the credentials for username (or None if they are not in the pool)"""
+        for credentials in self.__credentials:
+            if credentials[0] == username:
+                return credentials
+        return None
+
+    def acquire(self, credentials=None):
+        """Returns the credentials to use for the next request (which will be credentials,
+        if specified). Must be followed by a call to release() once the request is complete"""
+        if len(self.__credentials) == 1:
+            return self.__credentials[0]
+        with self.__lock:
+            if credentials is not None:
+                i = self.__credentials.index(credentials)
+            else:
+                # (the buckets are looked up each time as they are recreated by configure())
+                wait_times = [get_bucket(self.__service, c).wait_time() for c in self.__credentials]
+                i = min(range(len(self.__credentials)), key=lambda i: (wait_times[i], self.__in_progress[i]))
+            self.__in_progress[i] += 1
+            return self.__credentials[i]
+
+    def release(self, credentials):
+        if len(self.__credentials) == 1:
+            return
+        with self.__lock:
+            self.__in_progress[self.__credentials.index(credentials)] -= 1
+
+
+# The default limiter used by the rest of the package
+_default_limiter = RateLimiter()
+
+def configure(service, requests_per_hour):
+    _default_limiter.configure(service, requests_per_hour)
+
+def get_bucket(service, auth=None):
+    return _default_limiter.get_bucket(service, auth)
@@ -0,0 +1,138 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Rules that control which URLs are followed when crawling the BitBucket API.
+#
+# Rules are written as a list of dictionaries, for example:
+#
+#     {'type': 'startswith', 'not': False, 'string': 'repositories/owner/repo/hooks'}
+#
+# where 'type' is one of 'in', 'startswith' or 'endswith'. A URL is ignored if
+# it matches any of the rules (or, for rules with 'not' set to True, if it does
+# not match). The rules are compiled into a single regular expression so that
+# each URL is checked with one call, no matter how many rules there are.
+
+import copy
+import re
+
+
+# The pattern (following the start of the URL) that each type of rule looks for
+_PATTERNS = {
+    'in': '.*(?:{})',
+    'startswith': '(?:{})',
+    'endswith': r'.*(?:{})\Z',
+}
+
+def _compile(rules):
+    # Rules of the same type are combined into a single alternation (so that, for example, 
+    # the URL is only scanned once for all of the 'in' rules). Each type is a lookahead
+    # from the start of the URL, negated for the rules with 'not' set.
+    strings = {}
+    for rule in rules:
+        if rule['type'] not in _PATTERNS:
+            raise RuntimeError('Unknown ignore rule type "{}"'.format(rule['type']))
+        strings.setdefault((rule['type'], bool(rule['not'])), []).append(re.escape(rule['string']))
+    alternatives = []
+    for (rule_type, negated), rule_strings in strings.items():
+        if negated:
+            # a URL is ignored if it fails to match any one of these rules
+            for string in rule_strings:
+                alternatives.append('(?!{})'.format(_PATTERNS[rule_type].format(string)))
+        else:
+            alternatives.append('(?={})'.format(_PATTERNS[rule_type].format('|'.join(rule_strings))))
+    return re.compile('|'.join(alternatives), re.DOTALL)
+
+
+class IgnoreMatcher(object):
+    def __init__(self, rules):
+        self.rules = list(rules)
+        if self.rules:
+            self.__regex = _compile(self.rules)
+        else:
+            self.__regex = None
+
+    def matches(self, url):
+        """Returns True if the URL should be ignored"""
+        if self.__regex is None:
+            return False
+        return self.__regex.match(url) is not None
+
+
+class RewriteRules(object):
+    """Rules that modify the query parameters of the URLs we request (for example, to
+    request the maximum number of items per page). Each rule is a dictionary:
+
+        {
+            'endpoint_match': [<endpoint string or compiled regex>, ...],
+            'rewrites': [{'params_match': {...}, 'params_to_update': {...}}, ...],
+        }
+
+    A rule applies to an endpoint that is equal to one of the strings (or contains a
+    match for one of the regexes). Each rewrite of a rule that applies is then made if
+    the params match ('*' matches anything, None matches a missing parameter). A
+    parameter is removed if it is updated to None. Rules are applied in order.
+
+    Endpoints that match a string are found with a dictionary lookup, and all of the
+    regexes are combined into one so that most endpoints are checked with a single search.
+    """
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.__by_endpoint = {}
+        self.__patterns = []
+        self.__rewrites = []
+        for i, rule in enumerate(self.rules):
+            for endpoint_match in rule['endpoint_match']:
+                if isinstance(endpoint_match, str):
+                    self.__by_endpoint.setdefault(endpoint_match, []).append(i)
+                else:
+                    self.__patterns.append((endpoint_match, i))
+            rewrites = []
+            for rewrite in rule['rewrites']:
+                # (name, value) pairs that must match. '*' matches anything, so needn't be checked
+                checks = tuple((name, value) for name, value in rewrite['params_match'].items() if value != '*')
+                rewrites.append((checks, tuple(rewrite['params_to_update'].items())))
+            self.__rewrites.append(rewrites)
+        self.__combined_pattern = None
+        if self.__patterns and all(pattern.flags == re.UNICODE for pattern, _ in self.__patterns):
+            try:
+                self.__combined_pattern = re.compile('|'.join('(?:{})'.format(pattern.pattern) for pattern, _ in self.__patterns))
+            except re.error:
+                # (e.g. the patterns use backreferences) so check them individually
+                pass
+
+    def __matching_rules(self, endpoint):
+        matching = self.__by_endpoint.get(endpoint, [])
+        if self.__patterns and (self.__combined_pattern is None or self.__combined_pattern.search(endpoint)):
+            # At least one regex matches, so find out which (more than one rule can apply)
+            matching = matching + [i for pattern, i in self.__patterns if pattern.search(endpoint)]
+            matching = sorted(set(matching))
+        return matching
+
+    def rewrite(self, endpoint, params):
+        """Returns the endpoint and a copy of params modified according to the rules
+        (params is not modified)"""
+        params = dict(params)
+        for i in self.__matching_rules(endpoint):
+            for checks, updates in self.__rewrites[i]:
+                for name, value in checks:
+                    if value is None:
+                        if name in params and params[name] is not None:
+                            break
+                    elif name not in params or params[name] != value:
+                        break
+                else:
+                    for name, value in updates:
+                        if value is None:
+                            params.pop(name, None)
+                        elif isinstance(value, (list, dict)):
+                            # (so that the caller can't modify the rules)
+                            params[name] = copy.copy(value)
+                        else:
+                            params[name] = value
+        return endpoint, params
@@ -0,0 +1,242 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# A pool of keep-alive HTTP sessions, one per (service, username) pair.
+#
+# Every call to requests.get/post/etc opens a new TCP connection and performs a
+# new TLS handshake. Over the hundreds of thousands of requests made while
+# crawling a large repository, that adds up to hours. Instead, all HTTP traffic
+# is sent through a requests.Session belonging to the credential that made it,
+# so that connections to the same host are kept alive and reused.
+
+import threading
+from urllib import parse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class _CountingConnectionMixin(object):
+    adapter = None
+
+    def connect(self):
+        self.adapter.count_connection()
+        return super(_CountingConnectionMixin, self).connect()
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts the number of requests sent and the number of
+    (TCP) connections that had to be opened in order to send them"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.__count_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_connections = 0
+        # Use connection classes that tell us every time they (re)connect
+        pool_classes = {}
+        for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items():
+            connection_cls = type('Counting'+pool_cls.ConnectionCls.__name__, (_CountingConnectionMixin, pool_cls.ConnectionCls), {'adapter': self})
+            pool_classes[scheme] = type('Counting'+pool_cls.__name__, (pool_cls,), {'ConnectionCls': connection_cls})
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+    def count_connection(self):
+        with self.__count_lock:
+            self.num_connections += 1
+
+    def send(self, *args, **kwargs):
+        with self.__count_lock:
+            self.num_requests += 1
+        return super(CountingHTTPAdapter, self).send(*args, **kwargs)
+
+    def statistics(self):
+        return self.num_requests, self.num_connections
+
+
+class HostRedirectAdapter(BaseAdapter):
+    """Transport adapter that sends requests for some hosts to a different server
+    (for example, a local mock of the BitBucket API). The original host is sent in
+    the Host header so the server can tell which service the request was for"""
+
+    def __init__(self, adapter, redirects):
+        super(HostRedirectAdapter, self).__init__()
+        self.__adapter = adapter
+        self.__redirects = redirects
+
+    def send(self, request, **kwargs):
+        original_url = request.url
+        split_url = parse.urlsplit(original_url)
+        target = self.__redirects.get(split_url.netloc, None)
+        if target is None:
+            return self.__adapter.send(request, **kwargs)
+        split_target = parse.urlsplit(target)
+        request = request.copy()
+        request.url = parse.urlunsplit((split_target.scheme, split_target.netloc) + tuple(split_url[2:]))
+        request.headers['Host'] = split_url.netloc
+        response = self.__adapter.send(request, **kwargs)
+        response.url = original_url
+        return response
+
+    def close(self):
+        self.__adapter.close()
+
+    def statistics(self):
+        return self.__adapter.statistics()
+
+
+class SessionPool(object):
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.__sessions = {}
+        self.__lock = threading.Lock()
+        # statistics from sessions that have been closed
+        self.__retired_requests = 0
+        self.__retired_connections = 0
+        # cassette to record the traffic to, or replay it from (see cassette.py)
+        self.__cassette = None
+        # hosts whose traffic should be sent to a different server (see redirect_hosts)
+        self.__host_redirects = {}
+
+    def configure(self, pool_connections=None, pool_maxsize=None):
+        with self.__lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            # existing sessions were created with the old pool sizes, so close them.
+            # They will be recreated (with the new sizes) the next time they are needed
+            for key in list(self.__sessions.keys()):
+                self.__close_session(key)
+
+    def use_cassette(self, cassette):
+        with self.__lock:
+            self.__cassette = cassette
+            # existing sessions send requests directly, so close them
+            for key in list(self.__sessions.keys()):
+                self.__close_session(key)
+
+    def redirect_hosts(self, redirects):
+        """Send all requests for the hosts in the keys of redirects to the
+        server (scheme://host:port) in the corresponding value"""
+        with self.__lock:
+            self.__host_redirects = dict(redirects)
+            for key in list(self.__sessions.keys()):
+                self.__close_session(key)
+
+    def get_session(self, service, auth=None):
+        key = (service, auth[0] if auth else None)
+        with self.__lock:
+            session = self.__sessions.get(key, None)
+            if session is None:
+                session = requests.Session()
+                adapter = CountingHTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+                if self.__host_redirects:
+                    adapter = HostRedirectAdapter(adapter, self.__host_redirects)
+                if self.__cassette is not None:
+                    adapter = self.__cassette.wrap(adapter)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                if auth:
+                    session.auth = tuple(auth)
+                self.__sessions[key] = session
+            return session
+
+    def request(self, service, auth, method, url, **kwargs):
+        session = self.get_session(service, auth)
+        if auth:
+            # make sure the password used is the one we were given (it may have been
+            # changed by the user since the session was created)
+            kwargs.setdefault('auth', tuple(auth))
+        return session.request(method, url, **kwargs)
+
+    def close(self):
+        with self.__lock:
+            for key in list(self.__sessions.keys()):
+                self.__close_session(key)
+
+    def __close_session(self, key):
+        session = self.__sessions.pop(key)
+        num_requests, num_connections = self.__session_statistics(session)
+        self.__retired_requests += num_requests
+        self.__retired_connections += num_connections
+        session.close()
+
+    def __session_statistics(self, session):
+        num_requests = 0
+        num_connections = 0
+        # the same adapter is mounted for both http:// and https://
+        adapters = {id(adapter): adapter for adapter in session.adapters.values()}
+        for adapter in adapters.values():
+            # (a cassette being replayed does not make any connections)
+            if hasattr(adapter, 'statistics'):
+                r, c = adapter.statistics()
+                num_requests += r
+                num_connections += c
+        return num_requests, num_connections
+
+    def statistics(self):
+        """Returns a dictionary of connection reuse statistics for each session
+        (keyed by "<service> (<username>)") as well as the total over all sessions"""
+        with self.__lock:
+            stats = {}
+            total_requests = self.__retired_requests
+            total_connections = self.__retired_connections
+            for (service, username), session in self.__sessions.items():
+                num_requests, num_connections = self.__session_statistics(session)
+                stats['{} ({})'.format(service, username or 'anonymous')] = {
+                    'requests': num_requests,
+                    'connections': num_connections,
+                    'reused': max(num_requests - num_connections, 0),
+                }
+                total_requests += num_requests
+                total_connections += num_connections
+            stats['total'] = {
+                'requests': total_requests,
+                'connections': total_connections,
+                'reused': max(total_requests - total_connections, 0),
+            }
+            return stats
+
+
+def format_statistics(stats):
+    total = stats['total']
+    percent = 100.0*total['reused']/total['requests'] if total['requests'] else 0
+    return 'HTTP connection reuse: {requests} requests made over {connections} connections ({percent:.1f}% reused a kept-alive connection)'.format(
+        requests=total['requests'],
+        connections=total['connections'],
+        percent=percent,
+    )
+
+
+# The default pool used by the rest of the package
+_default_pool = SessionPool()
+
+def configure(pool_connections=None, pool_maxsize=None):
+    _default_pool.configure(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+def use_cassette(cassette):
+    _default_pool.use_cassette(cassette)
+
+def redirect_hosts(redirects):
+    _default_pool.redirect_hosts(redirects)
+
+def get_session(service, auth=None):
+    return _default_pool.get_session(service, auth)
+
+def request(service, auth, method, url, **kwargs):
+    return _default_pool.request(service, auth, method, url, **kwargs)
+
+def statistics():
+    return _default_pool.statistics()
+
+def close():
+    _default_pool.close()
@@ -0,0 +1,233 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Statistics about the requests made to the BitBucket and GitHub APIs (and
+# the files downloaded), grouped by the kind of endpoint requested.
+#
+# Every request records its latency, status code, size, the number of times
+# it was retried and how long it waited for the rate limiter. The totals and
+# latency histograms for each endpoint family (e.g. "issues/comments" or
+# "pullrequests/activity") are written to a JSON file at a fixed interval
+# while an export runs, along with the number of requests made in each
+# interval, so that it is possible to see which parts of the data use up the
+# API quota and to spot slowdowns during long exports.
+
+import datetime
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from urllib import parse
+
+# upper bounds (in seconds) of the buckets of the latency histograms (the last bucket has no upper bound)
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+DEFAULT_INTERVAL = 60
+
+# number of intervals kept in the timeline (a week, at the default interval)
+MAX_TIMELINE = 10080
+
+# The parts of a URL path that identify the repository (rather than the kind of endpoint)
+_REPOSITORY_PREFIXES = {
+    'api.bitbucket.org': ['2.0', 'repositories'],
+    'api.github.com': ['repos'],
+}
+
+# collections whose items are named rather than numbered (so the name is not part of the family)
+_NAMED_COLLECTIONS = {'users', 'teams', 'workspaces', 'commits', 'branches', 'tags', 'attachments', 'diffstat', 'labels'}
+
+# the parts of a path that are endpoint names (rather than IDs, hashes or file names)
+_name_regex = re.compile(r'[a-z_-]+')
+
+
+def endpoint_family(url):
+    """Returns the kind of endpoint a URL is for (e.g. 'issues/comments' for the comments of any
+    issue of any repository). Files not on an API host are grouped by host."""
+    split_url = parse.urlsplit(url)
+    parts = [part for part in split_url.path.split('/') if part]
+    prefix = _REPOSITORY_PREFIXES.get(split_url.netloc, None)
+    if prefix is None:
+        return split_url.netloc
+    if parts[:len(prefix)] == prefix:
+        # drop the owner and repository names
+        parts = parts[len(prefix) + 2:]
+        if not parts:
+            return 'repository'
+    elif split_url.netloc == 'api.bitbucket.org':
+        parts = parts[1:]
+    family = []
+    for i, part in enumerate(parts):
+        if i > 0 and parts[i-1] in _NAMED_COLLECTIONS:
+            continue
+        if _name_regex.fullmatch(part):
+            family.append(part)
+    return '/'.join(family)
+
+
+def _utc_timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).isoformat(timespec='seconds')
+
+
+class _Statistics(object):
+    __slots__ = ('requests', 'bytes', 'retries', 'rate_limit_wait', 'latency', 'max_latency', 'status_codes', 'histogram')
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.retries = 0
+        self.rate_limit_wait = 0.0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.status_codes = {}
+        self.histogram = [0]*(len(LATENCY_BUCKETS) + 1)
+
+    def add(self, latency, status_code, size, retries, rate_limit_wait):
+        self.requests += 1
+        self.bytes += size
+        self.retries += retries
+        self.rate_limit_wait += rate_limit_wait
+        self.latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        status_code = str(status_code)
+        self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'rate_limit_wait': round(self.rate_limit_wait, 3),
+            'mean_latency': round(self.latency/self.requests, 4) if self.requests else None,
+            'max_latency': round(self.max_latency, 4),
+            'status_codes': dict(sorted(self.status_codes.items())),
+            'latency_histogram': list(self.histogram),
+        }
+
+
+class Telemetry(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        # {service: _Statistics} and {service: {family: _Statistics}}
+        self.__totals = {}
+        self.__families = {}
+        # requests made (and their total latency, etc) in each interval between writes
+        self.__timeline = deque(maxlen=MAX_TIMELINE)
+        self.__last_totals = (0, 0, 0, 0.0)
+        self.__path = None
+        self.__interval = DEFAULT_INTERVAL
+        self.__thread = None
+        self.__stop_event = threading.Event()
+
+    def record(self, service, url, latency, status_code, size, retries=0, rate_limit_wait=0):
+        """Records a request to url (latency and rate_limit_wait in seconds, size in bytes).
+        service is 'bitbucket', 'github' or 'downloads'. status_code may instead be the reason
+        the request failed (e.g. 'ConnectionError')"""
+        family = endpoint_family(url)
+        with self.__lock:
+            if service not in self.__totals:
+                self.__totals[service] = _Statistics()
+                self.__families[service] = {}
+            if family not in self.__families[service]:
+                self.__families[service][family] = _Statistics()
+            for statistics in (self.__totals[service], self.__families[service][family]):
+                statistics.add(latency, status_code, size, retries, rate_limit_wait)
+
+    def snapshot(self):
+        """Returns the statistics as a dictionary (as written to the telemetry file)"""
+        with self.__lock:
+            return {
+                'started': _utc_timestamp(self.__started),
+                'updated': _utc_timestamp(time.time()),
+                'interval': self.__interval,
+                'latency_buckets': LATENCY_BUCKETS,
+                'totals': {service: statistics.as_dict() for service, statistics in sorted(self.__totals.items())},
+                'endpoints': {
+                    service: {family: statistics.as_dict() for family, statistics in sorted(families.items())}
+                    for service, families in sorted(self.__families.items())
+                },
+                'timeline': list(self.__timeline),
+            }
+
+    def __add_to_timeline(self):
+        with self.__lock:
+            totals = (
+                sum(statistics.requests for statistics in self.__totals.values()),
+                sum(statistics.bytes for statistics in self.__totals.values()),
+                sum(statistics.retries for statistics in self.__totals.values()),
+                sum(statistics.latency for statistics in self.__totals.values()),
+            )
+            requests, size, retries, latency = [now - before for now, before in zip(totals, self.__last_totals)]
+            self.__last_totals = totals
+            self.__timeline.append({
+                'time': _utc_timestamp(time.time()),
+                'requests': requests,
+                'bytes': size,
+                'retries': retries,
+                'mean_latency': round(latency/requests, 4) if requests else None,
+            })
+
+    def write(self, path):
+        """Writes the statistics to path (replacing it atomically)"""
+        self.__add_to_timeline()
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1)
+        os.replace(tmp, path)
+
+    def __run(self):
+        while not self.__stop_event.wait(self.__interval):
+            try:
+                self.write(self.__path)
+            except OSError as e:
+                print('Could not write the API statistics to {}: {}'.format(self.__path, e))
+
+    def start(self, path, interval=DEFAULT_INTERVAL):
+        """Writes the statistics to path every interval seconds (until stop() is called)"""
+        self.stop()
+        self.__path = path
+        self.__interval = max(interval, 1)
+        self.__stop_event = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stops the periodic writes, and writes the final statistics"""
+        if self.__thread is None:
+            return
+        self.__stop_event.set()
+        self.__thread.join()
+        self.__thread = None
+        try:
+            self.write(self.__path)
+        except OSError as e:
+            print('Could not write the API statistics to {}: {}'.format(self.__path, e))
+
+
+# The statistics recorded by the rest of the package
+_default_telemetry = Telemetry()
+
+def record(service, url, latency, status_code, size, retries=0, rate_limit_wait=0):
+    _default_telemetry.record(service, url, latency, status_code, size, retries, rate_limit_wait)
+
+def snapshot():
+    return _default_telemetry.snapshot()
+
+def start(path, interval=DEFAULT_INTERVAL):
+    _default_telemetry.start(path, interval)
+
+def stop():
+    _default_telemetry.stop()
@@ -0,0 +1,92 @@
+# Copyright 2019 Philip Starkey
+#
+# This file is part of bitbucket-hg-exporter.
+# https://github.com/philipstarkey/bitbucket-hg-exporter
+#
+# bitbucket-hg-exporter is distributed under the GPLv3.
+# See the LICENSE file in the GitHub repository for further details.
+
+# Keeps track of the files saved by the crawl of the BitBucket API.
+#
+# The crawl needs to know, for every URL it finds, whether the file it would
+# be saved to already exists (downloaded on a previous run) and whether it has
+# already been processed on this run (in which case it is a duplicate). Rather
+# than asking the filesystem each time (and keeping an object per file), the
+# save directory is scanned once at startup and the paths are kept in sets,
+# which are updated as files are saved.
+#
+# Paths are stored as fixed size (128 bit) digests rather than strings, so
+# memory use stays small (and independent of the length of the URLs) for
+# repositories with millions of API endpoints.
+
+import hashlib
+import os
+import threading
+
+# files saved alongside the data that the crawl never looks up
+_IGNORED_SUFFIXES = ('.meta', '.part')
+
+
+def _key(path):
+    # (paths built from API endpoints use '/', whereas the scan uses os.sep)
+    path = os.path.normcase(os.path.normpath(path))
+    return hashlib.blake2b(path.encode('utf-8', 'surrogateescape'), digest_size=16).digest()
+
+
+class VisitedSet(object):
+    def __init__(self, root):
+        self.root = root
+        self.__files = set()
+        self.__dirs = set()
+        self.__visited = set()
+        # (files are also added by the threads downloading attachments and avatars)
+        self.__lock = threading.Lock()
+
+    def scan(self):
+        """Records the files and directories that already exist below root"""
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            keys = [_key(os.path.join(dirpath, filename)) for filename in filenames if not filename.endswith(_IGNORED_SUFFIXES)]
+            with self.__lock:
+                self.__dirs.add(_key(dirpath))
+                self.__files.update(keys)
+
+    def exists(self, path):
+        """Returns True if the file exists (as of the scan, or having been added since)"""
+        key = _key(path)
+        with self.__lock:
+            return key in self.__files
+
+    def add(self, path):
+        """Records that the file has been saved"""
+        key = _key(path)
+        with self.__lock:
+            self.__files.add(key)
+
+    def makedirs(self, path):
+        """Creates a directory (and its parents) unless it is known to exist"""
+        key = _key(path)
+        with self.__lock:
+            if key in self.__dirs:
+                return
+        os.makedirs(path, exist_ok=True)
+        with self.__lock:
+            self.__dirs.add(key)
+
+    def visit(self, path):
+        """Marks the file as processed on this run. Returns True if it already was"""
+        key = _key(path)
+        with self.__lock:
+            if key in self.__visited:
+                return True
+            self.__visited.add(key)
+            return False
+
+    def visited(self, path):
+        key = _key(path)
+        with self.__lock:
+            return key in self.__visited
+
+    def clear_visited(self):
+        """Forgets which files have been processed (but not which exist)"""
+        with self.__lock:
+            self.__visited = set()
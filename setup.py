@@ -113,6 +113,7 @@ setup(
     entry_points = {
         "console_scripts": [
             "bitbucket-hg-exporter = bitbucket_hg_exporter.__main__:main",
+            "bitbucket-hg-exporter-benchmark = bitbucket_hg_exporter.benchmark:main",
         ]
     },
     data_files=datafiles,